@@ -0,0 +1,8 @@
+# coding=UTF-8
+"""
+Microbenchmarks for CoolAMQP's hot paths.
+
+These do not need a broker. Run each one as a module, eg.
+
+    python -m benchmarks.dispatch
+"""
@@ -0,0 +1,95 @@
+# coding=UTF-8
+"""
+Cost of receiving a message on a consumer's channel, from raw bytes to on_message.
+
+Counts Python-level object constructions (calls to __init__ and __new__) per
+message, with and without the content receiver fast path, and times both.
+Then does the same with the fast path, for a consumer that acks every message.
+"""
+from __future__ import print_function, absolute_import, division
+
+import collections
+import io
+import sys
+import timeit
+
+from coolamqp.attaches import Consumer
+from coolamqp.framing.definitions import BasicDeliver, BasicConsumeOk, \
+    BasicContentPropertyList
+from coolamqp.framing.frames import AMQPMethodFrame, AMQPHeaderFrame, AMQPBodyFrame
+from coolamqp.objects import NodeDefinition, Queue
+from coolamqp.uplink.connection import Connection
+
+MESSAGES = 1000
+
+
+def make_consumer(no_ack=True):
+    conn = Connection(NodeDefinition('127.0.0.1', 'guest', 'guest'), None, [])
+    conn.send = lambda frames, priority=False: None
+    if no_ack:
+        cons = Consumer(Queue(), lambda msg: None, no_ack=True)
+    else:
+        cons = Consumer(Queue(), lambda msg: msg.ack(), no_ack=False)
+    cons.connection = conn
+    cons.channel_id = 1
+    cons.consumer_tag = b'ctag'
+    cons.on_setup(BasicConsumeOk(b'ctag'))
+    return conn, cons
+
+
+def make_data():
+    buf = io.BytesIO()
+    properties = BasicContentPropertyList(content_type=b'application/json',
+                                          delivery_mode=2)
+    for i in range(MESSAGES):
+        AMQPMethodFrame(1, BasicDeliver(b'ctag', i + 1, False, b'exchange', b'routing.key')) \
+            .write_to(buf)
+        AMQPHeaderFrame(1, 60, 0, 10, properties).write_to(buf)
+        AMQPBodyFrame(1, b'0123456789').write_to(buf)
+    return buf.getvalue()
+
+
+def count_constructions(conn, data):
+    counter = collections.Counter()
+
+    def get_constructed(frame):
+        if frame is None or frame.f_code.co_name not in ('__init__', '__new__'):
+            return None
+        return frame.f_locals.get('self', frame.f_locals.get('cls'))
+
+    def profile(frame, event, arg):
+        if event == 'call':
+            obj = get_constructed(frame)
+            # don't count base class' constructors
+            if obj is not None and obj is not get_constructed(frame.f_back):
+                counter[(obj if isinstance(obj, type) else type(obj)).__name__] += 1
+
+    sys.setprofile(profile)
+    try:
+        conn.recvf.put(data)
+    finally:
+        sys.setprofile(None)
+    return counter
+
+
+def run():
+    data = make_data()
+    for name, fast_path, no_ack in (('Fast path disabled', False, True),
+                                    ('Fast path enabled', True, True),
+                                    ('Fast path enabled, acking', True, False)):
+        conn, cons = make_consumer(no_ack)
+        if not fast_path:
+            conn.remove_content_receiver(1)
+
+        counter = count_constructions(conn, data)
+        seconds = min(timeit.repeat(lambda: conn.recvf.put(data), number=10, repeat=5))
+
+        print('%s: %.1f objects constructed per message, %.2f us per message' % (
+            name, sum(counter.values()) / MESSAGES,
+            seconds / (10 * MESSAGES) * 1e6))
+        for name, count in counter.most_common():
+            print('    %-40s %.1f' % (name, count / MESSAGES))
+
+
+if __name__ == '__main__':
+    run()
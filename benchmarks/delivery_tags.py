@@ -0,0 +1,66 @@
+# coding=UTF-8
+"""
+Soak test of tracking delivery tags of unacked messages with DeliveryTagSet, versus a plain set.
+
+A consumer with a prefetch window of 10000 messages is simulated. Messages are acked
+in random order within the window, and one in every million is never acked at all, the way
+a message stuck in some application's queue would be. Memory taken by both structures is
+printed every few million messages, and it should stay flat for DeliveryTagSet.
+Note that a plain set can't tell the lowest outstanding tag in O(1), which is needed
+to coalesce acks. DeliveryTagSet is measured once more, asking for it after every ack,
+the way a consumer with ack_batch_size does.
+
+Pass the amount of messages to simulate, in millions, as the argument (default is 20).
+A week of consuming at 50k messages per second is about 30000 millions.
+"""
+from __future__ import print_function, absolute_import, division
+
+import random
+import sys
+import time
+
+from coolamqp.attaches.utils import DeliveryTagSet
+
+PREFETCH = 10000
+NEVER_ACKED_EVERY = 1000000
+REPORT_EVERY = 2000000
+INT_SIZE = sys.getsizeof(2 ** 40)
+
+
+def footprint(tags):
+    if isinstance(tags, DeliveryTagSet):
+        return sys.getsizeof(tags.bits) + sys.getsizeof(tags.stragglers) + \
+               INT_SIZE * len(tags.stragglers)
+    return sys.getsizeof(tags) + INT_SIZE * len(tags)
+
+
+def measure(name, tags, messages, lowest=False):
+    rng = random.Random(0)
+    window = []
+    started = time.time()
+    for tag in range(1, messages + 1):
+        tags.add(tag)
+        if tag % NEVER_ACKED_EVERY:
+            window.append(tag)
+        if len(window) >= PREFETCH:
+            i = rng.randrange(len(window))
+            window[i], window[-1] = window[-1], window[i]
+            tags.discard(window.pop())
+            if lowest:
+                tags.lowest()
+
+        if tag % REPORT_EVERY == 0:
+            print('%s: %5dM messages, %5d outstanding, %8d bytes' % (
+                name, tag // 1000000, len(tags), footprint(tags)))
+
+    print('%s: %.3f us per message' % (name, (time.time() - started) / messages * 1e6))
+
+
+def run(millions=20):
+    measure('DeliveryTagSet', DeliveryTagSet(), millions * 1000000)
+    measure('DeliveryTagSet, lowest()', DeliveryTagSet(), millions * 1000000, lowest=True)
+    measure('set', set(), millions * 1000000)
+
+
+if __name__ == '__main__':
+    run(*[int(arg) for arg in sys.argv[1:]])
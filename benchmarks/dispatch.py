@@ -0,0 +1,79 @@
+# coding=UTF-8
+"""
+Per-frame cost of Connection dispatching frames to watches.
+
+A consumer on channel 1 receives a stream of BasicDeliver/header/body triples,
+while the rest of the watches are registered the way attaches would register
+them - a close watch per channel and a pending MethodWatch here and there.
+
+With a single watch, it's a catch-all watch on channel 1.
+"""
+from __future__ import print_function, absolute_import, division
+
+import timeit
+
+from coolamqp.framing.definitions import BasicDeliver, BasicContentPropertyList, \
+    ChannelClose, ChannelCloseOk, BasicCancel, BasicCancelOk, QueueDeclareOk
+from coolamqp.framing.frames import AMQPMethodFrame, AMQPHeaderFrame, AMQPBodyFrame
+from coolamqp.objects import NodeDefinition
+from coolamqp.uplink.connection import Connection, HeaderOrBodyWatch, MethodWatch, Watch
+
+FRAMES_IN_BATCH = 300
+REPEATS = 200
+
+
+class CatchAllWatch(Watch):
+    def __init__(self, channel):
+        Watch.__init__(self, channel, False)
+
+    def is_triggered_by(self, frame):
+        return True
+
+
+def on_delivery(frame):
+    pass
+
+
+def make_connection(watch_count):
+    conn = Connection(NodeDefinition('127.0.0.1', 'guest', 'guest'), None, [])
+
+    if watch_count == 1:
+        conn.watch(CatchAllWatch(1))
+        return conn
+
+    conn.watch(HeaderOrBodyWatch(1, on_delivery))
+    deliver_watch = MethodWatch(1, BasicDeliver, on_delivery)
+    deliver_watch.oneshot = False
+    conn.watch(deliver_watch)
+
+    for i in range(watch_count - 2):
+        channel = 2 + i // 2
+        if i % 2:
+            conn.watch_for_method(channel, QueueDeclareOk, on_delivery)
+        else:
+            conn.watch_for_method(channel, (ChannelClose, ChannelCloseOk, BasicCancel,
+                                            BasicCancelOk), on_delivery)
+    return conn
+
+
+def make_batch():
+    frames = []
+    for i in range(FRAMES_IN_BATCH // 3):
+        frames.append(AMQPMethodFrame(1, BasicDeliver(b'ctag', i, False, b'', b'rkey')))
+        frames.append(AMQPHeaderFrame(1, 60, 0, 5, BasicContentPropertyList()))
+        frames.append(AMQPBodyFrame(1, b'hello'))
+    return frames
+
+
+def run():
+    batch = make_batch()
+    print('Dispatching batches of %s frames' % (len(batch),))
+    for watch_count in (1, 10, 1000):
+        conn = make_connection(watch_count)
+        seconds = min(timeit.repeat(lambda: conn.on_frames(batch), number=REPEATS, repeat=5))
+        print('%5s watches: %6.3f us per frame' % (
+            watch_count, seconds / (REPEATS * len(batch)) * 1e6))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,45 @@
+# coding=UTF-8
+"""
+Per-message cost of serializing frames of a publish, when every message is published
+with the same MessageProperties object, versus a fresh one for every message.
+
+Only the framing is measured - the frames are serialized, as the publisher would do it,
+but not sent anywhere.
+"""
+from __future__ import print_function, absolute_import, division
+
+import timeit
+
+from coolamqp.framing.definitions import BasicPublish
+from coolamqp.framing.frames import AMQPMethodFrame, AMQPHeaderFrame, AMQPBodyFrame
+from coolamqp.objects import MessageProperties
+from coolamqp.uplink.connection.send_framer import SendingFramer
+
+MESSAGES = 20000
+BODY = b'x' * 100
+
+
+def make_properties():
+    return MessageProperties(content_type=b'application/json', content_encoding=b'utf8',
+                             delivery_mode=2, app_id=b'benchmark',
+                             headers={'trace-id': '0123456789abcdef', 'hops': 3})
+
+
+def publish(framer, properties):
+    framer.send([AMQPMethodFrame(1, BasicPublish(b'exchange', b'routing.key', False, False)),
+                 AMQPHeaderFrame(1, 60, 0, len(BODY), properties),
+                 AMQPBodyFrame(1, BODY)])
+
+
+def run():
+    framer = SendingFramer(lambda data, priority: None)
+    shared = make_properties()
+
+    for name, stmt in (('Shared properties', lambda: publish(framer, shared)),
+                       ('Fresh properties', lambda: publish(framer, make_properties()))):
+        seconds = min(timeit.repeat(stmt, number=MESSAGES, repeat=5))
+        print('%s: %6.3f us per message' % (name, seconds / MESSAGES * 1e6))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,74 @@
+# coding=UTF-8
+"""
+Cost of tracking publisher confirms with AtomicTagger, with 100k messages in flight.
+
+100k tags are deposited, and then they are confirmed:
+
+* nearly in order - the way a broker might confirm them, mostly one by one (in slightly
+  shuffled order), with a multiple ack every now and then
+* shuffled - one by one, in completely random order
+"""
+from __future__ import print_function, absolute_import, division
+
+import random
+import time
+
+from coolamqp.attaches.utils import AtomicTagger
+
+IN_FLIGHT = 100000
+MULTIPLE_EVERY = 50  # every that many acks is a multiple one
+
+
+class NullConfirmable(object):
+    __slots__ = ()
+
+    def confirm(self):
+        pass
+
+    def reject(self):
+        pass
+
+
+def make_nearly_in_order_acks():
+    rng = random.Random(0)
+    tags = list(range(1, IN_FLIGHT + 1))
+    # swap neighbouring tags, brokers confirm roughly, but not exactly in order
+    for i in range(0, IN_FLIGHT - 1, 2):
+        if rng.random() < 0.5:
+            tags[i], tags[i + 1] = tags[i + 1], tags[i]
+
+    acks = []
+    for i, tag in enumerate(tags):
+        acks.append((tag, i % MULTIPLE_EVERY == MULTIPLE_EVERY - 1))
+    return acks
+
+
+def make_shuffled_acks():
+    tags = list(range(1, IN_FLIGHT + 1))
+    random.Random(0).shuffle(tags)
+    return [(tag, False) for tag in tags]
+
+
+def measure(name, acks):
+    confirmable = NullConfirmable()
+
+    tagger = AtomicTagger()
+    started = time.time()
+    for i in range(IN_FLIGHT):
+        tagger.deposit(tagger.get_key(), confirmable)
+    deposited = time.time()
+    for tag, multiple in acks:
+        tagger.ack(tag, multiple)
+    acked = time.time()
+
+    print('%s: deposit %6.3f us, ack %6.3f us per message' % (
+        name, (deposited - started) / IN_FLIGHT * 1e6, (acked - deposited) / IN_FLIGHT * 1e6))
+
+
+def run():
+    measure('Nearly in order', make_nearly_in_order_acks())
+    measure('Shuffled', make_shuffled_acks())
+
+
+if __name__ == '__main__':
+    run()
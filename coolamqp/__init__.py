@@ -1 +1 @@
-__version__ = '2.1.2'
+__version__ = '2.2.0'
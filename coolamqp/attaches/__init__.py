@@ -15,5 +15,8 @@ EVERYTHING HERE IS CALLED BY LISTENER THREAD UNLESS STATED OTHERWISE.
 
 from coolamqp.attaches.consumer import Consumer, BodyReceiveMode
 from coolamqp.attaches.publisher import Publisher
+from coolamqp.attaches.window import InFlightWindow
+from coolamqp.attaches.prefetch import PrefetchController, PrefetchStats
+from coolamqp.attaches.frame_buffer import FrameBuffer
 from coolamqp.attaches.agroup import AttacheGroup
 from coolamqp.attaches.declarer import Declarer
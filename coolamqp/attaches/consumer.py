@@ -1,8 +1,10 @@
 # coding=UTF-8
 from __future__ import absolute_import, division, print_function
 
+import functools
 import io
 import logging
+import threading
 import typing as tp
 import uuid
 import warnings
@@ -10,22 +12,32 @@ from concurrent.futures import Future
 
 import coolamqp.argumentify
 from coolamqp.attaches.channeler import Channeler, ST_ONLINE, ST_OFFLINE
+from coolamqp.attaches.prefetch import PrefetchController
+from coolamqp.attaches.utils import DeliveryTagSet
 from coolamqp.exceptions import AMQPError
 from coolamqp.framing.definitions import ChannelOpenOk, BasicConsume, \
     BasicConsumeOk, QueueDeclare, QueueDeclareOk, ExchangeDeclare, \
     ExchangeDeclareOk, \
     QueueBind, QueueBindOk, ChannelClose, BasicDeliver, BasicCancel, \
-    BasicAck, BasicReject, RESOURCE_LOCKED, BasicCancelOk, BasicQos, BasicQosOk
+    BasicAck, BasicReject, RESOURCE_LOCKED, BasicCancelOk, BasicQos, BasicQosOk, BasicNack
 from coolamqp.framing.frames import AMQPBodyFrame, AMQPHeaderFrame
-from coolamqp.objects import Callable
+from coolamqp.objects import Callable, MessageBatch, ReceivedMessage
 from coolamqp.argumentify import argumentify
 from coolamqp.uplink import HeaderOrBodyWatch, MethodWatch
+from coolamqp.utils import monotonic
 
 logger = logging.getLogger(__name__)
 
 EMPTY_MEMORYVIEW = memoryview(b'')  # for empty messages
 
 
+def _settlement(delivery_tag, success):  # type: (int, bool) -> tp.Union[BasicAck, BasicReject]
+    """Return the method that acks or rejects a single message"""
+    if success:
+        return BasicAck(delivery_tag, False)
+    return BasicReject(delivery_tag, True)
+
+
 class BodyReceiveMode(object):
     #: # message.body will be a single bytes object
     #: this will gather frames as memoryviews, and b''.join() them upon receiving last frame
@@ -109,20 +121,58 @@ class Consumer(Channeler):
     :type body_receive_mode: a property of :class:`BodyReceiveMode`
     :param arguments: a dictionary, extra set of arguments to be provided to RabbitMQ during binding.
         Primarily to support streams.
+    :param ack_batch_size: if more than 1, acknowledgements are coalesced. As long as messages are
+        acked (or rejected) in order of delivery, a single basic.ack (or basic.nack) with
+        multiple set is sent for every ack_batch_size of them, or ack_batch_interval seconds after
+        the first of them, whichever comes first. Messages acked out of order are acked at once.
+        Requires RabbitMQ, if messages are rejected. Must be lower than qos (and prefetch_controller's
+        min_qos), or the broker would stop delivering messages, waiting for acks that wait for
+        the timer - ValueError is raised otherwise.
+    :type ack_batch_size: int
+    :param ack_batch_interval: seconds after which coalesced acknowledgements are sent. The listener
+        thread checks for such acknowledgements that often.
+    :type ack_batch_interval: float
+    :param message_class: class of messages passed to on_message. Must be ReceivedMessage
+        or it's subclass, constructed the same way.
+    :param on_messages: callable that will process incoming messages in batches. If given,
+        it's called instead of on_message with a :class:`coolamqp.objects.MessageBatch` of
+        all messages received with a single read from the socket, but no more than batch_size
+        of them, or batch_bytes of their bodies. Call .ack() on the batch to ack them all.
+    :type on_messages: callable(MessageBatch instance)
+    :param batch_size: maximum amount of messages in a batch. Keep it no bigger than qos.
+    :type batch_size: int
+    :param batch_bytes: maximum total size of bodies of messages in a batch, or None for no limit
+    :type batch_bytes: int
+    :param batch_linger: if given, a batch is not passed at the end of a read, but only once
+        it's full or it's first message waited for that many seconds
+    :type batch_linger: float
+    :param prefetch_controller: if given, it will adjust qos of this consumer as it goes.
+        qos is then the prefetch count to start with. Requires no_ack=False.
+    :type prefetch_controller: :class:`coolamqp.attaches.PrefetchController`
     """
     __slots__ = ('queue', 'no_ack', 'on_message', 'cancelled', 'receiver',
                  'attache_group', 'channel_close_sent', 'qos', 'qos_update_sent',
                  'future_to_notify', 'future_to_notify_on_dead',
                  'fail_on_first_time_resource_locked',
                  'body_receive_mode', 'consumer_tag', 'on_cancel', 'on_broker_cancel',
-                 'hb_watch', 'deliver_watch', 'span', 'arguments')
+                 'hb_watch', 'deliver_watch', 'span', 'arguments', 'ack_batch_size',
+                 'ack_batch_interval', 'message_class', 'on_messages', 'batch_size',
+                 'batch_bytes', 'batch_linger', 'prefetch_controller')
 
     def __init__(self, queue, on_message, span=None,
                  no_ack=True, qos=0,
                  future_to_notify=None,
                  fail_on_first_time_resource_locked=False,
                  body_receive_mode=BodyReceiveMode.BYTES,
-                 arguments=None
+                 arguments=None,
+                 ack_batch_size=1,  # type: int
+                 ack_batch_interval=0.05,  # type: float
+                 message_class=ReceivedMessage,  # type: tp.Type[ReceivedMessage]
+                 on_messages=None,  # type: tp.Optional[tp.Callable[[MessageBatch], None]]
+                 batch_size=100,  # type: int
+                 batch_bytes=None,  # type: tp.Optional[int]
+                 batch_linger=0,  # type: float
+                 prefetch_controller=None  # type: tp.Optional[PrefetchController]
                  ):
         """
         Note that if you specify QoS, it is applied before basic.consume is
@@ -159,6 +209,24 @@ class Consumer(Channeler):
 
         self.consumer_tag = None
 
+        self.ack_batch_size = ack_batch_size
+        self.ack_batch_interval = ack_batch_interval
+        self.message_class = message_class
+        self.on_messages = on_messages
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.batch_linger = batch_linger
+        self.prefetch_controller = prefetch_controller
+        if prefetch_controller is not None:
+            if no_ack:
+                raise ValueError(u'prefetch_controller requires no_ack=False')
+            self.qos = prefetch_controller.initial_qos(self.qos)
+        if ack_batch_size > 1 and not no_ack:
+            if prefetch_controller is not None:
+                qos = prefetch_controller.min_qos
+            if qos and ack_batch_size >= qos:
+                raise ValueError(u'ack_batch_size must be lower than qos')
+
         self.on_cancel = Callable(
             oneshots=True)  #: public, called on cancel for any reason
         self.on_broker_cancel = Callable(
@@ -173,7 +241,8 @@ class Consumer(Channeler):
         :type prefetch_count: int
         """
         if self.state == ST_ONLINE:
-            self.method(BasicQos(0, prefetch_count, False))
+            self.method_and_watch(BasicQos(0, prefetch_count, False), BasicQosOk,
+                                  lambda payload: None)
         self.qos = prefetch_count
 
     def cancel(self):  # type: () -> Future
@@ -194,6 +263,10 @@ class Consumer(Channeler):
             self.future_to_notify_on_dead = Future()
             self.future_to_notify_on_dead.set_running_or_notify_cancel()
 
+        if self.receiver is not None:
+            # send what was acked so far, or these messages would be redelivered
+            self.receiver.flush_acks()
+
         self.cancelled = True
         self.on_cancel()
         # you'll blow up big next time you try to use this consumer if you
@@ -228,6 +301,7 @@ class Consumer(Channeler):
         else:
             self.hb_watch.cancel()
             self.deliver_watch.cancel()
+            self.connection.remove_content_receiver(self.channel_id)
             self.receiver.on_gone()
             self.receiver = None
 
@@ -349,11 +423,11 @@ class Consumer(Channeler):
             return
 
         if isinstance(sth, BasicDeliver):
-            self.receiver.on_basic_deliver(sth)
+            self.receiver.on_deliver(sth.delivery_tag, sth.exchange, sth.routing_key)
         elif isinstance(sth, AMQPBodyFrame):
             self.receiver.on_body(sth.data)
         elif isinstance(sth, AMQPHeaderFrame):
-            self.receiver.on_head(sth)
+            self.receiver.on_content_header(sth.body_size, sth.properties)
 
             # No point in listening for more stuff, that's all the watches
             # even listen for
@@ -462,6 +536,15 @@ class Consumer(Channeler):
             self.deliver_watch.oneshot = False
             self.connection.watch(self.deliver_watch)
 
+            # and bypass them altogether, if possible
+            self.connection.set_content_receiver(self.channel_id, self.receiver)
+
+            if self.prefetch_controller is not None:
+                self.connection.watchdog(self.prefetch_controller.interval,
+                                         self.receiver.on_prefetch_timer)
+            if self.ack_batch_size > 1 and not self.no_ack:
+                self.connection.watchdog(self.ack_batch_interval, self.receiver.on_ack_timer)
+
             self.state = ST_ONLINE
 
             if self.cancelled:
@@ -483,12 +566,16 @@ class MessageReceiver(object):
     This object is TORN DOWN when a consumer goes offline,
     and is recreated when it goes online.
 
-    This is called by consumer upon receiving different parts of the message,
-    and may opt to kill the connection on bad framing with
-    self.consumer.connection.send(None)
+    This is called by consumer, or directly by connection's ReceivingFramer,
+    upon receiving different parts of the message, and may opt to kill the
+    connection on bad framing with self.consumer.connection.send(None)
     """
-    __slots__ = ('consumer', 'state', 'bdeliver', 'header', 'body', 'data_to_go',
-                 'message_size', 'offset', 'acks_pending', 'recv_mode')
+    __slots__ = ('consumer', 'state', 'delivery_tag', 'exchange', 'routing_key',
+                 'properties', 'body', 'data_to_go', 'message_size', 'offset',
+                 'acks_pending', 'recv_mode', 'ack_lock', 'acks_to_send', 'send_lock',
+                 'batch_tag', 'batch_success', 'batch_count', 'batch_since',
+                 'messages', 'messages_size',
+                 'messages_since', 'settled', 'delivered', 'unacked_sum')
 
     def __init__(self, consumer):  # type: (Consumer) -> None
         self.consumer = consumer
@@ -497,8 +584,10 @@ class MessageReceiver(object):
         # 2 - waiting for Body [all]
         # 3 - gone!
 
-        self.bdeliver = None  # payload of Basic-Deliver
-        self.header = None  # AMQPHeaderFrame
+        self.delivery_tag = None  # fields of Basic-Deliver
+        self.exchange = None
+        self.routing_key = None
+        self.properties = None  # content property list of the message
         if consumer.body_receive_mode == BodyReceiveMode.MEMORYVIEW:
             self.body = None  # None is an important sign - first piece of
             # message
@@ -510,7 +599,27 @@ class MessageReceiver(object):
         self.offset = 0  # used only in MEMORYVIEW mode - pointer to self.body
         #  (which would be a buffer)
 
-        self.acks_pending = set()  # list of things to ack/reject
+        # delivery tags of messages to ack/reject. Protected by ack_lock, as is
+        # coalescing of acks, if consumer.ack_batch_size > 1.
+        self.acks_pending = DeliveryTagSet()
+        self.ack_lock = threading.Lock()
+        # acks and rejects to send, in order. They are queued with ack_lock held, and
+        # sent with only send_lock held, so that receiving messages doesn't wait for that.
+        self.acks_to_send = []  # type: tp.List[coolamqp.framing.base.AMQPMethodPayload]
+        self.send_lock = threading.Lock()
+        # for consumer.prefetch_controller, since it's last interval
+        self.settled = 0  # messages acked or rejected
+        self.delivered = 0  # messages delivered
+        self.unacked_sum = 0  # sum of amounts of unacked messages, counted on every delivery
+        self.batch_tag = None  # highest tag of the batch to be sent, or None if there's none
+        self.batch_success = True  # whether the batch is acked or rejected
+        self.batch_count = 0  # amount of messages in the batch
+        self.batch_since = 0.0  # monotonic() when the first of them was acked
+
+        # Messages to pass to consumer.on_messages. Touched only by the listener thread.
+        self.messages = MessageBatch()
+        self.messages_size = 0  # total size of their bodies
+        self.messages_since = 0.0  # monotonic() when the first of them was received
 
         self.recv_mode = consumer.body_receive_mode
         # if BYTES, pieces (as mvs) are received into .body and b''.join()ed
@@ -526,55 +635,238 @@ class MessageReceiver(object):
     def on_gone(self):
         """Called by Consumer to inform upon discarding this receiver"""
         self.state = 3
+        self.messages = MessageBatch()  # they will be redelivered
 
-    def confirm(self, delivery_tag, success):  # type: (int, tp.Callable[[], None]) -> None
+    def settle(self, delivery_tag, success):  # type: (int, bool) -> None
         """
-        This crafts a constructor for confirming messages.
+        Ack or reject a message. Called by ReceivedMessage.
+
+        Calling it multiple times for a message has no ill effect, neither
+        has calling it if this receiver is long gone, or the consumer is no_ack.
 
-        This should return a callable/0, whose calling will ACK or REJECT the
-        message.
-        Calling it multiple times should have no ill effect.
+        :param delivery_tag: delivery_tag to ack
+        :param success: True if ACK, False if REJECT
+        """
+        if self.state == 3:
+            return  # Gone!
+
+        if self.consumer.cancelled:
+            return  # cancelled!
+
+        with self.ack_lock:
+            if not self.acks_pending.discard(delivery_tag):
+                return  # already confirmed/rejected
+            self.settled += 1
+            if self.consumer.ack_batch_size > 1:
+                self._coalesce(delivery_tag, success)
+            else:
+                self.acks_to_send.append(_settlement(delivery_tag, success))
+        self._send_acks()
 
-        If this receiver is long gone,
+    def confirm(self, delivery_tag, success):  # type: (int, bool) -> tp.Callable[[], None]
+        """
+        Return a callable/0, whose calling will ACK or REJECT the message.
 
         :param delivery_tag: delivery_tag to ack
         :param success: True if ACK, False if REJECT
         :return: callable/0
         """
+        return functools.partial(self.settle, delivery_tag, success)
 
-        def clbl():
-            if self.state == 3:
-                return  # Gone!
+    def settle_many(self, delivery_tags, success):  # type: (tp.List[int], bool) -> None
+        """
+        Ack or reject many messages. Called by MessageBatch.
 
-            if self.consumer.cancelled:
-                return  # cancelled!
+        :param delivery_tags: delivery tags of messages, in increasing order
+        :param success: True if ACK, False if REJECT
+        """
+        if self.state == 3 or self.consumer.cancelled:
+            return
 
-            if delivery_tag not in self.acks_pending:
+        with self.ack_lock:
+            delivery_tags = [tag for tag in delivery_tags if self.acks_pending.discard(tag)]
+            if not delivery_tags:
                 return  # already confirmed/rejected
+            self.settled += len(delivery_tags)
+
+            highest = delivery_tags[-1]
+            lowest = self.acks_pending.lowest()
+            if len(delivery_tags) > 1 and (lowest is None or lowest > highest):
+                # all messages up to the highest one are settled, so multiple can be used
+                if self.batch_tag is not None:
+                    if self.batch_success == success:
+                        # it's covered by this one
+                        self.batch_tag = None
+                        self.batch_count = 0
+                    else:
+                        self._take_batch()
+                if success:
+                    self.acks_to_send.append(BasicAck(highest, True))
+                else:
+                    self.acks_to_send.append(BasicNack(highest, True, True))
+            else:
+                for delivery_tag in delivery_tags:
+                    if self.consumer.ack_batch_size > 1:
+                        self._coalesce(delivery_tag, success)
+                    else:
+                        self.acks_to_send.append(_settlement(delivery_tag, success))
+        self._send_acks()
+
+    def _send_acks(self):  # type: () -> None
+        """
+        Send the queued acks and rejects. Called with ack_lock released.
+
+        Whoever holds send_lock sends everything queued so far, so they go out in the order
+        they were queued in - a multiple one must not overtake a single one it covers.
+        """
+        if not self.acks_to_send:
+            return
+        with self.send_lock:
+            with self.ack_lock:
+                payloads, self.acks_to_send = self.acks_to_send, []
+            if payloads:
+                self.consumer.methods(payloads)
+
+    def _coalesce(self, delivery_tag, success):  # type: (int, bool) -> None
+        """Add a settled message to the batch. Called with ack_lock held"""
+        lowest = self.acks_pending.lowest()
+        if lowest is not None and lowest < delivery_tag:
+            # some earlier message is not settled yet, so multiple can't be used
+            self.acks_to_send.append(_settlement(delivery_tag, success))
+            return
 
-            if success:
-                self.consumer.method(BasicAck(delivery_tag, False))
+        if self.batch_tag is not None and self.batch_success != success:
+            self._take_batch()
+
+        if self.batch_tag is None:
+            self.batch_since = monotonic()
+        # a multiple one may cover messages settled out of order, that's fine
+        self.batch_tag = delivery_tag
+        self.batch_success = success
+        self.batch_count += 1
+
+        if self.batch_count >= self.consumer.ack_batch_size:
+            self._take_batch()
+
+    def _take_batch(self):  # type: () -> None
+        """Queue the coalesced acks or rejects for sending. Called with ack_lock held"""
+        if self.batch_tag is None:
+            return
+        if self.batch_count == 1:
+            self.acks_to_send.append(_settlement(self.batch_tag, self.batch_success))
+        elif self.batch_success:
+            self.acks_to_send.append(BasicAck(self.batch_tag, True))
+        else:
+            self.acks_to_send.append(BasicNack(self.batch_tag, True, True))
+        self.batch_tag = None
+        self.batch_count = 0
+
+    def flush_acks(self):  # type: () -> None
+        """Send coalesced acks or rejects at once"""
+        if self.state == 3:
+            return
+        with self.ack_lock:
+            self._take_batch()
+        self._send_acks()
+
+    def on_ack_timer(self):  # type: () -> None
+        """
+        Called by the listener thread every ack_batch_interval, or sooner if a batch is due then.
+
+        Timers are armed only by the listener thread, never by threads that ack messages - the
+        listener wouldn't notice a timer added while it waits for the socket.
+        """
+        if self.state == 3:
+            return
+        interval = self.consumer.ack_batch_interval
+        with self.ack_lock:
+            delay = interval
+            if self.batch_tag is not None:
+                remaining = self.batch_since + interval - monotonic()
+                if remaining > 0:
+                    delay = remaining
+                else:
+                    self._take_batch()
+        self._send_acks()
+        self.consumer.connection.watchdog(delay, self.on_ack_timer)
+
+    def _add_message(self, message):  # type: (ReceivedMessage) -> None
+        """Add a message to the batch for consumer.on_messages"""
+        consumer = self.consumer
+        if not self.messages:
+            self.messages_since = monotonic()
+            if consumer.batch_linger:
+                consumer.connection.watchdog(consumer.batch_linger, self.on_messages_timer)
             else:
-                self.consumer.method(BasicReject(delivery_tag, True))
+                consumer.connection.call_after_read(self.flush_messages)
 
-        return clbl
+        self.messages.append(message)
+        self.messages_size += self.message_size
+        if len(self.messages) >= consumer.batch_size or \
+                (consumer.batch_bytes is not None and self.messages_size >= consumer.batch_bytes):
+            self.flush_messages()
 
-    def on_head(self, frame):
+    def flush_messages(self):  # type: () -> None
+        """Pass the messages received so far to consumer.on_messages"""
+        if self.state == 3 or not self.messages:
+            return
+        messages, self.messages = self.messages, MessageBatch()
+        self.messages_size = 0
+        self.consumer.on_messages(messages)
+
+    def on_messages_timer(self):  # type: () -> None
+        """Called by the listener thread batch_linger after a batch was started"""
+        if self.state == 3 or not self.messages:
+            return
+        remaining = self.messages_since + self.consumer.batch_linger - monotonic()
+        if remaining > 0:
+            # this batch was started after the one this timer was for
+            self.consumer.connection.watchdog(remaining, self.on_messages_timer)
+        else:
+            self.flush_messages()
+
+    def on_prefetch_timer(self):  # type: () -> None
+        """Called by the listener thread every prefetch_controller.interval"""
+        if self.state == 3:
+            return
+        consumer = self.consumer
+        with self.ack_lock:
+            settled, self.settled = self.settled, 0
+            if self.delivered:
+                unacked = self.unacked_sum / self.delivered
+            else:
+                unacked = len(self.acks_pending)
+            self.delivered = self.unacked_sum = 0
+        qos = consumer.prefetch_controller.adjust(consumer.qos, settled, unacked)
+        if qos != consumer.qos:
+            consumer.set_qos(qos)
+        consumer.connection.watchdog(consumer.prefetch_controller.interval,
+                                     self.on_prefetch_timer)
+
+    def on_content_header(self, body_size, properties):
         assert self.state == 1
-        self.header = frame
-        self.message_size = self.data_to_go = frame.body_size
+        self.properties = properties
+        self.message_size = self.data_to_go = body_size
         self.state = 2
 
-        if not self.header.body_size:
+        if not body_size:
             # An empty message is no common guest. It won't have a BODY field
             #  though...
             self.on_body(EMPTY_MEMORYVIEW)  # trigger it manually
 
-    def on_basic_deliver(self, payload):
+    def on_head(self, frame):  # type: (AMQPHeaderFrame) -> None
+        self.on_content_header(frame.body_size, frame.properties)
+
+    def on_deliver(self, delivery_tag, exchange, routing_key):
         assert not self.state
-        self.bdeliver = payload
+        self.delivery_tag = delivery_tag
+        self.exchange = exchange
+        self.routing_key = routing_key
         self.state = 1
 
+    def on_basic_deliver(self, payload):  # type: (BasicDeliver) -> None
+        self.on_deliver(payload.delivery_tag, payload.exchange, payload.routing_key)
+
     def on_body(self, payload):
         """:type payload: buffer"""
         assert self.state == 2
@@ -606,9 +898,10 @@ class MessageReceiver(object):
             # Message A-OK!
 
             if ack_expected:
-                self.acks_pending.add(self.bdeliver.delivery_tag)
-
-            from coolamqp.objects import ReceivedMessage
+                with self.ack_lock:
+                    self.acks_pending.add(self.delivery_tag)
+                    self.unacked_sum += len(self.acks_pending)
+                    self.delivered += 1
 
             # Does body need preprocessing?
             body = self.body
@@ -627,19 +920,13 @@ class MessageReceiver(object):
                     body = bio.getvalue()
             # if MEMORYVIEW, then it's already ok
 
-            rm = ReceivedMessage(
-                body,
-                self.bdeliver.exchange,
-                self.bdeliver.routing_key,
-                self.header.properties,
-                self.bdeliver.delivery_tag,
-                None if self.consumer.no_ack else self.confirm(
-                    self.bdeliver.delivery_tag, True),
-                None if self.consumer.no_ack else self.confirm(
-                    self.bdeliver.delivery_tag, False),
-            )
-
-            self.consumer.on_message(rm)
+            message = self.consumer.message_class(
+                body, self.exchange, self.routing_key, self.properties,
+                self.delivery_tag, None, None, self)
+            if self.consumer.on_messages is None:
+                self.consumer.on_message(message)
+            else:
+                self._add_message(message)
 
             self.state = 0
 
@@ -0,0 +1,142 @@
+# coding=UTF-8
+from __future__ import absolute_import, division, print_function
+
+import io
+import logging
+import mmap
+import tempfile
+import typing as tp
+
+from coolamqp.framing.body_stream import AMQPBodyStream, BuffersWithStreams
+
+logger = logging.getLogger(__name__)
+
+
+class _Spill(object):
+    """Frames written to a temporary file"""
+    __slots__ = ('file', 'length')
+
+    def __init__(self, directory=None):
+        self.file = tempfile.TemporaryFile(dir=directory)
+        self.length = 0
+
+    def write(self, data):  # type: (bytes) -> None
+        self.file.write(data)
+        self.length += len(data)
+
+    def map(self):  # type: () -> memoryview
+        """Return contents of this file, memory-mapped. The file is closed."""
+        self.file.flush()
+        try:
+            mapped = mmap.mmap(self.file.fileno(), self.length, access=mmap.ACCESS_READ)
+        finally:
+            self.file.close()
+        return memoryview(mapped)
+
+
+class FrameBuffer(object):
+    """
+    Frames that a publisher holds back while the connection is blocked, or the channel
+    is flow-controlled.
+
+    Frames are kept serialized. Once they take more than memory_limit bytes, further frames
+    are spilled to a temporary file, to be memory-mapped and sent from it when they are
+    taken. If they take more than size_limit bytes in total, the buffer is full, and
+    publishers will refuse to publish.
+
+    Not thread safe, publishers access it with their lock held.
+
+    :param memory_limit: bytes to keep in memory, None to never spill to disk
+    :param size_limit: bytes after which the buffer is full, None for no limit
+    :param directory: directory to create the temporary files in, None for the default one
+    """
+    __slots__ = ('memory_limit', 'size_limit', 'directory', 'entries', 'memory', 'size',
+                 'spill', 'arena')
+
+    def __init__(self, memory_limit=None, size_limit=None, directory=None):
+        self.memory_limit = memory_limit  # type: tp.Optional[int]
+        self.size_limit = size_limit  # type: tp.Optional[int]
+        self.directory = directory  # type: tp.Optional[str]
+        self.entries = []  # bytes, AMQPBodyStreams and _Spills, in order
+        self.memory = 0  # bytes held in memory
+        self.size = 0  # bytes held in total
+        self.spill = None  # type: tp.Optional[_Spill]
+        self.arena = io.BytesIO()
+
+    def __len__(self):  # type: () -> int
+        """Return the amount of entries, which is zero only if there's nothing buffered"""
+        return len(self.entries)
+
+    def is_full(self):  # type: () -> bool
+        return self.size_limit is not None and self.size >= self.size_limit
+
+    def extend(self, frames):
+        """
+        Buffer some frames.
+
+        :param frames: iterable of frames
+        """
+        arena = self.arena
+        for frame in frames:
+            if isinstance(frame, AMQPBodyStream):
+                # these are never serialized, they'll be produced as they're sent
+                self._take_arena()
+                self.spill = None
+                self.entries.append(frame)
+            else:
+                frame.write_to(arena)
+        self._take_arena()
+
+    def _take_arena(self):  # type: () -> None
+        arena = self.arena
+        if not arena.tell():
+            return
+        data = arena.getvalue()
+        arena.seek(0)
+        arena.truncate()
+
+        self.size += len(data)
+        if self.spill is None and (self.memory_limit is None or
+                                   self.memory + len(data) <= self.memory_limit):
+            self.entries.append(data)
+            self.memory += len(data)
+            return
+
+        if self.spill is None:
+            logger.debug('Frame buffer exceeds %s bytes, spilling to disk', self.memory_limit)
+            self.spill = _Spill(self.directory)
+            self.entries.append(self.spill)
+        self.spill.write(data)
+
+    def take(self):  # type: () -> list
+        """
+        Return everything that's buffered as a list of buffers to send (a BuffersWithStreams,
+        if there are AMQPBodyStreams among them) and clear this buffer.
+        """
+        buffers = []
+        for entry in self.entries:
+            if isinstance(entry, _Spill):
+                buffers.append(entry.map())
+            elif isinstance(entry, AMQPBodyStream):
+                if not isinstance(buffers, BuffersWithStreams):
+                    buffers = BuffersWithStreams(buffers)
+                buffers.append(entry)
+                buffers.streams += 1
+            else:
+                buffers.append(entry)
+
+        self.entries = []
+        self.memory = 0
+        self.size = 0
+        self.spill = None
+        return buffers
+
+    def clear(self):  # type: () -> None
+        """Drop everything that's buffered"""
+        for entry in self.entries:
+            if isinstance(entry, _Spill):
+                entry.file.close()
+        self.entries = []
+        self.memory = 0
+        self.size = 0
+        self.spill = None
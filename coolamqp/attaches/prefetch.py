@@ -0,0 +1,152 @@
+# coding=UTF-8
+from __future__ import absolute_import, division, print_function
+
+import logging
+import math
+
+from coolamqp.utils import monotonic
+
+logger = logging.getLogger(__name__)
+
+BASE_LATENCY_PERIOD = 30.0  # seconds after which the lowest latency seen is learned anew
+PROBE_EVERY = 10  # intervals between probes for a higher rate
+
+
+class PrefetchStats(object):
+    """
+    What a PrefetchController has seen during an interval, and what it decided.
+
+    :ivar qos: prefetch count during the interval
+    :ivar new_qos: prefetch count decided upon. Equal to qos if it was not changed.
+    :ivar rate: messages acked or rejected per second
+    :ivar unacked: average amount of messages delivered, but not acked or rejected
+    :ivar latency: average seconds from delivery to ack, or None if nothing was acked
+    :ivar base_latency: lowest latency seen recently, or None if nothing was acked yet
+    """
+    __slots__ = ('qos', 'new_qos', 'rate', 'unacked', 'latency', 'base_latency')
+
+    def __init__(self, qos, new_qos, rate, unacked, latency, base_latency):
+        self.qos = qos
+        self.new_qos = new_qos
+        self.rate = rate
+        self.unacked = unacked
+        self.latency = latency
+        self.base_latency = base_latency
+
+    def __repr__(self):
+        return u'PrefetchStats(qos=%s, new_qos=%s, rate=%.1f, unacked=%s, latency=%s, ' \
+               u'base_latency=%s)' % (self.qos, self.new_qos, self.rate, self.unacked,
+                                      self.latency, self.base_latency)
+
+
+class PrefetchController(object):
+    """
+    Adjusts the prefetch count (QoS) of a Consumer to what it's able to process.
+
+    Pass it to a Consumer (that acks it's messages) as prefetch_controller. Every interval
+    seconds it measures the rate of messages being acked, and the average amount of unacked
+    ones. Average latency from delivery to ack follows from them, by Little's law
+    (unacked = rate * latency). Then:
+
+        - if nearly all of the prefetch count is in use, or every PROBE_EVERY intervals, it
+          probes for a higher rate, growing the prefetch count by a half. It keeps growing it
+          as long as the rate grows by at least 5% in response, and goes back to the last value
+          that helped when it doesn't. This finds the prefetch count that covers the round trip
+          to the broker, even though messages in flight can't be seen.
+        - if latency exceeds twice the lowest latency seen (and it's not because of a probe),
+          messages are waiting to be processed, so the prefetch count is cut to what's needed
+          to keep up the current rate at the lowest latency, with some headroom
+
+    The prefetch count stays between min_qos and max_qos. A controller may be used by a
+    single consumer only.
+
+    :param min_qos: lowest prefetch count to use
+    :param max_qos: highest prefetch count to use
+    :param interval: seconds between adjustments
+    :param on_stats: callable(PrefetchStats) to call after every interval, eg. to graph them.
+        Called by the listener thread, so it must not block.
+    """
+    __slots__ = ('min_qos', 'max_qos', 'interval', 'on_stats', 'last_tick', 'base_latency',
+                 'base_latency_since', 'probe_from', 'probe_rate', 'since_probe')
+
+    def __init__(self, min_qos=10,  # type: int
+                 max_qos=10000,  # type: int
+                 interval=1.0,  # type: float
+                 on_stats=None  # type: tp.Optional[tp.Callable[[PrefetchStats], None]]
+                 ):
+        if not 0 < min_qos <= max_qos:
+            raise ValueError(u'Needs 0 < min_qos <= max_qos')
+        self.min_qos = min_qos
+        self.max_qos = max_qos
+        self.interval = interval
+        self.on_stats = on_stats
+
+        self.last_tick = None  # type: tp.Optional[float]
+        self.base_latency = None  # type: tp.Optional[float]
+        self.base_latency_since = 0.0
+        self.probe_from = None  # prefetch count before the current probe, or None if not probing
+        self.probe_rate = 0.0  # rate at probe_from
+        self.since_probe = 0  # intervals since the last probe
+
+    def initial_qos(self, qos):  # type: (int) -> int
+        """
+        Return the prefetch count a consumer should start with.
+
+        :param qos: prefetch count given to the consumer, 0 if none
+        """
+        return min(max(qos, self.min_qos), self.max_qos)
+
+    def adjust(self, qos, settled, unacked):  # type: (int, int, float) -> int
+        """
+        Called every interval by the listener thread.
+
+        :param qos: current prefetch count
+        :param settled: amount of messages acked or rejected since the last call
+        :param unacked: average amount of messages delivered, but not acked or rejected yet
+        :return: prefetch count to use
+        """
+        now = monotonic()
+        elapsed = now - self.last_tick if self.last_tick is not None else self.interval
+        self.last_tick = now
+
+        rate = settled / elapsed if elapsed > 0 else 0.0
+        new_qos = qos
+        latency = None
+        if rate:
+            latency = unacked / rate
+
+            # nothing unacked means nothing was delivered, and latency is unknown
+            if unacked and (self.base_latency is None or latency < self.base_latency or
+                            now - self.base_latency_since > BASE_LATENCY_PERIOD):
+                self.base_latency = latency
+                self.base_latency_since = now
+
+            self.since_probe += 1
+            if self.base_latency is None:
+                pass
+            elif self.probe_from is not None:
+                if rate >= self.probe_rate * 1.05:
+                    self.probe_from, self.probe_rate = qos, rate
+                    new_qos = int(math.ceil(qos * 1.5))
+                else:
+                    new_qos = self.probe_from
+                    self.probe_from = None
+            elif latency > 2 * self.base_latency and unacked >= self.min_qos:
+                new_qos = min(qos, int(math.ceil(rate * self.base_latency * 2)))
+                self.since_probe = 0
+            elif unacked >= qos * 0.9 or self.since_probe >= PROBE_EVERY:
+                self.probe_from, self.probe_rate = qos, rate
+                self.since_probe = 0
+                new_qos = int(math.ceil(qos * 1.5))
+
+            new_qos = min(max(new_qos, self.min_qos), self.max_qos)
+            if new_qos == qos:
+                self.probe_from = None
+
+            if new_qos != qos:
+                logger.debug('%.1f messages/s, %.1f unacked, latency %.3f s, prefetch count '
+                             'changed to %s', rate, unacked, latency, new_qos)
+
+        if self.on_stats is not None:
+            self.on_stats(PrefetchStats(qos, new_qos, rate, unacked, latency, self.base_latency))
+        return new_qos
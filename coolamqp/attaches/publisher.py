@@ -11,15 +11,19 @@ to check with the broker beforehand.
 from __future__ import absolute_import, division, print_function
 
 import collections
+import io
 import logging
+import struct
+import typing as tp
 import warnings
 
 import six
 
 from coolamqp.framing.definitions import ChannelOpenOk, BasicPublish, Basic, \
-    BasicAck
+    BasicAck, FRAME_HEADER, FRAME_BODY, FRAME_END_BYTE
 from coolamqp.framing.frames import AMQPMethodFrame, AMQPBodyFrame, \
-    AMQPHeaderFrame
+    AMQPHeaderFrame, STRUCT_BHL, STRUCT_HH
+from coolamqp.uplink.connection.send_framer import COPY_THRESHOLD
 
 try:
     # these extensions will be available
@@ -31,14 +35,20 @@ except ImportError:
 from coolamqp.attaches.channeler import Channeler, ST_ONLINE, ST_OFFLINE
 from coolamqp.uplink import PUBLISHER_CONFIRMS, MethodWatch, FailWatch
 from coolamqp.attaches.utils import AtomicTagger, FutureConfirmableRejectable, \
-    Synchronized
+    AggregateConfirmableRejectable, CallbackConfirmableRejectable, Synchronized
+from coolamqp.attaches.frame_buffer import FrameBuffer
+from coolamqp.exceptions import BufferFull
 
 from concurrent.futures import Future
-from coolamqp.objects import Exchange
+from coolamqp.framing.body_stream import AMQPBodyStream
+from coolamqp.objects import Message, StreamedBody, exchange_and_routing_key
 
 logger = logging.getLogger(__name__)
 
+STRUCT_Q = struct.Struct('!Q')
+
 # for holding messages when MODE_CNPUB and link is down
+# future is either a Future, or a ConfirmableRejectable to deposit as-is
 CnpubMessageSendOrder = collections.namedtuple('CnpubMessageSendOrder',
                                                ('message', 'exchange_name',
                                                 'routing_key', 'future',
@@ -71,6 +81,14 @@ class Publisher(Channeler, Synchronized):
          MODE_NOACK - use non-ack mode
          MODE_CNPUB - use consumer publishing mode. A switch to MODE_TXPUB will be made
                       if broker does not support these.
+    :param window: an InFlightWindow, to limit messages awaiting confirmation in MODE_CNPUB
+    :param frame_buffer: a FrameBuffer to hold frames in while the connection is blocked or
+        content flow is stopped. By default an unbounded one, kept in memory.
+    :param reconnect_buffer_messages: in MODE_NOACK, keep at most this many messages published
+        while there's no connection, and send them once it's back, instead of dropping them.
+        If more are published, the oldest ones are dropped. 0 to drop them all.
+    :param reconnect_buffer_bytes: maximum total length of bodies of these messages, or None
+        for no limit
     :raise ValueError: mode invalid
     """
     MODE_NOACK = 0  # no-ack publishing
@@ -81,7 +99,8 @@ class Publisher(Channeler, Synchronized):
     class UnusablePublisher(Exception):
         """This publisher will never work (eg. MODE_CNPUB on a broker not supporting publisher confirms)"""
 
-    def __init__(self, mode, cluster=None):
+    def __init__(self, mode, cluster=None, window=None, frame_buffer=None,
+                 reconnect_buffer_messages=0, reconnect_buffer_bytes=None):
         Channeler.__init__(self)
         Synchronized.__init__(self)
 
@@ -95,18 +114,33 @@ class Publisher(Channeler, Synchronized):
         #           Future to confirm or None, flags as tuple|empty tuple
 
         self.tagger = None  # None, or AtomicTagger instance id MODE_CNPUB
+        self.window = window if mode == Publisher.MODE_CNPUB else None  # InFlightWindow or None
         self.set_connected = False
         self.cluster = cluster
         self.critically_failed = False
         self.content_flow = True
         self.blocked = False
-        self.frames_to_send = []
+        self.frames_to_send = frame_buffer or FrameBuffer()  # type: FrameBuffer
+        # MODE_NOACK messages published while offline, as (message, exchange, routing key)
+        self.reconnect_buffer = collections.deque()
+        self.reconnect_buffer_size = 0  # total length of their bodies
+        self.reconnect_buffer_messages = reconnect_buffer_messages  # type: int
+        self.reconnect_buffer_bytes = reconnect_buffer_bytes  # type: tp.Optional[int]
 
     @Synchronized.synchronized
     def attach(self, connection):
         Channeler.attach(self, connection)
         connection.watch(FailWatch(self.on_fail))
 
+    @property
+    def buffered_bytes(self):  # type: () -> int
+        """Amount of bytes held back because the connection is blocked or flow is stopped"""
+        return self.frames_to_send.size
+
+    # These are synchronized, so that no frames sent right after unblocking overtake
+    # the ones that were held back
+
+    @Synchronized.synchronized
     def on_connection_blocked(self, payload):
         if isinstance(payload, ConnectionBlocked):
             self.blocked = True
@@ -114,24 +148,69 @@ class Publisher(Channeler, Synchronized):
             self.blocked = False
 
             if self.content_flow:
-                self.connection.send(self.frames_to_send)
-                self.frames_to_send = []
+                self._send_buffered()
 
+    @Synchronized.synchronized
     def on_flow_control(self, payload):
         """Called on ChannelFlow"""
-        assert isinstance(ChannelFlow, payload)
+        assert isinstance(payload, ChannelFlow)
 
         self.content_flow = payload.active
         self.connection.send([AMQPMethodFrame(self.channel_id,
                                               ChannelFlowOk(payload.active))])
 
         if payload.active and not self.blocked:
-            self.connection.send(self.frames_to_send)
-            self.frames_to_send = []
+            self._send_buffered()
+
+    def _send_buffered(self):
+        """Send frames that were held back, in order"""
+        if self.frames_to_send:
+            logger.debug(u'Sending %s bytes held back', self.frames_to_send.size)
+            self.connection.send_serialized(self.frames_to_send.take())
+
+    def _hold_for_reconnect(self, message, exchange, routing_key):
+        """Keep a MODE_NOACK message published while offline, or drop it"""
+        if not self.reconnect_buffer_messages:
+            logger.debug(u'Publish request, but not connected - dropping the message')
+            return
+
+        self.reconnect_buffer.append((message, exchange, routing_key))
+        self.reconnect_buffer_size += len(message.body)
+        while len(self.reconnect_buffer) > self.reconnect_buffer_messages or \
+                (self.reconnect_buffer_bytes is not None and
+                 self.reconnect_buffer_size > self.reconnect_buffer_bytes):
+            dropped, _, _ = self.reconnect_buffer.popleft()
+            self.reconnect_buffer_size -= len(dropped.body)
+            logger.debug(u'Reconnect buffer is full - dropping the oldest message')
+
+    def _send_reconnect_buffer(self):
+        """Send MODE_NOACK messages published while offline, as a single batch"""
+        if self.reconnect_buffer:
+            logger.debug(u'Sending %s messages published while offline',
+                         len(self.reconnect_buffer))
+            batch = list(self.reconnect_buffer)
+            self.reconnect_buffer.clear()
+            self.reconnect_buffer_size = 0
+            self._pub_many(batch)
+
+    def _check_buffer(self):
+        """:raise BufferFull: too much is held back already"""
+        if self.frames_to_send.is_full():
+            raise BufferFull(u'%s bytes held back' % (self.frames_to_send.size, ))
 
     @Synchronized.synchronized
     def on_fail(self):
         self.state = ST_OFFLINE
+        # a new channel starts unblocked, and frames held back were meant for this one
+        self.blocked = False
+        self.content_flow = True
+        if self.frames_to_send:
+            logger.debug(u'Dropping %s bytes held back on a failed channel',
+                         self.frames_to_send.size)
+            self.frames_to_send.clear()
+        if self.tagger is not None:
+            # these will never be confirmed
+            self.tagger.detach_window()
 
     def _pub(self, message, exchange_name, routing_key, parent_span=None, span_enqueued=None,
              dont_close_span=False):
@@ -153,14 +232,64 @@ class Publisher(Channeler, Synchronized):
             span = self.cluster.tracer.start_span('Sending',
                                                   child_of=parent_span,
                                                   references=opentracing.follows_from(span_enqueued))
-        # Break down large bodies
-        bodies = []
+        frames_to_send, further_bodies = self._get_frames(message, exchange_name, routing_key)
+        self._send_frames(frames_to_send, further_bodies)
+
+        if span is not None:
+            span.finish()
+
+        if parent_span is not None and not dont_close_span:
+            parent_span.finish()
+
+    def _send_frames(self, frames_to_send, further_bodies):
+        """
+        Send frames of a message, or hold them back if content flow is stopped or the
+        connection is blocked.
 
-        body = memoryview(message.body)
+        :param frames_to_send: frames to send at once
+        :param further_bodies: list of further body frames
+        """
+        if self.content_flow and not self.blocked:
+            self.connection.send(frames_to_send)
+
+            if further_bodies:
+                while self.content_flow and not self.blocked and len(further_bodies) > 0:
+                    self.connection.send([further_bodies[0]])
+                    del further_bodies[0]
+
+                if further_bodies:
+                    self.frames_to_send.extend(further_bodies)
+        else:
+            self.frames_to_send.extend(frames_to_send)
+            self.frames_to_send.extend(further_bodies)
+
+    def _get_body_frames(self, body):
+        """
+        Break down a body into frames, so that each fits in frame_max.
+
+        :return: list of AMQPBodyFrame, or of a single AMQPBodyStream for a StreamedBody
+        """
         max_body_size = self.connection.frame_max - AMQPBodyFrame.FRAME_SIZE_WITHOUT_PAYLOAD - 16
+        if isinstance(body, StreamedBody):
+            return [AMQPBodyStream(self.channel_id, body, max_body_size)] if len(body) else []
+
+        bodies = []
+
+        body = memoryview(body)
         while len(body) > 0:
-            bodies.append(body[:max_body_size])
+            bodies.append(AMQPBodyFrame(self.channel_id, body[:max_body_size]))
             body = body[max_body_size:]
+        return bodies
+
+    def _get_frames(self, message, exchange_name, routing_key):
+        """
+        Return frames needed to publish a message.
+
+        :return: a tuple of (frames to send at once, list of further body frames). The
+            second list is non-empty only if the body had to be broken down into
+            many frames.
+        """
+        bodies = self._get_body_frames(message.body)
 
         frames_to_send = [AMQPMethodFrame(self.channel_id,
                                           BasicPublish(exchange_name, routing_key, False, False)),
@@ -168,30 +297,52 @@ class Publisher(Channeler, Synchronized):
                                           message.properties)]
 
         if len(bodies) == 1:
-            frames_to_send.append(AMQPBodyFrame(self.channel_id, bodies[0]))
+            frames_to_send.append(bodies.pop())
 
-        if self.content_flow and not self.blocked:
-            self.connection.send(frames_to_send)
+        return frames_to_send, bodies
 
-            if len(bodies) > 1:
-                while self.content_flow and not self.blocked and len(bodies) > 0:
-                    self.connection.send([AMQPBodyFrame(self.channel_id, bodies[0])])
-                    del bodies[0]
+    def _pub_prepared(self, prepared, body):
+        """
+        Just send a message from a PreparedPublish.
+
+        BECAUSE OF publish_prepared THIS CAN GET CALLED BY FOREIGN THREAD.
 
-                if not self.content_flow and not self.blocked and len(bodies) > 0:
-                    for body in bodies:
-                        self.frames_to_send.append(AMQPBodyFrame(self.channel_id, body))
+        :param prepared: PreparedPublish instance
+        :param body: body of the message
+        """
+        if self.connection.log_frames is not None:
+            # frame loggers need real frames
+            return self._pub(Message(body, prepared.properties), prepared.exchange,
+                             prepared.routing_key)
+
+        if 0 < len(body) < COPY_THRESHOLD and not isinstance(body, StreamedBody) and \
+                len(body) + AMQPBodyFrame.FRAME_SIZE_WITHOUT_PAYLOAD + 16 <= self.connection.frame_max:
+            self._send_frames([prepared.get_frames(self.channel_id, len(body), body)], [])
         else:
-            self.frames_to_send.extend(frames_to_send)
-            if len(bodies) > 1:
-                for body in bodies:
-                    self.frames_to_send.append(AMQPBodyFrame(self.channel_id, body))
+            bodies = self._get_body_frames(body)
+            frames_to_send = [prepared.get_frames(self.channel_id, len(body))]
+            if len(bodies) == 1:
+                frames_to_send.append(bodies.pop())
+            self._send_frames(frames_to_send, bodies)
 
-        if span is not None:
-            span.finish()
+    def _pub_many(self, messages):
+        """
+        Send many messages, as a single batch.
 
-        if parent_span is not None and not dont_close_span:
-            parent_span.finish()
+        BECAUSE OF publish_many THIS CAN GET CALLED BY FOREIGN THREAD.
+
+        :param messages: list of (Message instance, exchange name::bytes, routing key::bytes)
+        """
+        frames_to_send = []
+        for message, exchange_name, routing_key in messages:
+            frames, further_bodies = self._get_frames(message, exchange_name, routing_key)
+            frames_to_send.extend(frames)
+            frames_to_send.extend(further_bodies)
+
+        if self.content_flow and not self.blocked:
+            self.connection.send(frames_to_send)
+        else:
+            self.frames_to_send.extend(frames_to_send)
 
     def _mode_cnpub_process_deliveries(self):
         """
@@ -203,6 +354,7 @@ class Publisher(Channeler, Synchronized):
         assert self.mode == Publisher.MODE_CNPUB
         assert self.tagger is not None
 
+        batch = []
         while len(self.messages) > 0:
             try:
                 msg, xchg, rk, fut, parent_span, span_enqueued = self.messages.popleft()
@@ -210,19 +362,32 @@ class Publisher(Channeler, Synchronized):
                 # todo see docs/casefile-0001
                 break
 
-            if not fut.set_running_or_notify_cancel():
+            if not isinstance(fut, Future):
+                confirmable = fut  # it can't be cancelled
+            elif not fut.set_running_or_notify_cancel():
+                if self.window is not None:
+                    self.window.release(1, len(msg.body))
                 if span_enqueued is not None:
                     from opentracing import logs
                     span_enqueued.log_kv({logs.EVENT: 'Cancelled'})
                     span_enqueued.finish()
                     parent_span.finish()
                 continue  # cancelled
+            else:
+                confirmable = FutureConfirmableRejectable(fut)
 
-            self.tagger.deposit(self.tagger.get_key(),
-                                FutureConfirmableRejectable(fut),
-                                parent_span)
+            self.tagger.deposit(self.tagger.get_key(), confirmable, parent_span, len(msg.body))
             assert isinstance(xchg, (six.binary_type, six.text_type))
-            self._pub(msg, xchg, rk, parent_span, span_enqueued, dont_close_span=True)
+            if parent_span is None:
+                batch.append((msg, xchg, rk))
+            else:
+                if batch:
+                    self._pub_many(batch)
+                    batch = []
+                self._pub(msg, xchg, rk, parent_span, span_enqueued, dont_close_span=True)
+
+        if batch:
+            self._pub_many(batch)
 
     def _on_cnpub_delivery(self, payload):  # type: (AMQPMethodPayload) -> None
         """
@@ -235,8 +400,7 @@ class Publisher(Channeler, Synchronized):
         elif isinstance(payload, BasicNack):
             self.tagger.nack(payload.delivery_tag, payload.multiple)
 
-    @Synchronized.synchronized
-    def publish(self, message, exchange=b'', routing_key=b'', span=None):
+    def publish(self, message, exchange=b'', routing_key=b'', span=None, on_confirmed=None):
         """
         Schedule to have a message published.
 
@@ -247,49 +411,228 @@ class Publisher(Channeler, Synchronized):
 
             Returned Future can be cancelled - this will prevent from sending the message, if it hasn't commenced yet.
 
+            If on_confirmed is given, no Future is created and None is returned. Instead,
+            on_confirmed(message, True) will be called when broker ACKs the message, or
+            on_confirmed(message, False) when it NACKs it. This is much cheaper. It will be called
+            from the listener thread, so it must not block. The message cannot be cancelled.
+
         If mode is MODE_NOACK:
-            this function returns None. Messages are dropped on the floor if there's no connection.
+            this function returns None. Messages are dropped on the floor if there's no connection,
+            unless there's room for them in the reconnect buffer.
 
         :param message: Message object to send
         :param exchange: exchange name to use. Default direct exchange by default. Can also be an Exchange object.
         :type exchange: bytes, str or Exchange instance
         :param routing_key: routing key to use
         :param span: optional span, if opentracing is installed
+        :param on_confirmed: optional callable(Message, bool), to be used instead of a Future in MODE_CNPUB
         :return: a Future instance, or None
         :raise Publisher.UnusablePublisher: this publisher will never work (eg. MODE_CNPUB on Non-RabbitMQ)
+        :raise WindowFull: this publisher has a window, and there was no room in it in time
+        :raise BufferFull: the connection is blocked, and the frame buffer is full
         """
+        self._check_buffer()
+        if self.window is None:
+            return self._publish(message, exchange, routing_key, span, on_confirmed)
+
+        self.window.acquire(1, len(message.body))
+        try:
+            return self._publish(message, exchange, routing_key, span, on_confirmed)
+        except BaseException:
+            self.window.release(1, len(message.body))
+            raise
+
+    @Synchronized.synchronized
+    def _publish(self, message, exchange, routing_key, span, on_confirmed):
         if span is not None:
             span_enqueued = self.cluster.tracer.start_span('Enqueued', child_of=span)
         else:
             span_enqueued = None
 
-        if isinstance(exchange, Exchange):
-            exchange = exchange.name.encode('utf8')
-        elif isinstance(exchange, six.text_type):
-            exchange = exchange.encode('utf8')
-
-        assert isinstance(exchange, six.binary_type)
+        exchange, routing_key = exchange_and_routing_key(exchange, routing_key)
 
         # Formulate the request
         if self.mode == Publisher.MODE_NOACK:
-            # If we are not connected right now, drop the message on the floor and log it with DEBUG
+            # If we are not connected right now, hold it until we are, or drop it on the floor
             if self.state != ST_ONLINE:
-                logger.debug(
-                    u'Publish request, but not connected - dropping the message')
+                self._hold_for_reconnect(message, exchange, routing_key)
             else:
                 self._pub(message, exchange, routing_key, span, span_enqueued)
 
         elif self.mode == Publisher.MODE_CNPUB:
-            fut = Future()
+            if on_confirmed is None:
+                fut = result = Future()
+            else:
+                fut = CallbackConfirmableRejectable(on_confirmed, message)
+                result = None
+
+            if self.state == ST_ONLINE and not self.messages:
+                # nothing is waiting before this message, so send it right away
+                if result is not None:
+                    fut.set_running_or_notify_cancel()
+                    fut = FutureConfirmableRejectable(fut)
+                self.tagger.deposit(self.tagger.get_key(), fut, span, len(message.body))
+                self._pub(message, exchange, routing_key, span, span_enqueued,
+                          dont_close_span=True)
+            else:
+                self.messages.append(CnpubMessageSendOrder(message, exchange, routing_key, fut,
+                                                           span, span_enqueued))
 
-            # todo can optimize this not to create an object if ST_ONLINE already
-            cnpo = CnpubMessageSendOrder(message, exchange, routing_key, fut, span, span_enqueued)
-            self.messages.append(cnpo)
+                if self.state == ST_ONLINE:
+                    self._mode_cnpub_process_deliveries()
+
+            return result
+        else:
+            raise Exception(u'Invalid mode')
+
+    def publish_many(self, messages, aggregate=False, on_confirmed=None):
+        """
+        Schedule to have many messages published, as a single batch.
+
+        All of them are framed at once and handed over to the socket as a single piece of
+        data, so this is much faster than calling publish() for each of them.
+
+        If mode is MODE_CNPUB:
+            if aggregate is False, this returns a list of Futures, one for each message, that
+            behave like the ones returned by publish().
+
+            If aggregate is True, this returns a single Future, that will complete once all of
+            the messages are confirmed by the broker, or fail once any of them is NACKed.
+            It cannot be cancelled.
+
+            If on_confirmed is given, None is returned, and on_confirmed is called instead. If
+            aggregate is False, it's called like the one passed to publish(), for every message.
+            If aggregate is True, it's called once, with a list of the messages and a bool
+            telling whether all of them were confirmed.
+
+        If mode is MODE_NOACK:
+            this function returns None. Messages are dropped on the floor if there's no connection,
+            unless there's room for them in the reconnect buffer.
+
+        :param messages: iterable of (Message object, exchange, routing key). Exchange can be
+            bytes, str or an Exchange instance, routing key can be bytes or str.
+        :param aggregate: whether to return a single Future for all messages, if mode is MODE_CNPUB
+        :param on_confirmed: optional callable(message or list of messages, bool), to be used
+            instead of Futures in MODE_CNPUB
+        :return: a list of Futures, a Future, or None
+        :raise WindowFull: this publisher has a window, and there was no room in it in time
+        :raise BufferFull: the connection is blocked, and the frame buffer is full
+        """
+        self._check_buffer()
+        batch = [(message, ) + exchange_and_routing_key(exchange, routing_key)
+                 for message, exchange, routing_key in messages]
+
+        if self.window is None:
+            return self._publish_many(batch, aggregate, on_confirmed)
+
+        size = sum(len(message.body) for message, _, _ in batch)
+        self.window.acquire(len(batch), size)
+        try:
+            return self._publish_many(batch, aggregate, on_confirmed)
+        except BaseException:
+            self.window.release(len(batch), size)
+            raise
+
+    @Synchronized.synchronized
+    def _publish_many(self, batch, aggregate, on_confirmed):
+        if self.mode == Publisher.MODE_NOACK:
+            if self.state != ST_ONLINE:
+                for message, exchange, routing_key in batch:
+                    self._hold_for_reconnect(message, exchange, routing_key)
+            else:
+                self._pub_many(batch)
+
+        elif self.mode == Publisher.MODE_CNPUB:
+            if on_confirmed is not None:
+                result = None
+                if aggregate:
+                    messages = [message for message, _, _ in batch]
+                    confirmable = AggregateConfirmableRejectable(
+                        len(batch), lambda confirmed: on_confirmed(messages, confirmed))
+                    futures = [confirmable] * len(batch)
+                else:
+                    futures = [CallbackConfirmableRejectable(on_confirmed, message)
+                               for message, _, _ in batch]
+            elif aggregate:
+                result = Future()
+                result.set_running_or_notify_cancel()
+                confirmable = AggregateConfirmableRejectable.for_future(result, len(batch))
+                futures = [confirmable] * len(batch)
+            else:
+                result = futures = [Future() for _ in batch]
+
+            for (message, exchange, routing_key), fut in zip(batch, futures):
+                self.messages.append(CnpubMessageSendOrder(message, exchange, routing_key, fut,
+                                                           None, None))
+
+            if self.state == ST_ONLINE:
+                self._mode_cnpub_process_deliveries()
+
+            return result
+        else:
+            raise Exception(u'Invalid mode')
+
+    def publish_prepared(self, prepared, body, on_confirmed=None):
+        """
+        Schedule to have a message published from a PreparedPublish.
+
+        Works like publish(). You'd rather call PreparedPublish.send().
+
+        :param prepared: PreparedPublish instance
+        :param body: body of the message
+        :param on_confirmed: optional callable(Message, bool), to be used instead of a Future in MODE_CNPUB
+        :return: a Future instance, or None
+        :raise WindowFull: this publisher has a window, and there was no room in it in time
+        :raise BufferFull: the connection is blocked, and the frame buffer is full
+        """
+        self._check_buffer()
+        if self.window is None:
+            return self._publish_prepared(prepared, body, on_confirmed)
+
+        self.window.acquire(1, len(body))
+        try:
+            return self._publish_prepared(prepared, body, on_confirmed)
+        except BaseException:
+            self.window.release(1, len(body))
+            raise
+
+    @Synchronized.synchronized
+    def _publish_prepared(self, prepared, body, on_confirmed):
+        if self.mode == Publisher.MODE_NOACK:
+            if self.state != ST_ONLINE:
+                self._hold_for_reconnect(Message(body, prepared.properties), prepared.exchange,
+                                         prepared.routing_key)
+            else:
+                self._pub_prepared(prepared, body)
+
+        elif self.mode == Publisher.MODE_CNPUB:
+            if self.state == ST_ONLINE and not self.messages:
+                # the fast path - nothing is waiting before this message
+                if on_confirmed is None:
+                    result = Future()
+                    result.set_running_or_notify_cancel()
+                    confirmable = FutureConfirmableRejectable(result)
+                else:
+                    result = None
+                    confirmable = CallbackConfirmableRejectable(on_confirmed,
+                                                                Message(body, prepared.properties))
+                self.tagger.deposit(self.tagger.get_key(), confirmable, None, len(body))
+                self._pub_prepared(prepared, body)
+                return result
+
+            message = Message(body, prepared.properties)
+            if on_confirmed is None:
+                fut = result = Future()
+            else:
+                fut = CallbackConfirmableRejectable(on_confirmed, message)
+                result = None
+            self.messages.append(CnpubMessageSendOrder(message, prepared.exchange,
+                                                       prepared.routing_key, fut, None, None))
 
             if self.state == ST_ONLINE:
                 self._mode_cnpub_process_deliveries()
 
-            return fut
+            return result
         else:
             raise Exception(u'Invalid mode')
 
@@ -329,14 +672,19 @@ class Publisher(Channeler, Synchronized):
                 self.method_and_watch(ConfirmSelect(False), ConfirmSelectOk,
                                       self.on_setup)
             elif self.mode == Publisher.MODE_NOACK:
-                # A-OK! Boot it.
-                self.state = ST_ONLINE
+                # A-OK! Boot it. Nothing may be published in between, so that messages held
+                # while offline go first.
+                with self.get_monitor_lock():
+                    self.state = ST_ONLINE
+                    self._send_reconnect_buffer()
                 self.on_operational(True)
 
         elif (self.mode == Publisher.MODE_CNPUB) and isinstance(payload, ConfirmSelectOk):
             # Because only in this case it makes sense to check for MODE_CNPUB
             # A-OK! Boot it.
-            self.tagger = AtomicTagger()
+            if self.tagger is not None:
+                self.tagger.detach_window()
+            self.tagger = AtomicTagger(self.window)
             self.state = ST_ONLINE
             self.on_operational(True)
 
@@ -352,3 +700,93 @@ class Publisher(Channeler, Synchronized):
             mw.oneshot = False
             self.connection.watch(mw)
             self._mode_cnpub_process_deliveries()
+
+
+class _PreparedFrames(object):
+    """
+    Frames of a message published from a PreparedPublish, to be written by SendingFramer:
+    a method frame, a content header frame, and if body is given, a body frame.
+    """
+    __slots__ = ('prefix', 'suffix', 'channel', 'body_size', 'body')
+    FRAME_TYPE = FRAME_HEADER
+
+    def __init__(self, prefix, suffix, channel, body_size, body):
+        self.prefix = prefix
+        self.suffix = suffix
+        self.channel = channel
+        self.body_size = body_size
+        self.body = body
+
+    def write_to(self, buf):
+        buf.write(self.prefix)
+        buf.write(STRUCT_Q.pack(self.body_size))
+        buf.write(self.suffix)
+        if self.body is not None:
+            buf.write(STRUCT_BHL.pack(FRAME_BODY, self.channel, self.body_size))
+            buf.write(self.body)
+            buf.write(FRAME_END_BYTE)
+
+
+class PreparedPublish(object):
+    """
+    A template for publishing messages to a fixed exchange, with a fixed routing key
+    and properties.
+
+    The method frame and the content header frame are encoded once, so publishing a message
+    only patches in the size of the body and appends body frames. They are encoded anew
+    if the publisher's channel changes, eg. after a reconnect.
+
+    Obtain it from Cluster.prepare().
+
+    Don't modify the properties after you've prepared them.
+    """
+    __slots__ = ('publisher', 'exchange', 'routing_key', 'properties', 'channel_id',
+                 'prefix', 'suffix')
+
+    def __init__(self, publisher,  # type: Publisher
+                 exchange,  # type: bytes
+                 routing_key,  # type: bytes
+                 properties  # type: coolamqp.objects.MessageProperties
+                 ):
+        self.publisher = publisher
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.properties = properties
+        self.channel_id = None  # channel that prefix and suffix were encoded for
+        self.prefix = None  # method frame and content header, up to body size
+        self.suffix = None  # content header after body size
+
+    def send(self, body, on_confirmed=None):
+        """
+        Publish a message.
+
+        :param body: body of the message
+        :param on_confirmed: if publishing with confirms, optional callable(Message, bool) to be
+            called instead of returning a Future, see Cluster.publish()
+        :return: a Future if publishing with confirms and on_confirmed was not given, else None
+        :raise WindowFull: there was no room in the in-flight window in time
+        """
+        return self.publisher.publish_prepared(self, body, on_confirmed)
+
+    def get_frames(self, channel_id, body_size, body=None):
+        # type: (int, int, tp.Optional[bytes]) -> _PreparedFrames
+        """
+        Return frames for a message.
+
+        Called by the publisher, with it's lock held.
+
+        :param channel_id: publisher's channel
+        :param body_size: length of body
+        :param body: body, if it's to be written along as a single body frame
+        """
+        if channel_id != self.channel_id:
+            buf = io.BytesIO()
+            AMQPMethodFrame(channel_id, BasicPublish(self.exchange, self.routing_key, False,
+                                                     False)).write_to(buf)
+            properties = self.properties.to_bytes()
+            buf.write(STRUCT_BHL.pack(FRAME_HEADER, channel_id, 12 + len(properties)))
+            buf.write(STRUCT_HH.pack(Basic.INDEX, 0))
+            self.prefix = buf.getvalue()
+            self.suffix = properties + FRAME_END_BYTE
+            self.channel_id = channel_id
+        return _PreparedFrames(self.prefix, self.suffix, channel_id, body_size, body)
@@ -1,11 +1,15 @@
 # coding=UTF-8
 from __future__ import print_function, absolute_import, division
 
+import collections
 import functools
 import logging
 import threading
+import typing as tp
 from concurrent.futures import Future
 
+from coolamqp.utils import monotonic
+
 logger = logging.getLogger(__name__)
 
 
@@ -68,6 +72,76 @@ class FutureConfirmableRejectable(ConfirmableRejectable):
         self.future.set_exception(Exception())
 
 
+class CallbackConfirmableRejectable(ConfirmableRejectable):
+    """
+    A ConfirmableRejectable that calls callback(message, True) once a message
+    is confirmed, or callback(message, False) once it's rejected.
+
+    This is much cheaper than a Future.
+    """
+    __slots__ = ('callback', 'message')
+
+    def __init__(self, callback, message):
+        self.callback = callback
+        self.message = message
+
+    def confirm(self):  # type: () -> None
+        self.callback(self.message, True)
+
+    def reject(self):  # type: () -> None
+        self.callback(self.message, False)
+
+
+class AggregateConfirmableRejectable(ConfirmableRejectable):
+    """
+    A ConfirmableRejectable that stands for a number of messages. It calls
+    callback(True) once all of them are confirmed, or callback(False) once any
+    of them is rejected. The callback is called only once.
+
+    Deposit the same instance under every message's tag.
+    """
+    __slots__ = ('callback', 'remaining', 'lock')
+
+    def __init__(self, count, callback):  # type: (int, tp.Callable[[bool], None]) -> None
+        """
+        :param count: amount of messages
+        :param callback: callable(bool)
+        """
+        self.callback = callback
+        self.remaining = count
+        self.lock = threading.Lock()
+        if not count:
+            callback(True)
+
+    @classmethod
+    def for_future(cls, future, count):
+        # type: (concurrent.futures.Future, int) -> AggregateConfirmableRejectable
+        """
+        Return an instance that results a running future with None, or
+        Exceptions it.
+        """
+        def callback(confirmed):
+            if confirmed:
+                future.set_result(None)
+            else:
+                future.set_exception(Exception())
+        return cls(count, callback)
+
+    def confirm(self):  # type: () -> None
+        with self.lock:
+            self.remaining -= 1
+            if self.remaining:
+                return
+        self.callback(True)
+
+    def reject(self):  # type: () -> None
+        with self.lock:
+            if self.remaining <= 0:
+                return  # already called back
+            self.remaining = -1  # so that it's never confirmed
+        self.callback(False)
+
+
 class AtomicTagger(object):
     """
     This implements a thread-safe dictionary of (integer=>ConfirmableRejectable | None),
@@ -101,19 +175,35 @@ class AtomicTagger(object):
 
     This has to be fast for most common cases. Corner cases will be resolved correctly,
     but maybe not fast.
+
+    Since tags are handed out by get_key() in order, they are kept in a list of slots,
+    where the slot of a tag is at index (tag - base). A slot is None if its tag was not
+    deposited, or was already acked/nacked. Slots before head are all None, and are
+    dropped once there's enough of them. So:
+
+        - depositing the next tag is O(1)
+        - acking/nacking a single tag is O(1)
+        - acking/nacking multiple tags is O(k) in the amount of slots released
+
+    Depositing a tag lower than any tag still held is the corner case - it's O(n).
+
+    If a window (an InFlightWindow) is given, messages that are acked/nacked are released
+    from it.
     """
-    __slots__ = ('lock', 'next_tag', 'tags')
+    __slots__ = ('lock', 'next_tag', 'slots', 'base', 'head', 'window')
 
-    def __init__(self):
+    def __init__(self, window=None):
         self.lock = threading.RLock()
+        self.window = window
 
         # Protected by lock
         self.next_tag = 1  # 0 is AMQP-reserved to mean "everything so far"
-        self.tags = []  # a list of (tag, ConfirmableRejectable)
+        self.slots = []  # a list of (ConfirmableRejectable, span, size, monotonic()) or None
         # they remain to be acked/nacked
-        # invariant: FOR EACH i, j: (i>j) => (tags[i][0] > tags[j][0])
+        self.base = 1  # tag of slots[0]
+        self.head = 0  # invariant: FOR EACH i < head: slots[i] is None
 
-    def deposit(self, tag, obj, span=None):
+    def deposit(self, tag, obj, span=None, size=0):
         """
         Put a tag into the tag list.
 
@@ -123,69 +213,83 @@ class AtomicTagger(object):
         :param obj: ConfirmableRejectable
                     if you put something that isn't a ConfirmableRejectable, you won't get bitten
                     until you call .ack() or .nack().
+        :param span: optional span, to be finished on ack/nack
+        :param size: length of message's body, as taken from the window
         """
         assert tag
-        opt = (tag, obj, span)
+        opt = (obj, span, size, monotonic() if self.window is not None else None)
 
         with self.lock:
-            if not self.tags:
-                self.tags.append(opt)
-            elif self.tags[-1][0] < tag:
-                self.tags.append(opt)
+            index = tag - self.base
+            slots = self.slots
+            if index == len(slots):
+                slots.append(opt)
+            elif index > len(slots):
+                slots.extend([None] * (index - len(slots)))
+                slots.append(opt)
+            elif index >= 0:
+                slots[index] = opt
+                if index < self.head:
+                    self.head = index
             else:
-                # Insert a value at place where it makes sense. Iterate from the end, because
-                # values will usually land there...
-                i = len(self.tags) - 1  # start index
+                # Lower than anything we have. Prepend it.
+                slots[0:0] = [opt] + [None] * (-index - 1)
+                self.base = tag
+                self.head = 0
 
-                while i > 0:  # this will terminate at i=0
-                    if self.tags[i][0] > tag:  # this means we should insert it here...
-                        break
-                    i -= 1  # previousl index
+    def __release(self, start, stop):  # type: (int, int) -> list
+        """
+        Take non-empty slots from start to stop (python slice indices) and clear them.
 
-                self.tags.insert(i, opt)
+        Must be called with the lock held.
+        """
+        slots = self.slots
+        items = [slot for slot in slots[start:stop] if slot is not None]
+        slots[start:stop] = [None] * (stop - start)
+
+        # advance head past slots that were released before
+        head = self.head
+        length = len(slots)
+        while head < length and slots[head] is None:
+            head += 1
+
+        if head == length:
+            self.base += length
+            self.head = 0
+            del slots[:]
+        elif head > 1024 and head * 2 > length:
+            self.base += head
+            self.head = 0
+            del slots[:head]
+        else:
+            self.head = head
+        return items
 
     def __acknack(self, tag, multiple, ack):
         """
         :param tag: Note that 0 means "everything"
         :param ack: True to ack, False to nack
         """
-        # Compute limits - they go from 0 to somewhere
         with self.lock:
-            start = 0
-            # start and stop will signify the PYTHON SLICE parameters
-
-            if tag:
-
+            if not tag:
+                items = self.__release(self.head, len(self.slots))
+            else:
+                index = tag - self.base
                 if multiple:
-                    # Compute the ranges
-                    for stop, opt in enumerate(self.tags):
-                        if opt[0] == tag:
-                            stop += 1  # this is exactly this tag. Adjust stop to end one further (Python slicing) and stop
-                            break
-                        if opt[0] > tag:
-                            break  # We went too far, but it's OK, we don't need to bother with adjusting stop
-                    else:
-                        # List finished without breaking? That would mean the entire range!
-                        stop = len(self.tags)
+                    if index < self.head:
+                        return  # nothing this low is held
+                    items = self.__release(self.head, min(index + 1, len(self.slots)))
                 else:
-                    # Just find that piece
-                    for index, opt in enumerate(self.tags):
-                        if opt[0] == tag:
-                            stop = index + 1
-                            break
-                    else:
+                    if index < self.head or index >= len(self.slots) or \
+                            self.slots[index] is None:
                         return  # not found!
+                    items = self.__release(index, index + 1)
+            window = self.window
 
-                if not multiple:
-                    start = stop - 1
-            else:
-                # Oh, I know the range!
-                stop = len(self.tags)
-
-            items = self.tags[start:stop]
-            del self.tags[start:stop]
+        if window is not None and items:
+            window.release(len(items), sum(item[2] for item in items), items[-1][3])
 
-        for tag, cr, span in items:
+        for cr, span, _, _ in items:
             if span is not None:
                 from opentracing import logs
 
@@ -200,6 +304,19 @@ class AtomicTagger(object):
                     span.log_kv({logs.EVENT: 'Nack'})
                     span.finish()
 
+    def detach_window(self):  # type: () -> None
+        """
+        Release all messages still held from the window, and stop using it.
+
+        Call this when the channel is lost, and these messages will never be acked/nacked.
+        """
+        with self.lock:
+            window, self.window = self.window, None
+            items = [slot for slot in self.slots if slot is not None]
+
+        if window is not None and items:
+            window.release(len(items), sum(item[2] for item in items))
+
     def ack(self, tag, multiple):
         """
         Acknowledge given objects.
@@ -240,6 +357,163 @@ class AtomicTagger(object):
             return self.next_tag - 1
 
 
+class DeliveryTagSet(object):
+    """
+    A set of delivery tags of messages received, but not acked or rejected yet.
+
+    Tags are added in increasing order, and removed in any order. They are kept as a bitmap,
+    that starts at the lowest outstanding tag, so it takes a bit per message received since then.
+    If some message is not acked for very long, and the bitmap would get longer than
+    MAX_BITMAP_BYTES, the oldest tags still in it are moved to a plain set. So memory taken
+    depends on how many messages are outstanding, not how many were received.
+
+    add, discard, __contains__ and lowest() are O(1) (amortized).
+
+    Not thread safe.
+    """
+    __slots__ = ('base', 'bits', 'low', 'high', 'count', 'stragglers', 'straggler_order')
+
+    MAX_BITMAP_BYTES = 8192
+
+    def __init__(self):
+        self.base = 1  # delivery tag of the first bit
+        self.bits = bytearray(256)
+        self.low = 0  # index of the lowest bit set. No bits below it are set.
+        self.high = 0  # index after the bit of the highest tag added
+        self.count = 0  # amount of bits set
+        self.stragglers = set()  # tags below base that are still outstanding
+        # stragglers in increasing order. Removed tags are dropped from it only when found
+        # at it's front, or when it gets twice as long as there are stragglers.
+        self.straggler_order = collections.deque()
+
+    def __len__(self):  # type: () -> int
+        return self.count + len(self.stragglers)
+
+    def __contains__(self, tag):  # type: (int) -> bool
+        index = tag - self.base
+        if index < 0:
+            return tag in self.stragglers
+        return index < self.high and bool(self.bits[index >> 3] & (1 << (index & 7)))
+
+    def add(self, tag):  # type: (int) -> None
+        """
+        :param tag: delivery tag, higher than any in the set
+        :raise ValueError: tag is not higher than any in the set
+        """
+        index = tag - self.base
+        if not self.count or index < self.high or index >> 3 >= len(self.bits):
+            index = self._prepare_add(tag)
+
+        self.bits[index >> 3] |= 1 << (index & 7)
+        self.high = index + 1
+        self.count += 1
+
+    def _prepare_add(self, tag):  # type: (int) -> int
+        """Handle the uncommon cases of add. Return the index of the tag's bit."""
+        if not self.count:
+            # all bits are clear, start anew from this tag
+            self.base = tag
+            self.low = self.high = 0
+            return 0
+        index = tag - self.base
+        if index < self.high:
+            raise ValueError(u'Delivery tag %s received out of order' % (tag, ))
+        self._make_room(index >> 3)
+        return tag - self.base
+
+    def _make_room(self, byte):  # type: (int) -> None
+        """Make the bitmap long enough to contain given byte"""
+        bits = self.bits
+        dead = self.low >> 3  # bytes with no bits set
+        if byte - dead >= self.MAX_BITMAP_BYTES:
+            # some old tags keep the bitmap from getting shorter
+            dead = len(bits) // 2
+            order = self.straggler_order
+            if len(order) > 2 * len(self.stragglers):
+                order = self.straggler_order = collections.deque(
+                    tag for tag in order if tag in self.stragglers)
+            for i in range(self.low >> 3, dead):
+                value = bits[i]
+                if value:
+                    for bit in range(8):
+                        if value & (1 << bit):
+                            tag = self.base + (i << 3) + bit
+                            self.stragglers.add(tag)
+                            order.append(tag)
+                            self.count -= 1
+                    bits[i] = 0
+            self.low = dead << 3
+            if self.count:
+                self._advance()
+            else:
+                self.low = self.high
+
+        if dead:
+            del bits[:dead]
+            self.base += dead << 3
+            self.low -= dead << 3
+            self.high -= dead << 3
+            byte -= dead
+
+        if byte >= len(bits):
+            bits.extend(bytearray(max(len(bits), byte + 1 - len(bits))))
+
+    def discard(self, tag):  # type: (int) -> bool
+        """
+        Remove a tag, if it's there.
+
+        :return: whether it was there
+        """
+        index = tag - self.base
+        if index < 0:
+            if tag in self.stragglers:
+                self.stragglers.remove(tag)
+                return True
+            return False
+
+        if index >= self.high:
+            return False
+        bits = self.bits
+        byte = index >> 3
+        mask = 1 << (index & 7)
+        if not bits[byte] & mask:
+            return False
+
+        bits[byte] ^= mask
+        self.count -= 1
+        if index == self.low:
+            if self.count:
+                self._advance()
+            else:
+                self.low = self.high
+        return True
+
+    def remove(self, tag):  # type: (int) -> None
+        """:raise KeyError: tag was not there"""
+        if not self.discard(tag):
+            raise KeyError(tag)
+
+    def _advance(self):  # type: () -> None
+        """Move low to the lowest bit set. There must be one."""
+        bits = self.bits
+        byte = self.low >> 3
+        while not bits[byte]:
+            byte += 1
+        value = bits[byte]
+        self.low = (byte << 3) + (value & -value).bit_length() - 1
+
+    def lowest(self):  # type: () -> tp.Optional[int]
+        """Return the lowest outstanding tag, or None if there are none"""
+        if self.stragglers:
+            order = self.straggler_order
+            while order[0] not in self.stragglers:
+                order.popleft()
+            return order[0]
+        if self.count:
+            return self.base + self.low
+        return None
+
+
 class Synchronized(object):
     """
     I have a lock and can sync on it. Use like:
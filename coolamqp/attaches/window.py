@@ -0,0 +1,155 @@
+# coding=UTF-8
+from __future__ import absolute_import, division, print_function
+
+import logging
+import threading
+import typing as tp
+
+from coolamqp.exceptions import WindowFull
+from coolamqp.uplink.listener import ListenerThread
+from coolamqp.utils import monotonic
+
+logger = logging.getLogger(__name__)
+
+BASE_LATENCY_PERIOD = 30.0  # seconds after which the lowest latency seen is learned anew
+
+
+class InFlightWindow(object):
+    """
+    A limit on how many messages published with confirms may await confirmation at once.
+
+    Pass it to Cluster to bound the memory taken by messages that the broker hasn't confirmed
+    yet. A message takes it's place in the window when it's published, and frees it when it's
+    confirmed, rejected or the connection is lost. If there's no room for a message, publish()
+    blocks until there is, for at most timeout seconds, and then raises WindowFull.
+
+    Confirms are processed by the listener thread, so if it publishes (eg. from a consumer's
+    on_message) and there's no room, WindowFull is raised at once - waiting would deadlock.
+
+    A single message (or a publish_many batch) is always let through if nothing is in flight,
+    even if it's larger than the window.
+
+    If adaptive, the limit of messages is adjusted between min_messages and max_messages,
+    from the latency of confirms (AIMD, as in TCP congestion avoidance):
+
+        - while confirms come in less than twice the lowest latency seen, the limit grows by
+          one for every limit's worth of confirmed messages
+        - when they take longer than that, the broker is queueing them, so the limit is cut
+          by a quarter, at most once per that latency
+
+    Thread safe.
+    """
+
+    def __init__(self, max_messages=None,  # type: tp.Optional[int]
+                 max_bytes=None,  # type: tp.Optional[int]
+                 timeout=None,  # type: tp.Optional[float]
+                 adaptive=False,  # type: bool
+                 min_messages=16  # type: int
+                 ):
+        """
+        :param max_messages: maximum amount of messages in flight, or None for no limit
+        :param max_bytes: maximum total length of bodies in flight, or None for no limit
+        :param timeout: how long can publish() block waiting for room. None means forever,
+            0 means to raise WindowFull at once.
+        :param adaptive: whether to adjust the limit of messages from confirm latency
+        :param min_messages: lowest limit of messages that adaptive mode will go down to
+        :raise ValueError: adaptive, but max_messages was not given
+        """
+        if adaptive and max_messages is None:
+            raise ValueError(u'Adaptive window needs max_messages')
+
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.adaptive = adaptive
+        self.min_messages = min(min_messages, max_messages or min_messages)
+
+        self.condition = threading.Condition(threading.Lock())
+        # Protected by condition
+        self.messages = 0  # type: int
+        self.bytes = 0  # type: int
+        self.limit = max_messages  # type: tp.Optional[float]
+        self.base_latency = None  # type: tp.Optional[float]
+        self.base_latency_since = monotonic()
+        self.last_decrease = 0.0
+
+    def _has_room(self, count, size):  # type: (int, int) -> bool
+        if not self.messages:
+            return True
+        if self.limit is not None and self.messages + count > self.limit:
+            return False
+        if self.max_bytes is not None and self.bytes + size > self.max_bytes:
+            return False
+        return True
+
+    def has_room(self, count=1, size=0):  # type: (int, int) -> bool
+        """
+        Check whether publishing would not block right now.
+
+        :param count: amount of messages
+        :param size: total length of their bodies
+        """
+        with self.condition:
+            return self._has_room(count, size)
+
+    def acquire(self, count, size):  # type: (int, int) -> None
+        """
+        Take place for some messages, blocking if necessary.
+
+        :param count: amount of messages
+        :param size: total length of their bodies
+        :raise WindowFull: there was no room in time, or called by the listener thread and
+            there's no room
+        """
+        with self.condition:
+            if not self._has_room(count, size):
+                if isinstance(threading.current_thread(), ListenerThread):
+                    # confirms that would make room are processed by this very thread
+                    raise WindowFull(u'%s messages in flight, and can\'t wait for them in '
+                                     u'the listener thread' % (self.messages, ))
+                elif self.timeout is None:
+                    while not self._has_room(count, size):
+                        self.condition.wait()
+                else:
+                    deadline = monotonic() + self.timeout
+                    while not self._has_room(count, size):
+                        remaining = deadline - monotonic()
+                        if remaining <= 0:
+                            raise WindowFull(u'%s messages in flight' % (self.messages, ))
+                        self.condition.wait(remaining)
+
+            self.messages += count
+            self.bytes += size
+
+    def release(self, count, size, deposited_at=None):
+        # type: (int, int, tp.Optional[float]) -> None
+        """
+        Free place taken by some messages.
+
+        :param count: amount of messages
+        :param size: total length of their bodies
+        :param deposited_at: monotonic() time when the last of them was sent, if they were
+            confirmed by the broker. Used to measure latency.
+        """
+        with self.condition:
+            self.messages -= count
+            self.bytes -= size
+            if self.adaptive and deposited_at is not None:
+                self._adapt(count, monotonic() - deposited_at)
+            self.condition.notify_all()
+
+    def _adapt(self, count, latency):  # type: (int, float) -> None
+        now = monotonic()
+        if self.base_latency is None or latency < self.base_latency or \
+                now - self.base_latency_since > BASE_LATENCY_PERIOD:
+            self.base_latency = latency
+            self.base_latency_since = now
+
+        if latency > 2 * self.base_latency:
+            if now - self.last_decrease > latency:
+                self.limit = max(self.min_messages, self.limit * 0.75)
+                self.last_decrease = now
+                logger.debug('Confirm latency is %.3f s, in-flight window shrunk to %d',
+                             latency, self.limit)
+        else:
+            self.limit = min(self.max_messages, self.limit + count / self.limit)
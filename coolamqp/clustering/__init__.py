@@ -6,7 +6,8 @@ to broker with an uniform interface.
 from __future__ import print_function, absolute_import, division
 
 from coolamqp.clustering.cluster import Cluster
+from coolamqp.clustering.outbox import Outbox
 from coolamqp.clustering.events import MessageReceived, NothingMuch, \
     ConnectionLost
 
-__all__ = ['Cluster', 'MessageReceived', 'NothingMuch', 'ConnectionLost']
+__all__ = ['Cluster', 'Outbox', 'MessageReceived', 'NothingMuch', 'ConnectionLost']
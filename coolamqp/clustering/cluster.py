@@ -1,7 +1,9 @@
 # coding=UTF-8
 from __future__ import print_function, absolute_import, division
 
+import itertools
 import logging
+import threading
 import time
 import typing as tp
 from concurrent.futures import Future
@@ -9,13 +11,16 @@ from concurrent.futures import Future
 import six
 
 from coolamqp.argumentify import argumentify, tobytes
-from coolamqp.attaches import Publisher, AttacheGroup, Consumer, Declarer
+from coolamqp.attaches import Publisher, AttacheGroup, Consumer, Declarer, InFlightWindow, \
+    FrameBuffer
+from coolamqp.attaches.publisher import PreparedPublish
 from coolamqp.attaches.utils import close_future
 from coolamqp.clustering.events import ConnectionLost, MessageReceived, \
     NothingMuch, Event
 from coolamqp.clustering.single import SingleNodeReconnector
 from coolamqp.exceptions import ConnectionDead
-from coolamqp.objects import Exchange, Message, Queue, QueueBind
+from coolamqp.objects import Exchange, Message, MessageProperties, Queue, QueueBind, \
+    EMPTY_PROPERTIES, exchange_and_routing_key
 from coolamqp.uplink import ListenerThread
 from coolamqp.utils import monotonic
 
@@ -47,7 +52,13 @@ class Cluster(object):
                  log_frames=None,
                  name=None,  # type: tp.Optional[str]
                  on_blocked=None,  # type: tp.Callable[[bool], None],
-                 tracer=None  # type: opentracing.Traccer
+                 tracer=None,  # type: opentracing.Traccer
+                 in_flight_window=None,  # type: tp.Optional[InFlightWindow]
+                 publisher_channels=1,  # type: int
+                 buffer_memory_limit=None,  # type: tp.Optional[int]
+                 buffer_size_limit=None,  # type: tp.Optional[int]
+                 reconnect_buffer_messages=0,  # type: int
+                 reconnect_buffer_bytes=None  # type: tp.Optional[int]
                  ):
         """
         :param nodes: single node
@@ -63,6 +74,24 @@ class Cluster(object):
         :param on_blocked: callable to call when ConnectionBlocked/ConnectionUnblocked is received. It will be
             called with a value of True if connection becomes blocked, and False upon an unblock
         :param tracer: tracer, if opentracing is installed
+        :param in_flight_window: an InFlightWindow, to limit how many messages published with
+            confirms can await confirmation at once. If there's no room, publish blocks or
+            raises WindowFull.
+        :param publisher_channels: amount of channels to publish on, for each of the two kinds of
+            publishing (with confirms and without). Each thread is assigned one of them, round-robin,
+            on it's first publish, so that threads publishing at once don't wait for each other.
+            The in-flight window is shared by all of them.
+        :param buffer_memory_limit: while the connection is blocked or content flow is stopped,
+            each publisher channel holds back frames in memory up to this many bytes, and spills
+            further ones to a temporary file. None means to keep them all in memory.
+        :param buffer_size_limit: once a publisher channel holds back this many bytes, publishing
+            on it raises BufferFull until the connection is unblocked. None means no limit.
+        :param reconnect_buffer_messages: messages published without confirms while there's no
+            connection (eg. while reconnecting) are normally discarded. Instead, each publisher
+            channel can keep up to this many of them, and send them once it's back. If more are
+            published, the oldest ones are discarded.
+        :param reconnect_buffer_bytes: maximum total length of bodies of these messages, for each
+            publisher channel. None means no limit.
         """
         from coolamqp.objects import NodeDefinition
         if isinstance(nodes, NodeDefinition):
@@ -71,6 +100,9 @@ class Cluster(object):
         if len(nodes) > 1:
             raise NotImplementedError(u'Multiple nodes not supported yet')
 
+        if publisher_channels < 1:
+            raise ValueError(u'publisher_channels must be at least 1')
+
         if tracer is not None:
             try:
                 import opentracing
@@ -86,6 +118,7 @@ class Cluster(object):
         self.node, = nodes              # type: NodeDefinition
         self.extra_properties = extra_properties
         self.log_frames = log_frames
+        self.in_flight_window = in_flight_window  # type: tp.Optional[InFlightWindow]
         self.on_blocked = on_blocked    # type: tp.Optional[tp.Callable[[bool], None]]
         self.connected = False          # type: bool
         self.listener = None            # type: BaseListener
@@ -94,6 +127,15 @@ class Cluster(object):
         self.snr = None                 # type: SingleNodeReconnector
         self.pub_tr = None              # type: Publisher
         self.pub_na = None              # type: Publisher
+        self.publisher_channels = publisher_channels  # type: int
+        self.buffer_memory_limit = buffer_memory_limit  # type: tp.Optional[int]
+        self.buffer_size_limit = buffer_size_limit  # type: tp.Optional[int]
+        self.reconnect_buffer_messages = reconnect_buffer_messages  # type: int
+        self.reconnect_buffer_bytes = reconnect_buffer_bytes  # type: tp.Optional[int]
+        self.publishers_tr = []         # type: tp.List[Publisher]
+        self.publishers_na = []         # type: tp.List[Publisher]
+        self.publisher_local = threading.local()  # index of publishers of this thread
+        self.publisher_counter = itertools.count()
         self.decl = None                # type: Declarer
         self.on_fail = None
 
@@ -216,8 +258,9 @@ class Cluster(object):
             child_span = None
         fut = Future()
         fut.set_running_or_notify_cancel()  # it's running right now
-        on_message = on_message or (
-            lambda msg: self.events.put_nowait(MessageReceived(msg)))
+        if on_message is None and kwargs.get('on_messages') is None:
+            on_message = self.events.put_nowait
+            kwargs.setdefault('message_class', MessageReceived)
         con = Consumer(queue, on_message, future_to_notify=fut, span=span, *args,
                        **kwargs)
         self.attache_group.add(con)
@@ -246,12 +289,26 @@ class Cluster(object):
                                               tags.DATABASE_STATEMENT: call
                                           })
 
+    def _get_publisher(self, confirm):  # type: (bool) -> Publisher
+        """Return the publisher for calling thread"""
+        if self.publisher_channels == 1:
+            return self.pub_tr if confirm else self.pub_na
+
+        try:
+            index = self.publisher_local.index
+        except AttributeError:
+            index = self.publisher_local.index = \
+                next(self.publisher_counter) % self.publisher_channels
+
+        return self.publishers_tr[index] if confirm else self.publishers_na[index]
+
     def publish(self, message,  # type: Message
                 exchange=None,  # type: tp.Union[Exchange, str, bytes]
                 routing_key=u'',  # type: tp.Union[str, bytes]
                 confirm=None,  # type: tp.Optional[bool]
                 span=None,  # type: tp.Optional[opentracing.Span]
-                dont_trace=False    # type: bool
+                dont_trace=False,    # type: bool
+                on_confirmed=None   # type: tp.Optional[tp.Callable[[Message, bool], None]]
                 ):  # type: (...) -> tp.Optional[Future]
         """
         Publish a message.
@@ -263,34 +320,107 @@ class Cluster(object):
                         If you choose so, you will receive a Future that can be used
                         to check it broker took responsibility for this message.
                         Note that if confirm is False, and message cannot be delivered to broker at once,
-                        it will be discarded
+                        it will be discarded, unless reconnect_buffer_messages was given
         :param span: optionally, current span, if opentracing is installed
         :param dont_trace: if set to True, a span won't be generated
+        :param on_confirmed: a callable(message, bool) to be called, from the listener thread, with
+                             True when broker confirms the message or False when it rejects it.
+                             If given, the message is published with confirms, but a Future is
+                             not created, which is much cheaper. None is returned then.
         :return: Future to be finished on completion or None, is confirm was not chosen
+        :raise WindowFull: in_flight_window was given, and there was no room in it in time
+        :raise BufferFull: the connection is blocked, and buffer_size_limit bytes are held back
         """
         if self.tracer is not None and not dont_trace:
             span = self._make_span('publish', span)
 
-        if isinstance(exchange, Exchange):
-            exchange = exchange.name.encode('utf8')
-        elif exchange is None:
-            exchange = b''
-        elif isinstance(exchange, six.text_type):
-            exchange = exchange.encode('utf8')
+        exchange, routing_key = exchange_and_routing_key(exchange, routing_key)
+
+        try:
+            if on_confirmed is not None:
+                return self._get_publisher(True).publish(message, exchange, routing_key, span,
+                                                         on_confirmed)
+            return self._get_publisher(confirm).publish(message, exchange, routing_key, span)
+        except Publisher.UnusablePublisher:
+            raise NotImplementedError(
+                u'Sorry, this functionality is not yet implemented!')
 
-        if isinstance(routing_key, six.text_type):
-            routing_key = routing_key.encode('utf8')
+    def publish_many(self, messages,  # type: tp.Iterable[tp.Tuple[Message, tp.Union[Exchange, str, bytes, None], tp.Union[str, bytes]]]
+                     confirm=None,  # type: tp.Optional[bool]
+                     aggregate=False,  # type: bool
+                     on_confirmed=None  # type: tp.Optional[tp.Callable[[tp.Any, bool], None]]
+                     ):  # type: (...) -> tp.Optional[tp.Union[Future, tp.List[Future]]]
+        """
+        Publish many messages at once.
+
+        The whole batch is framed at once and handed over to the socket as a single piece of data,
+        so this is much faster than calling publish() for every message. Spans are not generated.
+
+        :param messages: iterable of (Message, exchange, routing key). Exchange may be None for
+                         the default "direct" empty-name exchange.
+        :param confirm: Whether to publish them using confirms/transactions.
+                        Note that if confirm is False, and messages cannot be delivered to broker
+                        at once, they will be discarded, unless reconnect_buffer_messages was given.
+        :param aggregate: if confirm is True, return a single Future that completes when all of
+                          the messages are confirmed, or fails if any of them was rejected,
+                          instead of a list of Futures, one for every message.
+        :param on_confirmed: a callable to be called instead of returning Futures. Messages will be
+                             published with confirms. It's called with (message, bool) for every
+                             message, or if aggregate is True, once with (list of messages, bool).
+        :return: list of Futures or a single Future if confirm was chosen, None otherwise
+        :raise WindowFull: in_flight_window was given, and there was no room in it in time
+        :raise BufferFull: the connection is blocked, and buffer_size_limit bytes are held back
+        """
+        batch = [(message, ) + exchange_and_routing_key(exchange, routing_key)
+                 for message, exchange, routing_key in messages]
 
         try:
-            if confirm:
-                clb = self.pub_tr
+            if confirm or on_confirmed is not None:
+                return self._get_publisher(True).publish_many(batch, aggregate, on_confirmed)
             else:
-                clb = self.pub_na
-            return clb.publish(message, exchange, routing_key, span)
+                return self._get_publisher(False).publish_many(batch)
         except Publisher.UnusablePublisher:
             raise NotImplementedError(
                 u'Sorry, this functionality is not yet implemented!')
 
+    def prepare(self, exchange=None,  # type: tp.Union[Exchange, str, bytes, None]
+                routing_key=u'',  # type: tp.Union[str, bytes]
+                properties=None,  # type: tp.Optional[MessageProperties]
+                confirm=False  # type: bool
+                ):  # type: (...) -> PreparedPublish
+        """
+        Prepare to publish many messages with the same exchange, routing key and properties.
+
+        The frames that these messages share are encoded only once, so publishing with the
+        returned PreparedPublish is much cheaper than calling publish(). Spans are not generated.
+
+        >>> prepared = cluster.prepare(routing_key=u'my_queue', confirm=True)
+        >>> prepared.send(b'hello world').result()
+
+        Can be called only after start(). If there are many publisher channels, messages are
+        published on the one assigned to the thread that called prepare().
+
+        :param exchange: exchange to use. Default is the "direct" empty-name exchange.
+        :param routing_key: routing key to use
+        :param properties: properties of the messages
+        :param confirm: Whether to publish them using confirms/transactions.
+        :return: a PreparedPublish
+        """
+        exchange, routing_key = exchange_and_routing_key(exchange, routing_key)
+        return PreparedPublish(self._get_publisher(confirm), exchange, routing_key,
+                               properties or EMPTY_PROPERTIES)
+
+    def get_buffered_bytes(self):  # type: () -> int
+        """
+        Return how many bytes publishers hold back, because the connection is blocked
+        or content flow is stopped.
+        """
+        return sum(publisher.buffered_bytes
+                   for publisher in self.publishers_tr + self.publishers_na)
+
+    def _make_frame_buffer(self):  # type: () -> FrameBuffer
+        return FrameBuffer(self.buffer_memory_limit, self.buffer_size_limit)
+
     def start(self, wait=True, timeout=10.0):
         """
         Connect to broker. Initialize Cluster.
@@ -326,13 +456,21 @@ class Cluster(object):
         if self.on_blocked is not None:
             self.snr.on_blocked.add(self.on_blocked)
 
-        # Spawn a transactional publisher and a noack publisher
-        self.pub_tr = Publisher(Publisher.MODE_CNPUB, self)
-        self.pub_na = Publisher(Publisher.MODE_NOACK, self)
+        # Spawn transactional publishers and noack publishers
+        self.publishers_tr = [Publisher(Publisher.MODE_CNPUB, self, self.in_flight_window,
+                                        self._make_frame_buffer())
+                              for _ in range(self.publisher_channels)]
+        self.publishers_na = [Publisher(Publisher.MODE_NOACK, self,
+                                        frame_buffer=self._make_frame_buffer(),
+                                        reconnect_buffer_messages=self.reconnect_buffer_messages,
+                                        reconnect_buffer_bytes=self.reconnect_buffer_bytes)
+                              for _ in range(self.publisher_channels)]
+        self.pub_tr = self.publishers_tr[0]
+        self.pub_na = self.publishers_na[0]
         self.decl = Declarer(self)
 
-        self.attache_group.add(self.pub_tr)
-        self.attache_group.add(self.pub_na)
+        for publisher in self.publishers_tr + self.publishers_na:
+            self.attache_group.add(publisher)
         self.attache_group.add(self.decl)
 
         self.listener.init()
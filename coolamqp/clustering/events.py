@@ -44,14 +44,19 @@ class ConnectionLost(Event):
 
 class MessageReceived(ReceivedMessage, Event):
     """
-    Something that works as an ersatz ReceivedMessage, but is an event
+    A ReceivedMessage, that is also an event.
+
+    Consumers started by Cluster.consume without on_message receive their messages as this.
+
+    It's constructed just like a ReceivedMessage, or from one: MessageReceived(msg).
     """
     __slots__ = ()
 
-    def __init__(self, msg):  # type: (ReceivedMessage) -> None
-        """:type msg: ReceivedMessage"""
-        ReceivedMessage.__init__(self, msg.body, msg.exchange_name,
-                                 msg.routing_key,
-                                 properties=msg.properties,
-                                 delivery_tag=msg.delivery_tag,
-                                 ack=msg.ack, nack=msg.nack)
+    def __init__(self, msg, *args, **kwargs):
+        if args or kwargs:
+            ReceivedMessage.__init__(self, msg, *args, **kwargs)
+        else:
+            ReceivedMessage.__init__(self, msg.body, msg.exchange_name, msg.routing_key,
+                                     properties=msg.properties,
+                                     delivery_tag=msg.delivery_tag,
+                                     ack=msg.ack, nack=msg.nack)
@@ -0,0 +1,474 @@
+# coding=UTF-8
+"""
+A durable, local outbox of messages to publish with confirms.
+
+Messages are appended to a log of memory-mapped segment files, and publish() returns as soon
+as they're on disk - without waiting for the broker. A background thread publishes them with
+confirms, and a segment file is deleted once all of it's messages are confirmed. Messages that
+were not confirmed when the process died are published again by the next Outbox started on
+the same directory.
+"""
+from __future__ import print_function, absolute_import, division
+
+import collections
+import functools
+import io
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import typing as tp
+import zlib
+
+from coolamqp.framing.definitions import BasicContentPropertyList
+from coolamqp.framing.lazy_properties import LazyContentPropertyList
+from coolamqp.objects import Exchange, Message, StreamedBody, EMPTY_PROPERTIES, \
+    exchange_and_routing_key
+from coolamqp.utils import monotonic
+
+logger = logging.getLogger(__name__)
+
+STRUCT_II = struct.Struct('!II')  # record header: length of payload, CRC32 of payload
+STRUCT_BBI = struct.Struct('!BBI')  # length of exchange, routing key and properties
+
+SEGMENT_NAME = 'outbox-%016d.log'
+
+HAS_FDATASYNC = hasattr(os, 'fdatasync') and sys.platform.startswith('linux')
+
+
+def _fsync_directory(directory):  # type: (str) -> None
+    """Make sure that files created in a directory survive a crash"""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:  # eg. Windows
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class _Segment(object):
+    """A memory-mapped file of the log"""
+    __slots__ = ('path', 'file', 'mmap', 'size', 'offset', 'synced_offset',
+                 'unconfirmed', 'sealed')
+
+    def __init__(self, path, size=None):
+        """
+        :param path: path to the file
+        :param size: size to create the file with, or None to open an existing one
+        """
+        self.path = path
+        self.sealed = size is None  # type: bool # no more records will be written
+        if size is None:
+            self.file = open(path, 'r+b')
+            size = os.fstat(self.file.fileno()).st_size
+        else:
+            self.file = open(path, 'w+b')
+            self.file.truncate(size)
+        self.size = size  # type: int
+        self.mmap = mmap.mmap(self.file.fileno(), size)
+        self.offset = 0  # type: int # where the next record will be written
+        self.synced_offset = 0  # type: int # up to where it's on disk
+        self.unconfirmed = 0  # type: int # records not confirmed by the broker yet
+
+    def has_room(self, length):  # type: (int) -> bool
+        return self.offset + length <= self.size
+
+    def append(self, parts, length):  # type: (tp.List[bytes], int) -> int
+        """
+        Write a record.
+
+        :param parts: buffers that make up the record
+        :param length: their total length
+        :return: offset of the record
+        """
+        offset = position = self.offset
+        for part in parts:
+            self.mmap[position:position + len(part)] = part
+            position += len(part)
+        self.offset = offset + length
+        self.unconfirmed += 1
+        return offset
+
+    def sync(self, start, stop):  # type: (int, int) -> None
+        """Flush part of this segment to disk"""
+        if stop <= start:
+            return
+        if HAS_FDATASYNC:
+            # mmap.flush() holds the GIL while it waits for the disk, while fdatasync()
+            # doesn't, so other writers can append meanwhile - that's what makes group commit
+            # work. On Linux it writes back pages dirtied through the mapping as well.
+            os.fdatasync(self.file.fileno())
+        else:
+            start -= start % mmap.PAGESIZE
+            self.mmap.flush(start, stop - start)
+
+    def read(self, offset):  # type: (int) -> tp.Optional[tp.Tuple[Message, bytes, bytes, int]]
+        """
+        Read a record.
+
+        :return: a tuple of (message, exchange, routing key, offset of next record), or None if
+            there's no valid record at offset (it was never written, or only partially)
+        """
+        if offset + STRUCT_II.size > self.size:
+            return None
+        length, crc = STRUCT_II.unpack_from(self.mmap, offset)
+        start = offset + STRUCT_II.size
+        if not length or start + length > self.size:
+            return None
+        payload = self.mmap[start:start + length]
+        if zlib.crc32(payload) & 0xffffffff != crc:
+            return None
+
+        exchange_length, routing_key_length, properties_length = STRUCT_BBI.unpack_from(payload, 0)
+        position = STRUCT_BBI.size
+        exchange = payload[position:position + exchange_length]
+        position += exchange_length
+        routing_key = payload[position:position + routing_key_length]
+        position += routing_key_length
+        properties = LazyContentPropertyList(BasicContentPropertyList,
+                                             payload[position:position + properties_length], 0)
+        position += properties_length
+        message = Message(payload[position:], properties)
+        return message, exchange, routing_key, start + length
+
+    def close(self, remove=False):  # type: (bool) -> None
+        self.mmap.close()
+        self.file.close()
+        if remove:
+            os.remove(self.path)
+
+
+class Outbox(object):
+    """
+    A durable, local outbox of messages to publish with confirms, through a Cluster.
+
+    publish() appends a message to a log in directory, and returns once it's on disk. Writers
+    that publish at once share a single flush (group commit). A background thread publishes
+    messages from the log in order, and parts of the log are deleted once the broker confirms
+    all of their messages. If the broker rejects a message, it's published again. While there's
+    no connection nothing is published, and messages that were awaiting confirmation when it
+    was lost are published again once it's back.
+
+    Delivery is at-least-once: a message can be published more than once if the connection was
+    lost, or the process died, before it's confirm was received.
+
+    Only a single Outbox may use a directory at a time.
+
+    >>> outbox = Outbox(cluster, '/var/lib/myapp/outbox')
+    >>> outbox.start()
+    >>> outbox.publish(Message(b'hello'), routing_key=u'my_queue')
+
+    :param cluster: a Cluster to publish with. It must be started before the Outbox.
+    :param directory: directory to keep the log in. It's created if it doesn't exist.
+    :param segment_size: size of a file of the log, in bytes
+    :param sync: whether publish() should wait for the message to be flushed to disk. If False,
+        it's on disk only once the operating system writes it there.
+    :param batch_size: maximum amount of messages to publish at once
+    :param max_in_flight: maximum amount of messages awaiting confirmation
+    :param retry_interval: seconds to wait before publishing again if publishing failed
+    """
+
+    def __init__(self, cluster,  # type: coolamqp.clustering.Cluster
+                 directory,  # type: str
+                 segment_size=64 * 1024 * 1024,  # type: int
+                 sync=True,  # type: bool
+                 batch_size=256,  # type: int
+                 max_in_flight=4096,  # type: int
+                 retry_interval=1.0  # type: float
+                 ):
+        self.cluster = cluster
+        self.directory = directory
+        self.segment_size = segment_size
+        self.sync = sync
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.retry_interval = retry_interval
+
+        self.condition = threading.Condition(threading.Lock())
+        # Protected by condition
+        self.segment = None  # type: _Segment # segment being written to
+        self.next_segment = 0  # type: int # number of the next segment file
+        self.written = 0  # type: int # amount of records written
+        self.synced = 0  # type: int # amount of records flushed to disk
+        self.flushing = False  # type: bool # is some writer flushing now
+        self.unsynced = collections.deque()  # (segment, offset) of records not flushed yet
+        self.ready = collections.deque()  # (segment, offset) of records to publish
+        self.in_flight = {}  # type: tp.Dict[int, list] # batches awaiting confirmation
+        self.in_flight_count = 0  # type: int
+        self.batch_counter = 0  # type: int
+        self.generation = 0  # type: int # incremented when the connection is lost
+        self.online = True  # type: bool # is there a connection to publish on
+        self.closed = False  # type: bool
+        self.thread = None  # type: threading.Thread
+
+    def start(self):  # type: () -> None
+        """
+        Recover messages left in the log, and start publishing.
+
+        Call it after the cluster is started.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        names = sorted(name for name in os.listdir(self.directory)
+                       if name.startswith('outbox-') and name.endswith('.log'))
+        recovered = 0
+        for name in names:
+            self.next_segment = int(name[len('outbox-'):-len('.log')]) + 1
+            segment = _Segment(os.path.join(self.directory, name))
+            offset = 0
+            while True:
+                record = segment.read(offset)
+                if record is None:
+                    break
+                self.ready.append((segment, offset))
+                segment.unconfirmed += 1
+                offset = record[3]
+            recovered += segment.unconfirmed
+            segment.offset = segment.synced_offset = offset
+            if not segment.unconfirmed:
+                segment.close(remove=True)
+
+        if recovered:
+            logger.info(u'Recovered %s messages from the outbox in %s', recovered,
+                        self.directory)
+
+        self.segment = self._new_segment(self.segment_size)
+        self.cluster.snr.on_fail.add(self._on_link_lost)
+        self.cluster.snr.on_connected.add(self._on_link_up)
+
+        self.thread = threading.Thread(target=self._drain, name='outbox %s' % (self.directory, ))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _new_segment(self, size):  # type: (int) -> _Segment
+        segment = _Segment(os.path.join(self.directory, SEGMENT_NAME % (self.next_segment, )),
+                           size)
+        self.next_segment += 1
+        _fsync_directory(self.directory)
+        return segment
+
+    @property
+    def pending(self):  # type: () -> int
+        """Amount of messages that were not confirmed by the broker yet"""
+        return len(self.unsynced) + len(self.ready) + self.in_flight_count
+
+    def publish(self, message,  # type: Message
+                exchange=b'',  # type: tp.Union[Exchange, str, bytes]
+                routing_key=b''  # type: tp.Union[str, bytes]
+                ):  # type: (...) -> None
+        """
+        Store a message to be published with confirms. Returns once it's on disk.
+
+        :param message: a Message. It's body cannot be a StreamedBody.
+        :param exchange: exchange to use. Default is the "direct" empty-name exchange.
+        :param routing_key: routing key to use
+        :raise ValueError: the message has a StreamedBody, or the outbox is closed
+        :raise IOError: writing to disk failed
+        """
+        exchange, routing_key = exchange_and_routing_key(exchange, routing_key)
+        if isinstance(message.body, StreamedBody):
+            raise ValueError(u'Messages with a StreamedBody cannot be put into an outbox')
+
+        buf = io.BytesIO()
+        (message.properties or EMPTY_PROPERTIES).write_to(buf)
+        properties = buf.getvalue()
+
+        parts = [STRUCT_BBI.pack(len(exchange), len(routing_key), len(properties)),
+                 exchange, routing_key, properties, message.body]
+        crc = 0
+        for part in parts:
+            crc = zlib.crc32(part, crc)
+        length = sum(len(part) for part in parts)
+        parts.insert(0, STRUCT_II.pack(length, crc & 0xffffffff))
+        length += STRUCT_II.size
+
+        with self.condition:
+            if self.closed:
+                raise ValueError(u'Outbox is closed')
+
+            if not self.segment.has_room(length):
+                self._rotate(length)
+            self.unsynced.append((self.segment, self.segment.append(parts, length)))
+            self.written += 1
+            seq = self.written
+
+            if not self.sync:
+                self._mark_synced(self.written)
+                return
+
+            while self.synced < seq:
+                if self.flushing:
+                    self.condition.wait()
+                else:
+                    self._flush()
+
+    def _rotate(self, length):  # type: (int) -> None
+        """Seal current segment and start a new one, with room for at least length bytes"""
+        old = self.segment
+        if self.sync:
+            old.sync(old.synced_offset, old.offset)
+            old.synced_offset = old.offset
+        old.sealed = True
+        if not old.unconfirmed:
+            old.close(remove=True)
+        # leave room for an empty record header, that marks the end
+        self.segment = self._new_segment(max(self.segment_size, length + STRUCT_II.size))
+
+    def _flush(self):  # type: () -> None
+        """
+        Flush what's written to disk, as a leader of a group commit.
+
+        Called with the lock held. It's released for the time of the flush.
+        """
+        self.flushing = True
+        target = self.written
+        segment = self.segment
+        start, stop = segment.synced_offset, segment.offset
+        self.condition.release()
+        try:
+            segment.sync(start, stop)
+        finally:
+            self.condition.acquire()
+            self.flushing = False
+            self.condition.notify_all()
+        segment.synced_offset = max(segment.synced_offset, stop)
+        self._mark_synced(target)
+
+    def _mark_synced(self, target):  # type: (int) -> None
+        """Make records up to target available for publishing"""
+        while self.synced < target:
+            self.ready.append(self.unsynced.popleft())
+            self.synced += 1
+        self.condition.notify_all()
+
+    def _drain(self):
+        while True:
+            with self.condition:
+                while not self.closed and (not self.online or not self.ready or
+                                           self.in_flight_count >= self.max_in_flight):
+                    self.condition.wait()
+                if self.closed:
+                    return
+
+                count = min(len(self.ready), self.batch_size,
+                            self.max_in_flight - self.in_flight_count)
+                batch = [self.ready.popleft() for _ in range(count)]
+                self.batch_counter += 1
+                batch_id = self.batch_counter
+                self.in_flight[batch_id] = batch
+                self.in_flight_count += count
+                generation = self.generation
+
+            try:
+                messages = [segment.read(offset)[:3] for segment, offset in batch]
+                self.cluster.publish_many(
+                    messages, aggregate=True,
+                    on_confirmed=functools.partial(self._on_confirmed, batch_id, generation))
+            except Exception as e:
+                logger.warning(u'Publishing from the outbox failed, will retry: %s', repr(e))
+                with self.condition:
+                    self._requeue(batch_id, generation)
+                time.sleep(self.retry_interval)
+
+    def _requeue(self, batch_id, generation):  # type: (int, int) -> None
+        """Put a batch back to be published again"""
+        if generation == self.generation:
+            batch = self.in_flight.pop(batch_id)
+            self.in_flight_count -= len(batch)
+            self.ready.extendleft(reversed(batch))
+            self.condition.notify_all()
+
+    def _on_confirmed(self, batch_id, generation, messages, confirmed):
+        # type: (int, int, tp.List[Message], bool) -> None
+        with self.condition:
+            if generation != self.generation or self.closed:
+                # it was put back when the connection was lost, or the log is closed already
+                return
+
+            if not confirmed:
+                logger.warning(u'Broker rejected messages from the outbox, publishing again')
+                self._requeue(batch_id, generation)
+                return
+
+            batch = self.in_flight.pop(batch_id)
+            self.in_flight_count -= len(batch)
+            for segment, _ in batch:
+                segment.unconfirmed -= 1
+                if not segment.unconfirmed and segment.sealed:
+                    segment.close(remove=True)
+            self.condition.notify_all()
+
+    def _on_link_lost(self):
+        """
+        Confirms for messages in flight will never come. Stop publishing until the connection
+        is back - the publisher would just queue them.
+
+        This is called for every connection that fails, also while reconnecting.
+        """
+        with self.condition:
+            if self.online:
+                self.online = False
+                self.generation += 1
+
+    def _on_link_up(self):
+        """Publish messages that were lost with the previous connection again, and carry on"""
+        with self.condition:
+            if self.online:
+                return
+            self.online = True
+            for batch_id in sorted(self.in_flight, reverse=True):
+                self.ready.extendleft(reversed(self.in_flight[batch_id]))
+            self.in_flight = {}
+            self.in_flight_count = 0
+            self.condition.notify_all()
+
+    def wait(self, timeout=None):  # type: (tp.Optional[float]) -> bool
+        """
+        Wait until all messages are confirmed by the broker.
+
+        :param timeout: seconds to wait for at most, None to wait forever
+        :return: whether all messages were confirmed
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        with self.condition:
+            while self.pending:
+                if deadline is None:
+                    self.condition.wait()
+                else:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+            return True
+
+    def close(self):  # type: () -> None
+        """
+        Stop publishing, and close the log. Messages that were not confirmed stay in it,
+        to be published by the next Outbox started on this directory.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.cluster.snr.on_fail.remove(self._on_link_lost)
+            self.cluster.snr.on_connected.remove(self._on_link_up)
+            self.thread.join()
+
+        with self.condition:
+            segments = set(segment for segment, _ in self.ready)
+            segments.update(segment for segment, _ in self.unsynced)
+            for batch in self.in_flight.values():
+                segments.update(segment for segment, _ in batch)
+            segments.add(self.segment)
+            for segment in segments:
+                if self.sync:
+                    segment.sync(segment.synced_offset, segment.offset)
+                segment.close(remove=not segment.unconfirmed)
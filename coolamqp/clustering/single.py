@@ -41,6 +41,7 @@ class SingleNodeReconnector(object):
 
         self.on_fail = Callable()  #: public
         self.on_blocked = Callable()  #: public
+        self.on_connected = Callable()  #: public, called once a connection is open
         self.on_fail.add(self._on_fail)
 
     def is_connected(self):  # type: () -> bool
@@ -58,6 +59,7 @@ class SingleNodeReconnector(object):
                                      log_frames=self.log_frames,
                                      name=self.name)
         self.attache_group.attach(self.connection)
+        self.connection.call_on_connected(self.on_connected)
         self.connection.start(timeout)
         self.connection.finalize.add(self.on_fail)
 
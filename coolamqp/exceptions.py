@@ -3,7 +3,8 @@ from __future__ import absolute_import, division, print_function
 
 from coolamqp.framing.definitions import HARD_ERRORS, RESOURCE_LOCKED
 
-__all__ = ['HARD_ERRORS', 'RESOURCE_LOCKED', 'CoolAMQPError', 'ConnectionDead', 'AMQPError']
+__all__ = ['HARD_ERRORS', 'RESOURCE_LOCKED', 'CoolAMQPError', 'ConnectionDead', 'AMQPError',
+           'WindowFull', 'BufferFull']
 
 
 class CoolAMQPError(Exception):
@@ -17,6 +18,20 @@ class ConnectionDead(CoolAMQPError):
     """
 
 
+class WindowFull(CoolAMQPError):
+    """
+    Too many messages await confirmation by the broker, and there was no room
+    for another one in time. See coolamqp.attaches.InFlightWindow.
+    """
+
+
+class BufferFull(CoolAMQPError):
+    """
+    The connection is blocked (or content flow is stopped), and publisher's FrameBuffer
+    already holds back as many bytes as it may. See coolamqp.attaches.FrameBuffer.
+    """
+
+
 class AMQPError(CoolAMQPError):
     """
     Base class for errors received from AMQP server
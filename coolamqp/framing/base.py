@@ -88,6 +88,12 @@ class AMQPClass(object):
     __slots__ = ()
 
 
+class _Parts(list):
+    """A list that pretends to be a buffer, to be joined afterwards"""
+    __slots__ = ()
+    write = list.append
+
+
 class AMQPContentPropertyList(object):
     """
     A class is intmately bound with content and content properties.
@@ -95,11 +101,12 @@ class AMQPContentPropertyList(object):
     WARNING: BE PREPARED that if you receive a content from the network,
     string values will be memoryviews. Use .tobytes() to correct that.
     If YOU create a property list, they will be bytes all right.
+
+    Property lists are immutable, so they serialize themselves only once. Reusing
+    a property list to publish many messages costs only a buffer write per message.
     """
     PROPERTIES = []
-    __slots__ = ()
-
-    # todo they are immutable, so they could just serialize themselves...
+    __slots__ = ('_serialized', )
 
     def __str__(self):  # type: () -> str
         values = {}
@@ -136,6 +143,22 @@ class AMQPContentPropertyList(object):
 
     def write_to(self, buf):
         """Serialize itself (flags + values) to a buffer"""
+        buf.write(self.to_bytes())
+
+    def to_bytes(self):  # type: () -> bytes
+        """
+        Return flags + values, serialized. This is computed only once.
+        """
+        try:
+            return self._serialized
+        except AttributeError:
+            parts = _Parts()
+            self.serialize_to(parts)
+            self._serialized = b''.join(parts)
+            return self._serialized
+
+    def serialize_to(self, buf):
+        """Actually serialize itself (flags + values) to a buffer"""
         raise Exception(u'This is an abstract method')
 
     @staticmethod
@@ -155,7 +178,7 @@ class AMQPContentPropertyList(object):
 
         :return: int
         """
-        raise Exception(u'This is an abstract method')
+        return len(self.to_bytes())
 
 
 class AMQPMethodPayload(AMQPPayload):
@@ -0,0 +1,109 @@
+# coding=UTF-8
+"""
+Lazily produced body frames of messages with a StreamedBody.
+
+An AMQPBodyStream takes the place of body frames of such a message. It's passed by SendingFramer
+to the socket as-is, and the socket asks it for the next body frame only once it has sent the
+previous one, so just a single frame of the message is held in memory at a time.
+"""
+from __future__ import absolute_import, division, print_function
+
+import os
+import socket
+import typing as tp
+
+from coolamqp.framing.definitions import FRAME_BODY, FRAME_END_BYTE
+from coolamqp.framing.frames import STRUCT_BHL
+
+__all__ = ['AMQPBodyStream', 'FileSegment', 'BuffersWithStreams']
+
+
+class BuffersWithStreams(list):
+    """
+    A list of buffers to send, where some of the elements are AMQPBodyStreams.
+
+    :ivar streams: amount of AMQPBodyStreams in this list
+    """
+
+    def __init__(self, buffers=()):
+        list.__init__(self, buffers)
+        self.streams = 0
+
+
+class FileSegment(object):
+    """
+    A part of a file, to be sent by the socket straight from the file - with os.sendfile
+    if possible.
+    """
+    __slots__ = ('file', 'offset', 'count')
+
+    def __init__(self, file, offset, count):
+        """
+        :param file: a file object with a fileno()
+        :param offset: offset in the file
+        :param count: amount of bytes
+        """
+        self.file = file
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):  # type: () -> int
+        return self.count
+
+    def read(self):  # type: () -> bytes
+        """Read this segment, for sockets that can't sendfile"""
+        self.file.seek(self.offset)
+        data = self.file.read(self.count)
+        if len(data) != self.count:
+            raise ValueError(u'File is shorter than declared')
+        return data
+
+    def sendfile(self, sock):  # type: (socket.socket) -> int
+        """
+        Send as much of this segment as the socket will take.
+
+        :return: amount of bytes sent
+        """
+        sent = os.sendfile(sock.fileno(), self.file.fileno(), self.offset, self.count)
+        if not sent:
+            raise ValueError(u'File is shorter than declared')
+        return sent
+
+    def advance(self, sent):  # type: (int) -> None
+        """Mark that sent bytes from the beginning of this segment were sent"""
+        self.offset += sent
+        self.count -= sent
+
+
+class AMQPBodyStream(object):
+    """
+    Body frames of a message with a StreamedBody, produced on demand.
+
+    Not thread safe, it's to be used only by the socket.
+    """
+    __slots__ = ('channel', 'chunks', 'body')
+    FRAME_TYPE = FRAME_BODY
+
+    def __init__(self, channel, body, max_body_size):
+        """
+        :param channel: channel ID
+        :param body: a StreamedBody
+        :param max_body_size: maximum length of a frame's payload
+        """
+        self.channel = channel
+        self.body = body
+        self.chunks = body.iter_chunks(max_body_size)
+
+    def next_frame(self):  # type: () -> tp.Optional[list]
+        """
+        Return the next body frame, as a list of buffers (and maybe a FileSegment),
+        or None if there are no more.
+
+        :raise ValueError: the body turned out to be shorter or longer than declared
+        """
+        for chunk in self.chunks:
+            return [STRUCT_BHL.pack(FRAME_BODY, self.channel, len(chunk)), chunk, FRAME_END_BYTE]
+        return None
+
+    def __str__(self):  # type: () -> str
+        return 'AMQPBodyStream(%s, %s bytes)' % (self.channel, len(self.body))
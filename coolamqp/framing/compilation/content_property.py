@@ -7,8 +7,8 @@ from coolamqp.framing.field_table import deframe_table, frame_table_size, enfram
 import six
 import struct
 import logging
-from coolamqp.framing.compilation.textcode_fields import get_counter, \
-    get_from_buffer, get_serializer
+from coolamqp.framing.compilation.textcode_fields import get_from_buffer, \
+    get_serializer
 
 logger = logging.getLogger(__name__)
 
@@ -29,13 +29,12 @@ ZPF_S = u'''
 '''
 NB = u"raise NotImplementedError('I don't support bits in properties')"
 INTER_X = u'    * %s::%s'
-BUF_WRITE_A = u'\n    def write_to(self, buf):\n        buf.write('
+BUF_WRITE_A = u'\n    def serialize_to(self, buf):\n        buf.write('
 RESERVED = u' (reserved)'
 UNICO = u"u'%s'"
 SPACER = u'''
     """
 '''
-GET_SIZE_HEADER = u'\n    def get_size(self):\n'
 
 
 def _compile_particular_content_property_list_class(zpf, fields):
@@ -136,11 +135,7 @@ def _compile_particular_content_property_list_class(zpf, fields):
     mod.append(line)
     mod.append(u'        return cls(%s)\n' % (FFN,))
 
-    # get_size
-    mod.append(GET_SIZE_HEADER)
-    mod.append(get_counter(present_fields, prefix=u'self.', indent_level=2)[
-               :-1])  # skip eol
-    mod.append(u' + %s\n' % (zpf_length,))  # account for pf length
+    # get_size and write_to are inherited, they use serialize_to just once
     return u''.join(mod), structers
 
 
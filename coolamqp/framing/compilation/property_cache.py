@@ -0,0 +1,134 @@
+# coding=UTF-8
+"""
+Ahead-of-time cache of particular content property list classes.
+
+A particular class is compiled the first time a combination of properties (property flags)
+is seen, which makes the first message of each kind slow. This allows you to compile them
+in advance, either for combinations that you declare, or for combinations that were seen
+by a previous run and saved to a file.
+
+Only the property flags are saved, and the classes are compiled anew from them when loading,
+so the file never contains code.
+"""
+from __future__ import absolute_import, division, print_function
+
+import atexit
+import binascii
+import io
+import json
+import logging
+import os
+
+from coolamqp.framing.compilation.content_property import \
+    compile_particular_content_property_list_class
+
+logger = logging.getLogger(__name__)
+
+ENVIRONMENT_VARIABLE = 'COOLAMQP_PROPERTY_CACHE'
+
+
+def _get_property_list_classes():
+    from coolamqp.framing.definitions import CLASS_ID_TO_CONTENT_PROPERTY_LIST
+    return dict((cls.__name__, cls) for cls in CLASS_ID_TO_CONTENT_PROPERTY_LIST.values())
+
+
+def warm_up(property_list_class, *field_sets):
+    """
+    Compile particular classes for given combinations of properties.
+
+    >>> warm_up(BasicContentPropertyList, ('content_type', ), ('content_type', 'headers'))
+
+    :param property_list_class: eg. BasicContentPropertyList
+    :param field_sets: iterables of property names, as you would pass them to typize
+    """
+    for fields in field_sets:
+        property_list_class.typize(*fields)
+
+
+def save(path):  # type: (str) -> None
+    """
+    Save combinations of properties of all particular classes compiled so far to a file.
+
+    The file is replaced atomically, so it's safe for many processes to save to the same file.
+
+    :param path: path to the file
+    """
+    data = {'classes': {}}
+    for name, cls in _get_property_list_classes().items():
+        data['classes'][name] = [binascii.hexlify(zpf).decode('ascii')
+                                 for zpf in cls.PARTICULAR_CLASSES]
+
+    temp_path = '%s.%s' % (path, os.getpid())
+    with io.open(temp_path, 'wb') as f:
+        f.write(json.dumps(data, indent=1).encode('utf-8'))
+    if hasattr(os, 'replace'):
+        os.replace(temp_path, path)
+    else:  # Python 2, where rename can't replace a file on Windows
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(temp_path, path)
+
+
+def load(path):  # type: (str) -> int
+    """
+    Compile particular classes for combinations of properties saved by save().
+
+    A cache that can't be read is ignored, and so are entries that are not valid property
+    flags, with a warning logged.
+
+    :param path: path to the file
+    :return: amount of classes compiled
+    """
+    try:
+        with io.open(path, 'rb') as f:
+            data = json.loads(f.read().decode('utf-8'))
+    except (IOError, OSError, ValueError) as e:
+        logger.warning('Could not read property class cache %s: %s', path, e)
+        return 0
+
+    classes = _get_property_list_classes()
+    loaded = 0
+    for name, entries in data.get('classes', {}).items():
+        try:
+            property_list_class = classes[name]
+        except KeyError:
+            continue
+
+        for entry in entries:
+            try:
+                zpf = binascii.unhexlify(entry)
+                if zpf in property_list_class.PARTICULAR_CLASSES:
+                    continue
+                particular = compile_particular_content_property_list_class(
+                    zpf, property_list_class.FIELDS)
+            except Exception as e:
+                logger.warning('Invalid entry %s in property class cache %s: %s', repr(entry),
+                               path, repr(e))
+                continue
+            property_list_class.PARTICULAR_CLASSES[zpf] = particular
+            loaded += 1
+
+    logger.debug('Loaded %s property classes from %s', loaded, path)
+    return loaded
+
+
+def load_from_environment():
+    """
+    If COOLAMQP_PROPERTY_CACHE is set, load the cache from there and save it back at exit.
+
+    Call it at start of your program, before you create a Cluster.
+    """
+    path = os.environ.get(ENVIRONMENT_VARIABLE)
+    if not path:
+        return
+
+    if os.path.exists(path):
+        load(path)
+    atexit.register(_save_at_exit, path)
+
+
+def _save_at_exit(path):
+    try:
+        save(path)
+    except (IOError, OSError) as e:
+        logger.warning('Could not save property class cache %s: %s', path, e)
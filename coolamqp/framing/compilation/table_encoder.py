@@ -0,0 +1,132 @@
+# coding=UTF-8
+"""
+Generate encoders of field-tables for a particular schema.
+
+A schema (signature) is a tuple of (name, type of value) for every field of the table,
+in order. Most producers send the same headers with every message, so an encoder is
+compiled once per signature, and then reused.
+"""
+from __future__ import absolute_import, division, print_function
+
+import logging
+import struct
+import typing as tp
+
+import six
+
+from coolamqp.framing.field_table import get_type_for, FIELD_TYPES
+
+logger = logging.getLogger(__name__)
+
+MAX_ENCODERS = 256  # don't compile more encoders than this, fall back to argumentify instead
+MAX_FIELDS = 255  # Python 2 won't compile a function with more arguments
+
+STRUCT_I = struct.Struct('!I')
+STRUCT_Bd = struct.Struct('!Bd')
+STRUCT_BI = struct.Struct('!BI')
+STRUCT_B_ = struct.Struct('!B?')
+
+INT_STRUCTS = dict((field_type, struct.Struct('!B' + FIELD_TYPES[field_type][1][1:]))
+                   for field_type in 'bBuUiIl')
+
+ENCODERS = {}  # type: tp.Dict[tuple, tp.Callable[..., bytes]]
+
+DEF_ENCODE = u'def encode_table(%s):\n'
+ENCODE_TEXT = u'    v%s = v%s.encode(\'utf-8\')\n'
+JOIN = u'    data = b\'\'.join((%s))\n'
+RETURN = u'    return STRUCT_I.pack(len(data)) + data\n'
+
+
+def frame_int(value):  # type: (int) -> bytes
+    """Return a field-value for an int, of the same type that get_type_for would pick"""
+    field_type = get_type_for(value)
+    return INT_STRUCTS[field_type].pack(ord(field_type), value)
+
+
+def _compile_table_encoder(signature):
+    """
+    :param signature: tuple of (name, type of value)
+    :return: source of encode_table(*values) -> bytes, or None if the signature contains
+        a type that is not supported
+    """
+    if len(signature) > MAX_FIELDS:
+        return None
+
+    mod = [DEF_ENCODE % (u', '.join(u'v%s' % (i,) for i in range(len(signature))),)]
+    parts = []
+    for i, (name, value_type) in enumerate(signature):
+        if not isinstance(name, six.binary_type):
+            name = name.encode('utf-8')
+        if len(name) > 255:
+            return None
+
+        parts.append(repr(six.int2byte(len(name)) + name))
+
+        if value_type is bool:
+            parts.append(u'STRUCT_B_.pack(%s, v%s)' % (ord('t'), i))
+        elif value_type is float:
+            parts.append(u'STRUCT_Bd.pack(%s, v%s)' % (ord('d'), i))
+        elif value_type is int:
+            parts.append(u'frame_int(v%s)' % (i,))
+        elif value_type in (six.binary_type, six.text_type):
+            if value_type is six.text_type:
+                mod.append(ENCODE_TEXT % (i, i))
+            parts.append(u'STRUCT_BI.pack(%s, len(v%s))' % (ord('S'), i))
+            parts.append(u'v%s' % (i,))
+        else:
+            return None
+
+    mod.append(JOIN % (u''.join(part + u', ' for part in parts), ))
+    mod.append(RETURN)
+    return u''.join(mod)
+
+
+def compile_table_encoder(signature):
+    """
+    Return an encoder for given table signature, compiling it if it wasn't seen before.
+
+    :param signature: tuple of (name, type of value)
+    :return: callable(*values) -> bytes, that returns the table as it goes on the wire
+        (including it's length). None if the signature is not supported or too many
+        signatures were seen already.
+    """
+    try:
+        return ENCODERS[signature]
+    except KeyError:
+        pass
+
+    if len(ENCODERS) >= MAX_ENCODERS:
+        return None
+
+    source = _compile_table_encoder(signature)
+    if source is None:
+        ENCODERS[signature] = None  # so that we don't try again
+        return None
+
+    logger.debug('Table signature %s not seen yet, compiling', signature)
+    loc = {
+        'STRUCT_I': STRUCT_I,
+        'STRUCT_Bd': STRUCT_Bd,
+        'STRUCT_BI': STRUCT_BI,
+        'STRUCT_B_': STRUCT_B_,
+        'frame_int': frame_int,
+    }
+    exec(source, loc)
+    encoder = ENCODERS[signature] = loc['encode_table']
+    return encoder
+
+
+def encode_table(table):  # type: (dict) -> tp.Optional[bytes]
+    """
+    Encode a dict as a field-table, using a compiled encoder.
+
+    Names may be text or bytes. Values may be text, bool, int or float.
+
+    :return: encoded table, including it's length, or None if this table can't be encoded
+        this way (use argumentify and enframe_table then)
+    """
+    signature = tuple((name, type(value)) for name, value in table.items())
+    encoder = compile_table_encoder(signature)
+    if encoder is None:
+        return None
+    return encoder(*table.values())
@@ -16,6 +16,8 @@ NOTE: it's not buffers, it's memoryview all along
 
 import struct
 import io
+import typing as tp
+
 import six
 
 
@@ -135,7 +137,7 @@ def get_type_for(val):
         return 'd'
     elif isinstance(val, (tuple, list)):
         return 'A'
-    elif isinstance(val, dict):
+    elif isinstance(val, (dict, FieldTableView)):
         return 'F'
     else:
         raise ValueError('I have zero idea what you have just passed')
@@ -180,7 +182,7 @@ def deframe_array(buf, offset):
     offset += 4
 
     values = []
-    while offset < (start_offset + 1 + ln):
+    while offset < (start_offset + 4 + ln):
         vt, delta = deframe_field_value(buf, offset)
         v, t = vt
         offset += delta
@@ -209,6 +211,9 @@ def enframe_table(buf, table):  # type (tp.BinaryIO, table) -> None
     """
     if isinstance(table, tuple) and len(table) > 1 and table[1] == 'F':        # Todo: fix an ugly hack
         table = table[0]
+    if isinstance(table, FieldTableView):
+        table.write_to(buf)
+        return
     _tobuf(buf, '!I', frame_table_size(table) - 4)
     for name, fv in table:
         _tobufv(buf, name, '!B', len(name))
@@ -266,8 +271,179 @@ def frame_table_size(table):
     if isinstance(table, tuple) and len(table) == 2:
         table = table[0]
         # todo: fix this hack
+    if isinstance(table, FieldTableView):
+        return table.get_size()
     return 4 + sum(1 + len(k) + frame_field_value_size(fv) for k, fv in table)
 
 
+STRUCT_B = struct.Struct('!B')
+STRUCT_I = struct.Struct('!I')
+
+
+class FieldTableView(object):
+    """
+    A read-only view of a field-table, as received from the network.
+
+    It behaves like the table it stands for - a list of (name, field-value) tuples, where
+    names are bytes and field-values are (value, type) tuples - so you can iterate over it,
+    index it and compare it to a list. Additionally, it can be used like a read-only dict:
+    view[name] returns the field-value of a name (you can pass text names as well), and
+    there are get(), keys(), values() and items(), so dict(view) maps names to field-values.
+
+    Nothing is decoded until you ask for it. On first access, names are read and offsets
+    of their values are noted, but no value is decoded. A value is decoded only when you
+    look it up (and then it's cached). Nested tables are FieldTableViews as well.
+
+    It can be used as a table when sending, in which case the original bytes are copied.
+    Call dict() or list() on it if you need a copy that doesn't refer to the received buffer.
+    """
+    __slots__ = ('buf', 'offset', 'length', 'fields', 'index', 'decoded')
+
+    def __init__(self, buf, offset):
+        """
+        :param buf: buffer containing the table
+        :param offset: offset of the table, that is, of it's length
+        """
+        self.buf = buf
+        self.offset = offset
+        self.length, = struct.unpack_from('!L', buf, offset)
+        self.fields = None  # (name, offset of it's field-value) in order, filled in on first access
+        self.index = None  # name -> offset of it's field-value
+        self.decoded = {}  # offset -> decoded field-value
+
+    def _build_index(self):
+        buf = self.buf
+        offset = self.offset + 4
+        end = offset + self.length
+
+        unpack_b = STRUCT_B.unpack_from
+        unpack_i = STRUCT_I.unpack_from
+        lengths = FIELD_LENGTHS
+        is_view = isinstance(buf, memoryview)
+
+        fields = []
+        while offset < end:
+            ln, = unpack_b(buf, offset)
+            name = buf[offset + 1:offset + 1 + ln]
+            if is_view:
+                name = name.tobytes()
+            offset += 1 + ln
+            fields.append((name, offset))
+
+            # skip the field-value
+            field_type, = unpack_b(buf, offset)
+            try:
+                length = lengths[field_type]
+            except KeyError:
+                raise ValueError('Unknown field type %s!', (repr(chr(field_type)),))
+            if length is not None:
+                offset += 1 + length
+            elif field_type == ORD_SHORTSTR:
+                offset += 2 + unpack_b(buf, offset + 1)[0]
+            else:
+                offset += 5 + unpack_i(buf, offset + 1)[0]
+
+        if offset > end:
+            raise ValueError(
+                'Table turned out longer than expected! Found %s bytes expected %s',
+                (offset - self.offset, self.length))
+
+        self.fields = fields
+        self.index = dict(fields)
+
+    def _decode(self, offset):
+        try:
+            return self.decoded[offset]
+        except KeyError:
+            pass
+
+        if chrpy3(self.buf[offset]) == 'F':
+            fv = FieldTableView(self.buf, offset + 1), 'F'
+        else:
+            fv = deframe_field_value(self.buf, offset)[0]
+        self.decoded[offset] = fv
+        return fv
+
+    def __getitem__(self, key):
+        """
+        :param key: a name, to return it's field-value, or an index or a slice, to return
+            (name, field-value) tuples, as if this was a list
+        """
+        if self.index is None:
+            self._build_index()
+
+        if isinstance(key, (six.integer_types, slice)):
+            if isinstance(key, slice):
+                return [(name, self._decode(offset)) for name, offset in self.fields[key]]
+            name, offset = self.fields[key]
+            return name, self._decode(offset)
+
+        if not isinstance(key, six.binary_type):
+            key = key.encode('utf-8')
+        return self._decode(self.index[key])
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __contains__(self, item):
+        """:param item: a name, or a (name, field-value) tuple, as if this was a list"""
+        if isinstance(item, tuple):
+            return item in self.items()
+        if not isinstance(item, six.binary_type):
+            item = item.encode('utf-8')
+        if self.index is None:
+            self._build_index()
+        return item in self.index
+
+    def __iter__(self):
+        return iter(self.items())
+
+    def __len__(self):
+        if self.index is None:
+            self._build_index()
+        return len(self.fields)
+
+    def keys(self):  # type: () -> tp.List[bytes]
+        if self.index is None:
+            self._build_index()
+        return [name for name, _ in self.fields]
+
+    def values(self):  # type: () -> tp.List[tp.Tuple[tp.Any, str]]
+        return [fv for _, fv in self.items()]
+
+    def items(self):  # type: () -> tp.List[tp.Tuple[bytes, tp.Tuple[tp.Any, str]]]
+        return self[:]
+
+    def __eq__(self, other):
+        if isinstance(other, FieldTableView):
+            return self.items() == other.items()
+        elif isinstance(other, (list, tuple)):
+            return self.items() == list(other)
+        elif isinstance(other, dict):
+            return dict(self) == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '<FieldTableView %s>' % (self.items(), )
+
+    def write_to(self, buf):
+        buf.write(self.buf[self.offset:self.offset + 4 + self.length])
+
+    def get_size(self):  # type: () -> int
+        return 4 + self.length
+
+
 FIELD_TYPES['A'] = (None, None, enframe_array, deframe_array, frame_array_size)
 FIELD_TYPES['F'] = (None, None, enframe_table, deframe_table, frame_table_size)
+
+FIELD_LENGTHS = dict((ord(field_type), opt[0]) for field_type, opt in FIELD_TYPES.items())
+ORD_SHORTSTR = ord('s')
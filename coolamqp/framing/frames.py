@@ -12,6 +12,7 @@ from coolamqp.framing.base import AMQPFrame
 from coolamqp.framing.definitions import FRAME_METHOD, FRAME_HEARTBEAT, \
     FRAME_BODY, FRAME_HEADER, FRAME_END, \
     IDENT_TO_METHOD, CLASS_ID_TO_CONTENT_PROPERTY_LIST, FRAME_END_BYTE
+from coolamqp.framing.lazy_properties import LazyContentPropertyList
 
 STRUCT_BH = struct.Struct('!BH')
 STRUCT_BHL = struct.Struct('!BHL')
@@ -99,8 +100,8 @@ class AMQPHeaderFrame(AMQPFrame):
     def unserialize(channel, payload_as_buffer):
         # payload starts with class ID
         class_id, weight, body_size = STRUCT_HHQ.unpack_from(payload_as_buffer, 0)
-        properties = CLASS_ID_TO_CONTENT_PROPERTY_LIST[class_id].from_buffer(
-            payload_as_buffer, 12)
+        properties = LazyContentPropertyList(CLASS_ID_TO_CONTENT_PROPERTY_LIST[class_id],
+                                             payload_as_buffer, 12)
         return AMQPHeaderFrame(channel, class_id, weight, body_size,
                                properties)
 
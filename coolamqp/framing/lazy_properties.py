@@ -0,0 +1,152 @@
+# coding=UTF-8
+"""
+Content property lists received from the network, that decode themselves on demand
+"""
+from __future__ import absolute_import, division, print_function
+
+import struct
+import typing as tp
+
+from coolamqp.framing.base import AMQPContentPropertyList, BASIC_TYPES
+from coolamqp.framing.compilation.utilities import format_field_name
+from coolamqp.framing.field_table import FieldTableView
+
+STRUCT_B = struct.Struct('!B')
+STRUCT_H = struct.Struct('!H')
+STRUCT_L = struct.Struct('!L')
+
+STRUCTS = dict((basic_type, struct.Struct('!' + fmt))
+               for basic_type, (length, fmt, _, _) in BASIC_TYPES.items()
+               if length is not None)
+
+FIELDS_OF = {}  # type: tp.Dict[type, tp.List[tp.Tuple[str, str, bool]]]
+
+
+def get_fields(property_list_class):
+    """
+    :param property_list_class: eg. BasicContentPropertyList
+    :return: a list of (field name, basic type, is reserved)
+    """
+    try:
+        return FIELDS_OF[property_list_class]
+    except KeyError:
+        fields = []
+        for field in property_list_class.FIELDS:
+            if field.basic_type == u'bit':
+                raise NotImplementedError(u'I don\'t support bits in properties')
+            fields.append((str(format_field_name(field.name)), field.basic_type, field.reserved))
+        FIELDS_OF[property_list_class] = fields
+        return fields
+
+
+class LazyContentPropertyList(AMQPContentPropertyList):
+    """
+    A content property list, as received in a content header frame.
+
+    It keeps the received buffer, and walks property flags only on first attribute access.
+    Then every property is decoded when it's accessed for the first time. If you never touch
+    the properties (eg. you route by routing key), you never pay for decoding them. Tables
+    (such as headers) are returned as FieldTableView, that decode only the fields you look up.
+
+    Missing properties raise AttributeError, just like they do in an eagerly decoded property list.
+
+    Serializing it back (eg. when you republish a received message with it's properties)
+    just copies the received bytes.
+    """
+    __slots__ = ('property_list_class', 'buf', 'offset', 'index', 'values')
+
+    def __init__(self, property_list_class, buf, offset):
+        """
+        :param property_list_class: class of the property list, eg. BasicContentPropertyList
+        :param buf: buffer that contains the property list, starting at offset and ending
+            at it's end
+        :param offset: offset at which property flags start
+        """
+        self.property_list_class = property_list_class
+        self.buf = buf
+        self.offset = offset
+        self.index = None  # field name -> (offset, basic type), filled in on first access
+        self.values = {}  # field name -> decoded value
+
+    def _build_index(self):
+        buf = self.buf
+        offset = self.offset
+
+        flags = []
+        while True:
+            flag_word, = STRUCT_H.unpack_from(buf, offset)
+            offset += 2
+            flags.append(flag_word)
+            if not flag_word & 1:
+                break
+
+        index = {}
+        for i, (name, basic_type, reserved) in enumerate(get_fields(self.property_list_class)):
+            # 15 fields per 16-bit word, the last bit signals continuation
+            if i // 15 >= len(flags) or not flags[i // 15] & (1 << (15 - i % 15)):
+                continue
+
+            if not reserved:
+                index[name] = offset, basic_type
+
+            length = BASIC_TYPES[basic_type][0]
+            if length is None:
+                if basic_type == u'shortstr':
+                    length = 1 + STRUCT_B.unpack_from(buf, offset)[0]
+                else:  # longstr or table
+                    length = 4 + STRUCT_L.unpack_from(buf, offset)[0]
+            offset += length
+
+        self.index = index
+
+    def _decode(self, offset, basic_type):
+        buf = self.buf
+        if basic_type == u'shortstr':
+            length, = STRUCT_B.unpack_from(buf, offset)
+            return buf[offset + 1:offset + 1 + length]
+        elif basic_type == u'longstr':
+            length, = STRUCT_L.unpack_from(buf, offset)
+            return buf[offset + 4:offset + 4 + length]
+        elif basic_type == u'table':
+            return FieldTableView(buf, offset)
+        else:
+            return STRUCTS[basic_type].unpack_from(buf, offset)[0]
+
+    def __getattr__(self, name):
+        if name in LazyContentPropertyList.__slots__ or name.startswith('__'):
+            raise AttributeError(name)  # not initialized yet, eg. during unpickling
+
+        try:
+            return self.values[name]
+        except KeyError:
+            pass
+
+        if self.index is None:
+            self._build_index()
+
+        try:
+            offset, basic_type = self.index[name]
+        except KeyError:
+            raise AttributeError(name)
+
+        value = self.values[name] = self._decode(offset, basic_type)
+        return value
+
+    def __str__(self):  # type: () -> str
+        if self.index is None:
+            self._build_index()
+        values = dict((name, getattr(self, name)) for name in self.index)
+        return '<AMQPContentPropertyList (%s)>' % (values, )
+
+    def write_to(self, buf):
+        buf.write(self.buf[self.offset:])
+
+    def serialize_to(self, buf):
+        buf.write(self.buf[self.offset:])
+
+    def to_bytes(self):  # type: () -> bytes
+        data = self.buf[self.offset:]
+        return data.tobytes() if isinstance(data, memoryview) else bytes(data)
+
+    def get_size(self):  # type: () -> int
+        return len(self.buf) - self.offset
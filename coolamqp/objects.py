@@ -2,7 +2,10 @@
 """
 Core objects used in CoolAMQP
 """
+import functools
 import logging
+import os
+import stat
 import threading
 import typing as tp
 import uuid
@@ -11,7 +14,10 @@ import warnings
 import six
 
 from coolamqp.argumentify import argumentify, tobytes, toutf8
+from coolamqp.framing.body_stream import FileSegment
+from coolamqp.framing.compilation.table_encoder import encode_table
 from coolamqp.framing.definitions import BasicContentPropertyList
+from coolamqp.framing.field_table import FieldTableView
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +34,8 @@ class MessageProperties(BasicContentPropertyList):
         :param content_encoding: MIME content encoding
         :type content_encoding: binary type (max length 255) (AMQP as shortstr)
         :param headers: message header field table. You can pass a dictionary here safely.
+            If it contains only text, bool, int and float values, it will be encoded right
+            away, with an encoder compiled for it's keys and types of values.
         :type headers: table. See coolamqp.uplink.framing.field_table (AMQP as table)
         :param delivery_mode: non-persistent (1) or persistent (2)
         :type delivery_mode: int, 8 bit unsigned (AMQP as octet)
@@ -54,7 +62,11 @@ class MessageProperties(BasicContentPropertyList):
         """
         if 'headers' in kwargs:
             if isinstance(kwargs['headers'], dict):
-                kwargs['headers'] = argumentify(kwargs['headers'])
+                encoded = encode_table(kwargs['headers'])
+                if encoded is None:
+                    kwargs['headers'] = argumentify(kwargs['headers'])
+                else:
+                    kwargs['headers'] = FieldTableView(encoded, 0)
         return BasicContentPropertyList.__new__(cls, *args, **kwargs)
 
 
@@ -77,6 +89,12 @@ class Callable(object):
     def add(self, clbl):
         self.callables.append(clbl)
 
+    def remove(self, clbl):
+        """Stop calling clbl. Does nothing if it wasn't added."""
+        with self.lock:
+            if clbl in self.callables:
+                self.callables.remove(clbl)
+
     def __call__(self, *args, **kwargs):
         with self.lock:
             for clbl in self.callables:
@@ -129,6 +147,132 @@ class Message(object):
             self.properties = properties
 
 
+class StreamedBody(object):
+    """
+    A body of a message to publish, that is read only as it's being sent, so that it doesn't
+    have to be held in memory. Pass it as body of a Message.
+
+    It can be read from:
+
+        - a file object. If it's a regular file, it will be sent with os.sendfile if possible.
+          The body starts at file's current position. It must not be read by anything else
+          until the message is sent.
+        - a bytes-like object, eg. an mmap. It's sent straight from it.
+        - an iterable of bytes-like objects. length must be given then.
+
+    length is the amount of bytes to send. By default, it's all of the bytes-like object,
+    or the rest of the file. If the body turns out to be shorter or longer than that, the
+    connection will have to be closed!
+
+    A message with a StreamedBody can be published only once.
+
+    :param source: a file object, a bytes-like object or an iterable of bytes-like objects
+    :param length: length of the body
+    :raise ValueError: length is needed, but was not given
+    """
+    __slots__ = ('source', 'length', 'offset')
+
+    def __init__(self, source, length=None):
+        self.source = source
+        self.offset = None  # position of body in a file
+
+        try:
+            view = memoryview(source)
+        except TypeError:
+            view = None
+
+        if view is not None:
+            source = self.source = view
+            if length is None:
+                length = view.nbytes
+        elif hasattr(source, 'read'):
+            try:
+                self.offset = source.tell()
+                if length is None:
+                    length = os.fstat(source.fileno()).st_size - self.offset
+            except (AttributeError, IOError, OSError, ValueError):
+                if length is None:
+                    raise ValueError(u'length is needed for files that are not regular')
+        elif length is None:
+            raise ValueError(u'length is needed for iterables')
+
+        self.length = length  # type: int
+
+    def __len__(self):  # type: () -> int
+        return self.length
+
+    def iter_chunks(self, max_size):  # type: (int) -> tp.Iterator
+        """
+        Yield the body in chunks no longer than max_size.
+
+        A chunk is a bytes-like object, or a FileSegment.
+
+        :raise ValueError: the body is shorter or longer than declared
+        """
+        source = self.source
+        if isinstance(source, memoryview):
+            if source.format != 'B':
+                source = source.cast('B')
+            if len(source) < self.length:
+                raise ValueError(u'Body is shorter than declared')
+            for offset in six.moves.range(0, self.length, max_size):
+                yield source[offset:min(offset + max_size, self.length)]
+            return
+
+        remaining = self.length
+        if hasattr(source, 'read'):
+            if self.offset is not None and _is_regular_file(source):
+                offset = self.offset
+                while remaining:
+                    count = min(remaining, max_size)
+                    yield FileSegment(source, offset, count)
+                    offset += count
+                    remaining -= count
+                return
+
+            while remaining:
+                data = source.read(min(remaining, max_size))
+                if not data:
+                    raise ValueError(u'Body is shorter than declared')
+                remaining -= len(data)
+                yield data
+            return
+
+        # short chunks are joined, so that frames are not needlessly small
+        pending = bytearray()
+        for chunk in source:
+            chunk = memoryview(chunk)
+            remaining -= len(chunk)
+            if remaining < 0:
+                raise ValueError(u'Body is longer than declared')
+
+            if pending:
+                taken = max_size - len(pending)
+                pending += chunk[:taken]
+                chunk = chunk[taken:]
+                if len(pending) < max_size:
+                    continue
+                yield bytes(pending)
+                pending = bytearray()
+
+            while len(chunk) >= max_size:
+                yield chunk[:max_size]
+                chunk = chunk[max_size:]
+            pending += chunk
+
+        if remaining:
+            raise ValueError(u'Body is shorter than declared')
+        if pending:
+            yield bytes(pending)
+
+
+def _is_regular_file(file):  # type: (tp.Any) -> bool
+    try:
+        return stat.S_ISREG(os.fstat(file.fileno()).st_mode)
+    except (AttributeError, IOError, OSError, ValueError):
+        return False
+
+
 def LAMBDA_NONE():
     pass
 
@@ -152,9 +296,13 @@ class ReceivedMessage(Message):
                        strings will be memoryviews
     :param delivery_tag: delivery tag assigned by AMQP broker to confirm
         this message
+    :param ack: callable/0 to call on ack()
+    :param nack: callable/0 to call on nack()
+    :param receiver: MessageReceiver that received this message. Used by CoolAMQP
+        instead of ack and nack, so that no closures need to be made for every message.
     """
     __slots__ = ('delivery_tag', 'exchange_name', 'routing_key', '_ack', '_nack',
-                 'acked')
+                 '_receiver', 'acked')
 
     def __init__(self, body,  # type: tp.Union[str, bytes, bytearray, tp.List[memoryview]]
                  exchange_name,  # type: memoryview
@@ -162,16 +310,23 @@ class ReceivedMessage(Message):
                  properties=None,
                  delivery_tag=None,  # type: int
                  ack=None,  # type: tp.Callable[[], None]
-                 nack=None  # type: tp.Callable[[], None]
+                 nack=None,  # type: tp.Callable[[], None]
+                 receiver=None
                  ):
-        Message.__init__(self, body, properties=properties)
+        if receiver is None:
+            Message.__init__(self, body, properties=properties)
+            self._ack = ack or LAMBDA_NONE
+            self._nack = nack or LAMBDA_NONE
+        else:
+            # received bodies and property lists need no checking
+            self.body = body
+            self.properties = properties
 
         self.delivery_tag = delivery_tag
         self.exchange_name = exchange_name
         self.routing_key = routing_key
         self.acked = False
-        self._ack = ack or LAMBDA_NONE
-        self._nack = nack or LAMBDA_NONE
+        self._receiver = receiver
 
     def ack(self):
         """
@@ -183,7 +338,10 @@ class ReceivedMessage(Message):
         """
         if self.acked:
             return
-        self._ack()
+        if self._receiver is None:
+            self._ack()
+        else:
+            self._receiver.settle(self.delivery_tag, True)
         self.acked = True
 
     def nack(self):
@@ -197,9 +355,51 @@ class ReceivedMessage(Message):
         """
         if self.acked:
             return
-        self._nack()
+        if self._receiver is None:
+            self._nack()
+        else:
+            self._receiver.settle(self.delivery_tag, False)
         self.acked = True
 
+    def __getattr__(self, name):
+        # _ack and _nack of messages constructed with a receiver are made only when asked for
+        if name in ('_ack', '_nack'):
+            receiver = self._receiver
+            if receiver is not None:
+                return functools.partial(receiver.settle, self.delivery_tag, name == '_ack')
+        raise AttributeError(name)
+
+
+class MessageBatch(list):
+    """
+    A list of ReceivedMessages, passed to Consumer's on_messages.
+
+    ack() and nack() settle all of them at once. If all messages delivered before them
+    were settled already, a single basic.ack (or basic.nack) with multiple set is sent.
+    """
+    __slots__ = ()
+
+    def ack(self):  # type: () -> None
+        """Acknowledge all messages that were not acked or nacked yet"""
+        self._settle(True)
+
+    def nack(self):  # type: () -> None
+        """Negatively acknowledge all messages that were not acked or nacked yet"""
+        self._settle(False)
+
+    def _settle(self, success):  # type: (bool) -> None
+        messages = [message for message in self if not message.acked]
+        if not messages:
+            return
+        for message in messages:
+            message.acked = True
+        receiver = messages[0]._receiver
+        if receiver is not None:
+            receiver.settle_many([message.delivery_tag for message in messages], success)
+        else:
+            for message in messages:
+                (message._ack if success else message._nack)()
+
 
 class Exchange(object):
     """
@@ -247,6 +447,27 @@ class Exchange(object):
 Exchange.direct = Exchange()
 
 
+def exchange_and_routing_key(exchange, routing_key):
+    # type: (tp.Union[Exchange, str, bytes, None], tp.Union[str, bytes]) -> tp.Tuple[bytes, bytes]
+    """
+    Turn an exchange and a routing key, as given to the publishing functions, into bytes.
+
+    :param exchange: an Exchange, it's name (as bytes or str), or None for the default exchange
+    :param routing_key: routing key as bytes or str
+    :return: a tuple of (exchange name, routing key)
+    """
+    if isinstance(exchange, Exchange):
+        exchange = exchange.name.encode('utf8')
+    elif exchange is None:
+        exchange = b''
+    elif isinstance(exchange, six.text_type):
+        exchange = exchange.encode('utf8')
+
+    if isinstance(routing_key, six.text_type):
+        routing_key = routing_key.encode('utf8')
+    return exchange, routing_key
+
+
 class ServerProperties(object):
     """
     An object describing properties of the target server.
@@ -1,65 +1,68 @@
 # coding=UTF-8
 from __future__ import absolute_import, division, print_function
 
-import collections
+import itertools
 import logging
 import socket
 import time
 import typing as tp
 import uuid
 
+import six
+
 import coolamqp.argumentify
 from coolamqp.utils import monotonic
 
 from coolamqp.exceptions import ConnectionDead
 from coolamqp.framing.base import AMQPMethodPayload
-from coolamqp.framing.definitions import ConnectionClose, ConnectionCloseOk
+from coolamqp.framing.definitions import ConnectionClose, ConnectionCloseOk, \
+    FRAME_METHOD
 from coolamqp.framing.frames import AMQPMethodFrame
 from coolamqp.objects import Callable
 from coolamqp.uplink.connection.recv_framer import ReceivingFramer
 from coolamqp.uplink.connection.send_framer import SendingFramer
 from coolamqp.uplink.connection.states import ST_ONLINE, ST_OFFLINE, \
     ST_CONNECTING
-from coolamqp.uplink.connection.watches import MethodWatch
+from coolamqp.uplink.connection.watches import MethodWatch, FAIL_ONLY
 from coolamqp.uplink.handshake import Handshaker
 
 logger = logging.getLogger(__name__)
 
 
-def alert_watches(watches, trigger):
+def alert_watches(watches, frame):
     """
-    Notify all watches in this collection.
+    Notify watches from given list about a frame, in the order they were registered in.
+
+    Watches that are not going to fire anymore (fired oneshots and cancelled ones) are removed
+    from the list. Fired oneshots are marked as cancelled, since they might linger on other
+    lists. Watches appended to the list while this runs won't be notified about this frame.
 
-    Return a list of alive watches.
     :param watches: list of Watch
-    :return: tuple of (list of Watch, bool - was any watch fired?)
+    :param frame: AMQPFrame
+    :return: bool - was any watch fired?
     """
     watch_handled = False
-    alive_watches = []
-    while len(watches) > 0:
-        watch = watches.pop()
-
-        if watch.cancelled:
-            continue
-
-        watch_triggered = watch.is_triggered_by(trigger)
-        watch_handled |= watch_triggered
-
-        if watch.cancelled:
-            continue
-
-        if not any((watch_triggered, watch.oneshot, watch.cancelled)):
-            # Watch remains alive if it was NOT triggered, or it's NOT a oneshot or it's not cancelled
-            alive_watches.append(watch)
-        elif not watch.oneshot and not watch.cancelled:
-            alive_watches.append(watch)
-        elif watch.oneshot and not watch_triggered:
-            alive_watches.append(watch)
+    dead_watches = None
+    # the list is not copied - watches appended meanwhile are past it's current length
+    for watch in itertools.islice(watches, len(watches)):
+        if not watch.cancelled:
+            if watch.is_triggered_by(frame):
+                watch_handled = True
+                if watch.oneshot:
+                    watch.cancelled = True
+            if not watch.cancelled:
+                continue
+        if dead_watches is None:
+            dead_watches = []
+        dead_watches.append(watch)
 
-    if set(alive_watches) != set(watches):
-        for removed_watch in set(watches) - set(alive_watches):
-            logger.debug('Removing watch %s', repr(removed_watch))
-    return alive_watches, watch_handled
+    if dead_watches is not None:
+        for watch in dead_watches:
+            try:
+                watches.remove(watch)
+            except ValueError:
+                pass    # someone's removed it in the meantime
+    return watch_handled
 
 
 class Connection(object):
@@ -102,11 +105,14 @@ class Connection(object):
         self.node_definition = node_definition
         self.uuid = uuid.uuid4().hex[:5]
         self.name = name or 'CoolAMQP'
-        self.recvf = ReceivingFramer(self.on_frame)
+        self.recvf = ReceivingFramer(on_frames=self.on_frames, on_parsed=self.on_parsed)
+        self.after_read = []  # callables to call once the data being received is processed
         self.extra_properties = extra_properties
         # todo a list doesn't seem like a very strong atomicity guarantee
-        self.watches = {}  # channel => list of [Watch instance]
+        # channel => dispatch key => list of [Watch instance], see Watch.get_dispatch_keys
+        self.watches = {}
         self.any_watches = []  # list of Watches that should check everything
+        self.fail_watches = []  # list of Watches not bound to a channel, that care only about failures
 
         self.finalize = Callable(oneshots=True)  #: public
 
@@ -149,6 +155,7 @@ class Connection(object):
         logger.info('[%s] Connection ready.', self.name)
 
         self.state = ST_ONLINE
+        self.recvf.set_frame_max(self.frame_max)
 
         while len(self.callables_on_connected) > 0:
             self.callables_on_connected.pop()()
@@ -192,8 +199,8 @@ class Connection(object):
         # be a race condition that ConnectionStart has arrived before there could
         # be a watch for it set
         self.listener_socket = self.listener_thread.register(sock,
-                                                             on_read=self.recvf.put,
-                                                             on_fail=self.on_fail)
+                                                             on_fail=self.on_fail,
+                                                             recv_into=self.recvf)
         self.sendf = SendingFramer(self.listener_socket.send)
         Handshaker(self, self.node_definition, self.on_connected, self.extra_properties)
         self.listener_thread.activate(self.listener_socket)
@@ -216,20 +223,22 @@ class Connection(object):
 
         self.state = ST_OFFLINE  # Update state
 
-        watchlists = [self.watches[channel] for channel in self.watches]
+        watchlists = [self.any_watches, self.fail_watches]
+        for index in six.itervalues(self.watches):
+            watchlists.extend(six.itervalues(index))
+
+        self.watches = {}  # Clear the watch list
+        self.any_watches = []
+        self.fail_watches = []
+        self.recvf.content_receivers.clear()
 
         for watchlist in watchlists:  # Run all watches - failed
             for watch in watchlist:
+                # a watch can be present on many lists, make sure it fails once
                 if not watch.cancelled:
+                    watch.cancelled = True
                     watch.failed()
 
-        for watch in self.any_watches:
-            if not watch.cancelled:
-                watch.failed()
-
-        self.watches = {}  # Clear the watch list
-        self.any_watches = []
-
         # call finalizers
         self.finalize()
 
@@ -271,53 +280,86 @@ class Connection(object):
             # Listener socket will kill us when time is right
             self.listener_socket.send(None)
 
-    def on_frame(self, frame):
+    def send_serialized(self, buffers):
         """
-        Called by event loop upon receiving an AMQP frame.
+        Schedule to send frames that were serialized earlier, eg. by a FrameBuffer.
 
-        This will verify all watches on given channel if they were hit,
-        and take appropriate action.
+        These are not logged to log_frames, since they are no longer frame objects.
 
-        Unhandled frames will be logged - if they were sent, they probably were important.
-
-        :param frame: AMQPFrame that was received
+        :param buffers: list of bytes-like objects containing whole frames
         """
-        if self.log_frames is not None:
-            self.log_frames.on_frame(monotonic(), frame, 'to_client')
+        self.sendf.send_serialized(buffers)
 
-        watch_handled = False  # True if ANY watch handled this
+    def on_frame(self, frame):
+        """
+        Called upon receiving a single AMQP frame.
 
-        # ==================== process per-channel watches
-        #
-        #   Note that new watches may arrive while we process existing watches.
-        #   Therefore, we need to copy watches and zero the list before we proceed
-        if frame.channel in self.watches:
-            watches = self.watches[frame.channel]  # a list
-            self.watches[frame.channel] = []
+        This is equivalent to calling .on_frames() with a single-element list.
 
-            alive_watches, f = alert_watches(watches, frame)
-            watch_handled |= f
+        :param frame: AMQPFrame that was received
+        """
+        self.on_frames([frame])
 
-            if frame.channel in self.watches:
-                # unwatch_all might have gotten called, check that
-                for watch in alive_watches:
-                    self.watches[frame.channel].append(watch)
+    def on_frames(self, frames):
+        """
+        Called by event loop upon receiving a batch of AMQP frames (all frames parsed
+        from a single read).
 
-        # ==================== process "any" watches
-        any_watches = self.any_watches
-        self.any_watches = []
-        alive_watches, f = alert_watches(any_watches, frame)
+        A frame on a channel reaches only watches that registered for it's dispatch key
+        (method class, or frame type for non-method frames), plus the ones that want to see
+        every frame on that channel, and then the "any" watches.
 
-        watch_handled |= f
+        Unhandled frames will be logged - if they were sent, they probably were important.
 
-        for watch in alive_watches:
-            self.any_watches.append(watch)
+        :param frames: a list of AMQPFrame that were received
+        """
+        if self.log_frames is not None:
+            now = monotonic()
+            for frame in frames:
+                self.log_frames.on_frame(now, frame, 'to_client')
+
+        for frame in frames:
+            watch_handled = False  # True if ANY watch handled this
+
+            # ==================== process per-channel watches
+            index = self.watches.get(frame.channel)
+            if index is not None:
+                if frame.FRAME_TYPE == FRAME_METHOD:
+                    watches = index.get(frame.payload.__class__)
+                else:
+                    watches = index.get(frame.FRAME_TYPE)
+                if watches:
+                    watch_handled = alert_watches(watches, frame)
+
+                watches = index.get(None)
+                if watches:
+                    watch_handled |= alert_watches(watches, frame)
+
+            # ==================== process "any" watches
+            if self.any_watches:
+                watch_handled |= alert_watches(self.any_watches, frame)
+
+            if not watch_handled:
+                if isinstance(frame, AMQPMethodFrame):
+                    logger.warning('[%s] Unhandled method frame %s', self.name,
+                                   repr(frame.payload))
+                else:
+                    logger.warning('[%s] Unhandled frame %s', self.name, frame)
+
+    def on_parsed(self):  # type: () -> None
+        """Called by ReceivingFramer once all frames received at once are processed"""
+        if self.after_read:
+            callbacks, self.after_read = self.after_read, []
+            for callback in callbacks:
+                callback()
+
+    def call_after_read(self, callback):  # type: (tp.Callable[[], None]) -> None
+        """
+        Call callback once all frames received with the current read are processed. One-shot.
 
-        if not watch_handled:
-            if isinstance(frame, AMQPMethodFrame):
-                logger.warning('[%s] Unhandled method frame %s', self.name, repr(frame.payload))
-            else:
-                logger.warning('[%s] Unhandled frame %s', self.name, frame)
+        Call from listener thread only, eg. from a watch or a content receiver.
+        """
+        self.after_read.append(callback)
 
     def watchdog(self, delay, callback):
         """
@@ -337,9 +379,35 @@ class Connection(object):
 
     def unwatch_all(self, channel_id):
         """
-        Remove all watches from specified channel
+        Remove all watches, and the content receiver, from specified channel
         """
         self.watches.pop(channel_id, None)
+        self.recvf.content_receivers.pop(channel_id, None)
+
+    def set_content_receiver(self, channel_id, receiver):
+        """
+        Have basic.deliver, content header and content body frames on given channel
+        fed directly to receiver, bypassing frame objects and watches.
+        See ReceivingFramer for the interface receiver has to implement.
+
+        This is a no-op if frames are being logged, since they need to be seen.
+        Watches for these frames should be registered anyway.
+
+        Call from listener thread only.
+
+        :param channel_id: channel ID
+        :param receiver: content receiver, eg. a MessageReceiver
+        """
+        if self.log_frames is None:
+            self.recvf.content_receivers[channel_id] = receiver
+
+    def remove_content_receiver(self, channel_id):
+        """
+        Stop feeding frames on given channel to a content receiver.
+
+        :param channel_id: channel ID
+        """
+        self.recvf.content_receivers.pop(channel_id, None)
 
     def watch(self, watch):
         """
@@ -347,12 +415,24 @@ class Connection(object):
         :param watch: Watch to register
         """
         assert self.state != ST_OFFLINE
+        keys = watch.get_dispatch_keys()
         if watch.channel is None:
-            self.any_watches.append(watch)
-        elif watch.channel not in self.watches:
-            self.watches[watch.channel] = collections.deque([watch])
-        else:
-            self.watches[watch.channel].append(watch)
+            if keys:
+                self.any_watches.append(watch)
+            else:
+                self.fail_watches.append(watch)
+            return
+
+        index = self.watches.setdefault(watch.channel, {})
+        for key in keys or (FAIL_ONLY, ):
+            watches = index.setdefault(key, [])
+            watches.append(watch)
+            # Fired oneshot watches linger on other keys, and cancelled watches
+            # linger until a frame comes, so clean them up every now and then.
+            # The list is replaced, not changed, since alert_watches might be going through it.
+            length = len(watches)
+            if length >= 16 and not (length & (length - 1)):
+                index[key] = [w for w in watches if not w.cancelled]
 
     def watch_for_method(self, channel,  # type: int
                          method,  # type: AMQPMethodPayload
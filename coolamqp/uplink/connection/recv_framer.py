@@ -1,17 +1,13 @@
 # coding=UTF-8
 from __future__ import absolute_import, division, print_function
 
-import collections
-import io
 import struct
 
-import six
-
-import coolamqp.argumentify
 from coolamqp.framing.definitions import FRAME_HEADER, FRAME_HEARTBEAT, \
-    FRAME_END, FRAME_METHOD, FRAME_BODY
+    FRAME_END, FRAME_METHOD, FRAME_BODY, CLASS_ID_TO_CONTENT_PROPERTY_LIST
 from coolamqp.framing.frames import AMQPBodyFrame, AMQPHeaderFrame, \
-    AMQPHeartbeatFrame, AMQPMethodFrame
+    AMQPHeartbeatFrame, AMQPMethodFrame, STRUCT_HHQ
+from coolamqp.framing.lazy_properties import LazyContentPropertyList
 
 FRAME_TYPES = {
     FRAME_HEADER: AMQPHeaderFrame,
@@ -19,151 +15,260 @@ FRAME_TYPES = {
     FRAME_METHOD: AMQPMethodFrame
 }
 
-ordpy2 = ord if six.PY2 else lambda x: x
+STRUCT_BHI = struct.Struct('!BHI')
+STRUCT_HH = struct.Struct('!HH')
+STRUCT_QB = struct.Struct('!QB')
+
+BASIC_DELIVER_ID = (60, 60)  # class and method ID of basic.deliver
+
+MIN_RECV_SIZE = 2048
+DEFAULT_MAX_RECV_SIZE = 131072  # RabbitMQ's default frame_max
+DEFAULT_BUFFER_SIZE = 4 * DEFAULT_MAX_RECV_SIZE
+
+# Python 2 memoryviews can't be released, so we can never tell whether a buffer
+# is still referenced by frames that we've handed out
+CAN_REUSE_BUFFERS = hasattr(memoryview, 'release')
 
 
 class ReceivingFramer(object):
     """
     Assembles AMQP framing from received data.
 
-    Just call with .put(data) upon receiving,
-    and on_frame will be called with fresh frames.
+    Data is kept in a single bytearray buffer. You can either:
 
-    Not thread safe.
+    * call .get_buffer(), receive into the returned memoryview (eg. using socket.recv_into)
+      and then call .on_received(bytes_received)
+    * call .put(data) with data received elsewhere - this will be copied into the buffer
 
-    State machine
-        (frame_type is None)  and has_bytes(1)        ->
-                (frame_type <- bytes(1))
+    on_frame will be called with fresh frames. Alternatively, if you pass on_frames, it will be
+    called once per .put() or .on_received() with a list of all frames parsed from that data.
+    on_parsed, if given, is called after all of them, once per .put() or .on_received().
 
-        (frame_type is HEARTBEAT) and has_bytes(AMQPHeartbeatFrame.LENGTH-1)
-                      ->          (output_frame, frame_type <- None)
-        (frame_type is not HEARTBEAT and not None) and has_bytes(6)  ->
-                                       (frame_channel <- bytes(2),
-                                         frame_size <- bytes(4))
+    Frames handed to on_frame are memoryviews into the buffer, so bytes that have been parsed
+    already are never overwritten. Once the buffer fills up, the unparsed remainder (that is,
+    a frame that has been received only partially) is moved to the front of the buffer, if
+    nothing else refers to it anymore, or to a freshly allocated buffer otherwise. This is the
+    only time data is copied.
 
-        (frame_size is not None) and has_bytes(frame_size+1)    ->
-                    (output_frame,
+    The amount of data to receive at once (recv_size) is adaptive. It starts at 2048 bytes,
+    doubles each time a read fills the buffer completely and shrinks when reads are small.
+    It will never exceed max_recv_size, which Connection sets to the negotiated frame_max.
 
-                                    frame_type <- None
-                                    frame_size < None)
-    """
+    Content receivers
+    -----------------
+    Channels present in content_receivers (channel ID -> receiver) are given a fast path.
+    basic.deliver, content header and content body frames on them are not turned into frame
+    objects, but fed directly to the receiver instead:
 
-    def __init__(self, on_frame=lambda frame: None):
-        self.chunks = collections.deque()  # all received data
-        self.total_data_len = 0
+    * basic.deliver results in receiver.on_deliver(delivery_tag, exchange, routing_key)
+    * a content header results in receiver.on_content_header(body_size, properties)
+    * a content body results in receiver.on_body(memoryview)
 
-        self.frame_type = None
-        self.frame_channel = None
-        self.frame_size = None
+    Other frames on these channels are processed as usual. Order of frames is preserved.
+    Since frames on these channels won't reach on_frame(s), only use this when nobody
+    needs to see them, eg. when frame logging is disabled.
 
-        self.bytes_needed = None  # bytes needed for a new frame
+    Not thread safe.
+    """
+
+    def __init__(self, on_frame=lambda frame: None, on_frames=None, on_parsed=None):
+        """
+        :param on_frame: callable(AMQPFrame) to call with every frame received
+        :param on_frames: callable(list of AMQPFrame) to call with every batch of frames
+            received. If given, on_frame won't be called.
+        :param on_parsed: callable/0 to call once all frames received at once are processed
+        """
         self.on_frame = on_frame
+        self.on_frames = on_frames
+        self.on_parsed = on_parsed
+        self.content_receivers = {}  # channel ID -> content receiver, see class docstring
 
-    def put(self, data):
+        self.buffer_size = DEFAULT_BUFFER_SIZE
+        self.buf = bytearray(self.buffer_size)
+        self.view = memoryview(self.buf)
+        self.start = 0  # offset of first byte not yet parsed
+        self.end = 0  # offset of first byte not yet received
+
+        self.recv_size = MIN_RECV_SIZE
+        self.max_recv_size = DEFAULT_MAX_RECV_SIZE
+        self.requested = 0  # size of the last buffer returned by get_buffer
+
+    def set_frame_max(self, frame_max):  # type: (int) -> None
         """
-        Called upon receiving data.
+        Called when frame_max is known, to cap the size of a single receive.
 
-        May result in any number of .on_frame() calls
-        :param data: received data
+        :param frame_max: negotiated frame_max. 0 means no limit, and will be ignored.
         """
-        self.total_data_len += len(data)
-        self.chunks.append(memoryview(data))
+        if frame_max:
+            self.max_recv_size = max(frame_max, MIN_RECV_SIZE)
+            self.recv_size = min(self.recv_size, self.max_recv_size)
 
-        while self._statemachine():
-            pass
+    def _is_shared(self):  # type: () -> bool
+        """
+        Is any byte of current buffer still referred to by some frame?
 
-    def _extract_single_byte(self):
-        return ordpy2(self._extract(1)[0])
+        Must be called with self.view released.
+        """
+        try:
+            self.buf.append(0)  # resizing is refused if there are any exports
+        except BufferError:
+            return True
+        del self.buf[-1]
+        return False
 
-    def _extract(self, up_to):
+    def _reserve(self, size):  # type: (int) -> None
+        """Make sure that there are at least size bytes free past self.end"""
+        if len(self.buf) - self.end >= size:
+            return
+
+        pending = self.end - self.start
+        needed = pending + size
+
+        if CAN_REUSE_BUFFERS and len(self.buf) >= needed:
+            self.view.release()
+            if not self._is_shared():
+                # wrap around, moving the partially received frame to the front
+                self.buf[:pending] = self.buf[self.start:self.end]
+                self.view = memoryview(self.buf)
+                self.start, self.end = 0, pending
+                return
+
+        self.buffer_size = max(self.buffer_size, 4 * self.max_recv_size, needed)
+        new_buf = bytearray(self.buffer_size)
+        new_buf[:pending] = self.buf[self.start:self.end]
+        self.buf = new_buf
+        self.view = memoryview(new_buf)
+        self.start, self.end = 0, pending
+
+    def get_buffer(self):  # type: () -> memoryview
         """
-        return up to up_to bytes from current chunk, switch if necessary
+        Return a writable memoryview to receive data into.
+
+        Fill it in, then call .on_received() with the amount of bytes written.
         """
-        assert self.total_data_len >= up_to, \
-            'Tried to extract %s but %s remaining' % (
-                up_to, self.total_data_len)
-        if up_to >= len(self.chunks[0]):
-            q = self.chunks.popleft()
-        else:
-            q = self.chunks[0][:up_to]
-            self.chunks[0] = self.chunks[0][up_to:]
+        self._reserve(self.recv_size)
+        self.requested = self.recv_size
+        return self.view[self.end:self.end + self.recv_size]
 
-        self.total_data_len -= len(q)
-        assert len(q) <= up_to, 'extracted %s but %s was requested' % (
-            len(q), up_to)
-        return q
+    def on_received(self, length):  # type: (int) -> None
+        """
+        Called after length bytes have been written into buffer returned by .get_buffer().
 
-    def _statemachine(self):
-        # state rule 1
-        if self.frame_type is None and self.total_data_len > 0:
-            self.frame_type = self._extract_single_byte()
+        May result in any number of .on_frame() calls, or a single .on_frames() call.
 
-            if self.frame_type not in (
-                    FRAME_HEARTBEAT, FRAME_HEADER, FRAME_METHOD, FRAME_BODY):
-                raise ValueError('Invalid frame')
+        :raises ValueError: invalid data was received
+        """
+        if length >= self.requested:
+            self.recv_size = min(self.recv_size * 2, self.max_recv_size)
+        elif length < self.recv_size // 4:
+            self.recv_size = max(self.recv_size // 2, MIN_RECV_SIZE)
 
-            return True
+        self.end += length
+        self._parse()
 
-        # state rule 2
-        elif (self.frame_type == FRAME_HEARTBEAT) and (
-                self.total_data_len >= AMQPHeartbeatFrame.LENGTH - 1):
-            data = b''
-            while len(data) < AMQPHeartbeatFrame.LENGTH - 1:
-                data = data + self._extract(
-                    AMQPHeartbeatFrame.LENGTH - 1 - len(data)).tobytes()
+    def put(self, data):
+        """
+        Called upon receiving data.
 
-            if data != AMQPHeartbeatFrame.DATA[1:]:
-                # Invalid heartbeat frame!
-                raise ValueError('Invalid AMQP heartbeat')
+        May result in any number of .on_frame() calls, or a single .on_frames() call.
 
-            self.on_frame(AMQPHeartbeatFrame())
-            self.frame_type = None
+        :param data: received data
+        :raises ValueError: invalid data was received
+        """
+        self._reserve(len(data))
+        self.buf[self.end:self.end + len(data)] = data
+        self.end += len(data)
+        self._parse()
+
+    def _parse(self):
+        if self.on_frames is not None:
+            frames = []
+            on_frame = frames.append
+        else:
+            on_frame = self.on_frame
 
-            return True
+        receivers = self.content_receivers
+        buf = self.buf
+        view = self.view
+        end = self.end
+        start = self.start
 
-        # state rule 3
-        elif (self.frame_type != FRAME_HEARTBEAT) and (
-                self.frame_type is not None) and (
-                self.frame_size is None) and (
-                self.total_data_len > 6):
-            hdr = b''
-            while len(hdr) < 6:
-                hdr = hdr + self._extract(6 - len(hdr)).tobytes()
+        while end - start >= AMQPHeartbeatFrame.LENGTH:  # smallest frame possible
+            frame_type, channel, size = STRUCT_BHI.unpack_from(buf, start)
 
-            self.frame_channel, self.frame_size = struct.unpack('!HI', hdr)
+            if frame_type not in (FRAME_HEARTBEAT, FRAME_HEADER, FRAME_METHOD, FRAME_BODY):
+                raise ValueError('Invalid frame')
 
-            return True
+            frame_end = start + 7 + size
+            if frame_end >= end:
+                break  # not whole frame received yet
 
-        # state rule 4
-        elif (self.frame_size is not None) and (
-                self.total_data_len >= (self.frame_size + 1)):
+            if buf[frame_end] != FRAME_END:
+                raise ValueError('Invalid frame end')
 
-            if len(self.chunks[0]) >= self.frame_size:
-                # We can subslice it - it's very fast
-                payload = self._extract(self.frame_size)
+            if receivers and channel in receivers:
+                if self.on_frames is not None and frames:
+                    # dispatch frames that came earlier first, to preserve ordering.
+                    # This might have unregistered the receiver.
+                    self.on_frames(frames)
+                    frames = []
+                    on_frame = frames.append
+
+                receiver = receivers.get(channel)
+                if receiver is not None and self._fast_path(receiver, frame_type, start + 7,
+                                                            frame_end):
+                    start = self.start
+                    continue
+
+            if frame_type == FRAME_HEARTBEAT:
+                if size or channel:
+                    raise ValueError('Invalid AMQP heartbeat')
+                frame = AMQPHeartbeatFrame()
             else:
-                # Construct a separate buffer :(
-                payload = io.BytesIO()
-                while payload.tell() < self.frame_size:
-                    payload.write(
-                        self._extract(self.frame_size - payload.tell()))
+                frame = FRAME_TYPES[frame_type].unserialize(channel, view[start + 7:frame_end])
 
-                assert payload.tell() <= self.frame_size
+            start = self.start = frame_end + 1
+            on_frame(frame)
 
-                payload = memoryview(payload.getvalue())
+        if self.on_frames is not None and frames:
+            self.on_frames(frames)
 
-            if self._extract_single_byte() != FRAME_END:
-                raise ValueError('Invalid frame end')
+        if self.on_parsed is not None:
+            self.on_parsed()
 
-            try:
-                frame = FRAME_TYPES[self.frame_type].unserialize(
-                    self.frame_channel, payload)
-            except ValueError:
-                raise
+    def _fast_path(self, receiver, frame_type, offset, frame_end):
+        """
+        Feed a frame directly to a content receiver, if it's one of the frames it handles.
 
-            self.on_frame(frame)
-            self.frame_type = None
-            self.frame_size = None
+        :param offset: offset of frame's payload
+        :param frame_end: offset of frame's frame end octet
+        :return: whether the frame was consumed
+        """
+        buf = self.buf
+        if frame_type == FRAME_BODY:
+            self.start = frame_end + 1
+            receiver.on_body(self.view[offset:frame_end])
+
+        elif frame_type == FRAME_HEADER:
+            class_id, weight, body_size = STRUCT_HHQ.unpack_from(buf, offset)
+            properties = LazyContentPropertyList(CLASS_ID_TO_CONTENT_PROPERTY_LIST[class_id],
+                                                 self.view[offset:frame_end], 12)
+            self.start = frame_end + 1
+            receiver.on_content_header(body_size, properties)
+
+        elif frame_type == FRAME_METHOD:
+            if STRUCT_HH.unpack_from(buf, offset) != BASIC_DELIVER_ID:
+                return False
+            offset += 4
+            offset += buf[offset] + 1  # skip consumer tag
+            delivery_tag, redelivered = STRUCT_QB.unpack_from(buf, offset)
+            offset += 9
+            exchange = self.view[offset + 1:offset + 1 + buf[offset]]
+            offset += buf[offset] + 1
+            routing_key = self.view[offset + 1:offset + 1 + buf[offset]]
+            self.start = frame_end + 1
+            receiver.on_deliver(delivery_tag, exchange, routing_key)
 
-            return True
-        return False
+        else:
+            return False
+        return True
@@ -2,34 +2,69 @@
 from __future__ import absolute_import, division, print_function
 
 import io
+import threading
 
+import six
+
+from coolamqp.framing.body_stream import AMQPBodyStream, BuffersWithStreams
+from coolamqp.framing.definitions import FRAME_BODY, FRAME_END_BYTE
+from coolamqp.framing.frames import STRUCT_BHL
+
+COPY_THRESHOLD = 1024  # immutable bodies this long or longer are passed by reference, not copied
 
-class SendingFramer(object):
-    """
-    Assembles AMQP framing from received data and orchestrates their upload via a socket.
 
-    Just call with .put(data) and get framing by iterator .framing().
+def is_immutable(data):  # type: (object) -> bool
+    """Can't data change after it's been published? True for bytes and read-only views of bytes"""
+    if isinstance(data, six.binary_type):
+        return True
+    return isinstance(data, memoryview) and data.readonly and \
+        isinstance(getattr(data, 'obj', None), six.binary_type)
 
-    Not thread safe.
 
-    State machine
-        (frame_type is None)  and has_bytes(1)        ->          (frame_type <- bytes(1))
+class SendingFramer(object):
+    """
+    Serializes frames and hands them over for sending.
+
+    Frames are encoded into a list of buffers, to be sent with scatter/gather I/O
+    (eg. socket.sendmsg), so that large bodies are never copied:
 
-        (frame_type is HEARTBEAT) and has_bytes(3)  ->          (output_frame, frame_type <- None)
-        (frame_type is not HEARTBEAT and not None) and has_bytes(6)  ->      (frame_channel <- bytes(2),
-                                                                 frame_size <- bytes(4))
+    * everything except for large bodies (frame headers, method frames, content headers,
+      short bodies) is written into an arena - a BytesIO reused for every send - and taken
+      out of it as bytes
+    * content bodies of COPY_THRESHOLD bytes or longer, that are bytes (or memoryviews of
+      bytes), are passed as-is, and the socket will send straight from them. Mutable bodies,
+      such as bytearrays, are copied, since the caller may reuse them right after publishing.
+    * AMQPBodyStreams are passed as-is too, in a BuffersWithStreams, and the socket will
+      produce their frames as it sends them
 
-        (frame_size is not None) and has_bytes(frame_size+1)    ->  (output_frame,
-                                                                            frame_type <- None
-                                                                            frame_size < None)
+    Thread safe. Every thread has it's own arena, so frames are serialized without holding
+    any lock - the lock is held only while the buffers are handed over to on_send.
     """
 
-    def __init__(self, on_send=lambda data: None):
+    def __init__(self, on_send=lambda data, priority: None):
         """
-        :param on_send: a callable(data, priority=False) that can be called with some data to send
-            data will always be entire AMQP frames!
+        :param on_send: a callable(data, priority=False) that can be called with some data to send.
+            data will be a list of buffers, and they will always make up entire AMQP frames!
         """
         self.on_send = on_send
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @property
+    def arena(self):  # type: () -> io.BytesIO
+        """Arena of the calling thread"""
+        try:
+            return self.local.arena
+        except AttributeError:
+            self.local.arena = arena = io.BytesIO()
+            return arena
+
+    @staticmethod
+    def _take_arena(arena, buffers):  # type: (io.BytesIO, list) -> None
+        """Append contents of the arena to buffers, and clear it"""
+        buffers.append(arena.getvalue())
+        arena.seek(0)
+        arena.truncate()
 
     def send(self, frames, priority=False):
         """
@@ -37,11 +72,44 @@ class SendingFramer(object):
         :param frames: list of AMQPFrame instances
         :param priority: preempty existing frames
         """
-        length = sum(frame.get_size() for frame in frames)
-        buf = io.BytesIO(bytearray(length))
+        buffers = []
+        arena = self.arena
+        try:
+            for frame in frames:
+                if frame.FRAME_TYPE == FRAME_BODY and isinstance(frame, AMQPBodyStream):
+                    if arena.tell():
+                        self._take_arena(arena, buffers)
+                    if not isinstance(buffers, BuffersWithStreams):
+                        buffers = BuffersWithStreams(buffers)
+                    buffers.append(frame)
+                    buffers.streams += 1
+                elif frame.FRAME_TYPE == FRAME_BODY and len(frame.data) >= COPY_THRESHOLD \
+                        and is_immutable(frame.data):
+                    arena.write(STRUCT_BHL.pack(FRAME_BODY, frame.channel, len(frame.data)))
+                    self._take_arena(arena, buffers)
+                    buffers.append(frame.data)
+                    arena.write(FRAME_END_BYTE)
+                else:
+                    frame.write_to(arena)
+        except Exception:
+            # drop whatever was written, so that it's not sent later
+            arena.seek(0)
+            arena.truncate()
+            raise
 
-        for frame in frames:
-            frame.write_to(buf)
+        if arena.tell():
+            self._take_arena(arena, buffers)
 
-        q = buf.getvalue()
-        self.on_send(q, priority)
+        with self.lock:
+            self.on_send(buffers, priority)
+
+    def send_serialized(self, buffers, priority=False):
+        """
+        Schedule to send frames that are already serialized.
+
+        :param buffers: list of bytes-like objects (or a BuffersWithStreams), containing
+            whole frames
+        :param priority: preempty existing frames
+        """
+        with self.lock:
+            self.on_send(buffers, priority)
@@ -4,11 +4,14 @@ from __future__ import absolute_import, division, print_function
 import logging
 
 from coolamqp.framing.base import AMQPMethodPayload
+from coolamqp.framing.definitions import FRAME_HEADER, FRAME_BODY
 from coolamqp.framing.frames import AMQPMethodFrame, AMQPHeaderFrame, \
     AMQPBodyFrame
 
 logger = logging.getLogger(__name__)
 
+FAIL_ONLY = 'fail'  # dispatch key for channel watches that won't be triggered by any frame
+
 
 class Watch(object):
     """
@@ -39,6 +42,20 @@ class Watch(object):
         """
         raise Exception('Abstract method')
 
+    def get_dispatch_keys(self):
+        """
+        Return keys of frames that can trigger this watch. Connection will
+        bother this watch only with frames that match one of them.
+
+        A key is either a method payload class (for method frames), or a frame type
+        (for other frames). None means "every frame".
+
+        Override this, if your watch is interested only in particular frames.
+
+        :return: a tuple of keys. Empty tuple means that no frame will trigger this watch.
+        """
+        return None,
+
     def failed(self):
         """
         This watch will process things no more, because underlying
@@ -91,6 +108,9 @@ class FailWatch(Watch):
     def is_triggered_by(self, frame):
         return False
 
+    def get_dispatch_keys(self):
+        return ()
+
     def failed(self):
         """Connection failed!"""
         self.callable()
@@ -105,6 +125,9 @@ class HeaderOrBodyWatch(Watch):
         Watch.__init__(self, channel, False)
         self.callable = callable
 
+    def get_dispatch_keys(self):
+        return FRAME_HEADER, FRAME_BODY
+
     def is_triggered_by(self, frame):
         if not (isinstance(frame, (AMQPHeaderFrame, AMQPBodyFrame))):
             return False
@@ -141,6 +164,9 @@ class MethodWatch(Watch):
         if self.on_end is not None:
             self.on_end()
 
+    def get_dispatch_keys(self):
+        return self.methods
+
     def is_triggered_by(self, frame):
 
         if not isinstance(frame, AMQPMethodFrame):
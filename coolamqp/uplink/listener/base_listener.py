@@ -19,6 +19,12 @@ class BaseListener(object):
             ts, fd, callback = heapq.heappop(self.time_events)
             callback()
 
+    def get_timeout(self, timeout):  # type: (float) -> float
+        """Return how long can we wait for I/O, so that timer events are not late"""
+        if self.time_events:
+            return max(0, min(timeout, self.time_events[0][0] - monotonic()))
+        return timeout
+
     def oneshot(self, sock, delta, callback):
         """
         A socket registers a time callback
@@ -87,7 +93,8 @@ class BaseListener(object):
     @abstractmethod
     def register(self, sock,                    # type: socket.socket
                  on_read=lambda data: None,     # type: tp.Callable[[bytearray], None]
-                 on_fail=lambda: None         # type: tp.Callable[[], None]
+                 on_fail=lambda: None,        # type: tp.Callable[[], None]
+                 recv_into=None
                  ):                     # type: () -> BaseSocket
         """
         This has to return a particular Socket instance, adapted to the needs of the listener.
@@ -95,6 +102,8 @@ class BaseListener(object):
         :param sock: a socket instance (as returned by socket module)
         :param on_read: callable(data) to be called with received data
         :param on_fail: callable() to be called when socket fails
+        :param recv_into: object to receive data into, instead of calling on_read.
+            See BaseSocket for details.
 
         :return: a BaseSocket's subclass instance to use instead of this socket
         """
@@ -55,7 +55,7 @@ class EpollListener(BaseListener):
                 self.epoll.register(socket_to_activate.fileno(), RW)
             self.sockets_to_activate = []
 
-        events = self.epoll.poll(timeout=timeout)
+        events = self.epoll.poll(timeout=self.get_timeout(timeout))
 
         self.do_timer_events()
 
@@ -106,7 +106,7 @@ class EpollListener(BaseListener):
             self.sockets_to_activate.append(sock)
 
     def register(self, sock, on_read=lambda data: None,
-                 on_fail=lambda: None):
+                 on_fail=lambda: None, recv_into=None):
         """
         Add a socket to be listened for by the loop.
 
@@ -115,7 +115,10 @@ class EpollListener(BaseListener):
         :param sock: a socket instance (as returned by socket module)
         :param on_read: callable(data) to be called with received data
         :param on_fail: callable() to be called when socket fails
+        :param recv_into: object to receive data into, instead of calling on_read.
+            See BaseSocket for details.
 
         :return: a BaseSocket instance to use instead of this socket
         """
-        return EpollSocket(sock, on_read, on_fail=on_fail, listener=self)
+        return EpollSocket(sock, on_read, on_fail=on_fail, listener=self,
+                           recv_into=recv_into)
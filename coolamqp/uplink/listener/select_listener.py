@@ -29,7 +29,8 @@ class SelectListener(BaseListener):
         self.do_timer_events()
 
         try:
-            rds, wrs, exs = select.select(rds_and_exs, wrs, rds_and_exs, timeout)
+            rds, wrs, exs = select.select(rds_and_exs, wrs, rds_and_exs,
+                                          self.get_timeout(timeout))
         except (select.error, socket.error, IOError):
             for sock in rds_and_exs:
                 try:
@@ -59,14 +60,17 @@ class SelectListener(BaseListener):
                 return self.close_socket(sock_ex)
 
     def register(self, sock, on_read=lambda data: None,
-                 on_fail=lambda: None):
+                 on_fail=lambda: None, recv_into=None):
         """
         Add a socket to be listened for by the loop.
 
         :param sock: a socket instance (as returned by socket module)
         :param on_read: callable(data) to be called with received data
         :param on_fail: callable() to be called when socket fails
+        :param recv_into: object to receive data into, instead of calling on_read.
+            See BaseSocket for details.
 
         :return: a BaseSocket instance to use instead of this socket
         """
-        return BaseSocket(sock, on_read, on_fail=on_fail, listener=self)
+        return BaseSocket(sock, on_read, on_fail=on_fail, listener=self,
+                          recv_into=recv_into)
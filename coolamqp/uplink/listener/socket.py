@@ -2,17 +2,49 @@
 from __future__ import absolute_import, division, print_function
 
 import collections
+import errno
+import itertools
 import logging
+import os
 from abc import ABCMeta, abstractmethod
 import socket
+import ssl
+import struct
+import typing as tp
+
+from coolamqp.framing.body_stream import AMQPBodyStream, BuffersWithStreams, FileSegment
+from coolamqp.framing.frames import STRUCT_BH
 
 logger = logging.getLogger(__name__)
 
+try:
+    IOV_MAX = min(os.sysconf('SC_IOV_MAX'), 1024)
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+if IOV_MAX <= 0:
+    IOV_MAX = 1024
+
+MAX_COALESCED_SEND = 65536  # without sendmsg, buffers shorter than that are joined before sending
+MSG_MORE = getattr(socket, 'MSG_MORE', 0)
+
 
 class SocketFailed(IOError):
     """Failure during socket operation. It needs to be discarded."""
 
 
+def _channel_of(data):
+    """
+    Return the channel of a piece of data to send, as read from it's first frame header,
+    or None if it can't be told.
+
+    Connection sends frames of a single channel at once, so that's the channel of all of it.
+    """
+    try:
+        return STRUCT_BH.unpack_from(data[0] if isinstance(data, list) else data, 0)[1]
+    except (IndexError, TypeError, struct.error):
+        return None
+
+
 class BaseSocket(object):
     """
     Base class for sockets provided to listeners.
@@ -26,7 +58,8 @@ class BaseSocket(object):
     def __init__(self, sock, on_read=lambda data: None,
                  on_time=lambda: None,
                  on_fail=lambda: None,
-                 listener=None):
+                 listener=None,
+                 recv_into=None):
         """
 
         :param sock: socketobject
@@ -39,16 +72,28 @@ class BaseSocket(object):
             Socket descriptor will be handled by listener.
             This should not
         :param listener: listener that registered this socket
+        :param recv_into: an object with methods .get_buffer() -> memoryview and
+            .on_received(bytes_received) (eg. a ReceivingFramer). If given, data will be
+            received directly into it, and on_read won't be called.
+            Listener thread context.
+            .on_received raises ValueError on socket should be closed
         """
         assert sock is not None
         self.sock = sock
         self.data_to_send = collections.deque()
         self.priority_queue = collections.deque()  # when a piece of data is finished, this queue is checked first
+        self.buffers = collections.deque()  # buffers of data already picked for sending, in order
+        # SSL sockets don't support sendmsg nor sendfile
+        self.can_sendmsg = hasattr(sock, 'sendmsg') and not isinstance(sock, ssl.SSLSocket)
+        self.can_sendfile = hasattr(os, 'sendfile') and not isinstance(sock, ssl.SSLSocket)
+        self.streams = 0  # amount of AMQPBodyStreams in self.buffers
+        self.stream_turn = False  # should the next frame be a streamed one, not other data
         self.my_on_read = on_read
         self._on_fail = on_fail
         self.on_time = on_time
         self.is_failed = False
         self.listener = listener
+        self.recv_into = recv_into
 
     def on_fail(self):
         self.is_failed = True
@@ -58,7 +103,8 @@ class BaseSocket(object):
         """
         Schedule to send some data.
 
-        :param data: data to send, or None to terminate this socket.
+        :param data: data to send (bytes, or a list of buffers that will be sent one after another),
+            or None to terminate this socket.
             Note that data will be sent atomically, ie. without interruptions.
         :param priority: preempt other datas. Property of sending data atomically will be maintained.
         """
@@ -68,6 +114,9 @@ class BaseSocket(object):
             # THE POPE OF NOPE
             self.priority_queue = collections.deque()
             self.data_to_send = collections.deque([None])
+            self.buffers = collections.deque()
+            self.streams = 0
+            self.stream_turn = False
             return
 
         if priority:
@@ -95,6 +144,10 @@ class BaseSocket(object):
         """Socket is readable, called by Listener"""
         if self.is_failed:
             return
+
+        if self.recv_into is not None:
+            return self._on_read_into()
+
         try:
             data = self.sock.recv(2048)
         except (IOError, socket.error) as e:
@@ -108,8 +161,188 @@ class BaseSocket(object):
         except ValueError as e:
             raise SocketFailed(repr(e))
 
+    def _on_read_into(self):      # type: () -> None
+        try:
+            received = self.sock.recv_into(self.recv_into.get_buffer())
+        except (IOError, socket.error) as e:
+            raise SocketFailed(repr(e))
+
+        if not received:
+            raise SocketFailed('connection gracefully closed')
+
+        try:
+            self.recv_into.on_received(received)
+        except ValueError as e:
+            raise SocketFailed(repr(e))
+
     def wants_to_send_data(self):  # type: () -> bool
-        return not (not self.data_to_send and not self.priority_queue)
+        return not (not self.data_to_send and not self.priority_queue and not self.buffers)
+
+    def _pick_buffers(self):  # type: () -> None
+        """
+        Move data from queues to self.buffers, until there are IOV_MAX buffers or the queues
+        are empty. Priority queue is checked first.
+
+        Nothing is picked while there's an AMQPBodyStream in self.buffers - instead, queued data
+        will be put in between it's frames by _next_stream_frame.
+
+        :raises SocketFailed: the socket should be terminated
+        """
+        buffers = self.buffers
+        while len(buffers) < IOV_MAX and not self.streams:
+            if self.priority_queue:
+                data = self.priority_queue.popleft()
+            elif self.data_to_send:
+                data = self.data_to_send.popleft()
+            else:
+                return
+
+            if data is None:
+                raise SocketFailed()  # We should terminate the connection!
+
+            if isinstance(data, list):
+                buffers.extend(data)
+                if isinstance(data, BuffersWithStreams):
+                    self.streams += data.streams
+            else:
+                buffers.append(data)
+
+    def _pick_interleaved(self, channel):  # type: (int) -> tp.Optional[tp.Any]
+        """
+        Take the first piece of data from data_to_send, that can be sent in between frames of
+        a message that is streamed on given channel.
+
+        That's data for other channels, that doesn't have to wait for data queued earlier
+        for the same channel.
+
+        :return: data, or None if there's none
+        """
+        blocked = set((channel, ))
+        for i, data in enumerate(itertools.islice(self.data_to_send, IOV_MAX)):
+            data_channel = None if data is None else _channel_of(data)
+            if data_channel is None:
+                return None  # can't tell what it is, so nothing behind it may go first
+            if data_channel in blocked or isinstance(data, BuffersWithStreams):
+                blocked.add(data_channel)  # other streams go in order
+                continue
+            del self.data_to_send[i]
+            return data
+        return None
+
+    def _next_stream_frame(self):  # type: () -> None
+        """
+        An AMQPBodyStream is first in self.buffers. Put it's next frame before it, or drop
+        it if it's done.
+
+        If there's priority data, it goes first instead. Otherwise the stream's frames take
+        turns with data queued for other channels, so a large message won't hold up traffic
+        on them until it's sent whole.
+
+        :raises SocketFailed: the socket should be terminated
+        """
+        buffers = self.buffers
+        stream = buffers[0]
+        if self.priority_queue:
+            data = self.priority_queue.popleft()
+            if data is None:
+                raise SocketFailed()
+        elif not self.stream_turn:
+            data = self._pick_interleaved(stream.channel)
+        else:
+            data = None
+
+        if data is not None:
+            self.stream_turn = True
+            if isinstance(data, list):
+                buffers.extendleft(reversed(data))
+            else:
+                buffers.appendleft(data)
+            return
+
+        self.stream_turn = False
+        try:
+            frame = stream.next_frame()
+        except (IOError, OSError, ValueError) as e:
+            # a part of the message was already sent, so the connection can't be used anymore
+            logger.error('Failed to read body of a message: %s', e)
+            raise SocketFailed(repr(e))
+
+        if frame is None:
+            buffers.popleft()
+            self.streams -= 1
+        else:
+            buffers.extendleft(reversed(frame))
+
+    def _send_file_segment(self, segment):  # type: (FileSegment) -> int
+        """
+        Send as much of a FileSegment that's first in self.buffers as the socket will take
+
+        :return: amount of bytes sent, None if nothing was sent
+        """
+        if not self.can_sendfile:
+            # replace it with it's data
+            try:
+                self.buffers[0] = segment.read()
+            except (IOError, OSError, ValueError) as e:
+                logger.error('Failed to read body of a message: %s', e)
+                raise SocketFailed(repr(e))
+            return None
+
+        try:
+            return segment.sendfile(self.sock)
+        except ValueError as e:
+            logger.error('Failed to read body of a message: %s', e)
+            raise SocketFailed(repr(e))
+
+    def _send_buffers_with_streams(self):  # type: () -> int
+        """
+        Like _send_buffers, but self.buffers may contain AMQPBodyStreams and FileSegments.
+
+        :return: amount of bytes sent, None if nothing was sent, but there's more to send
+        :raises SocketFailed: the socket should be terminated
+        """
+        buffers = self.buffers
+        first = buffers[0]
+        if isinstance(first, AMQPBodyStream):
+            self._next_stream_frame()
+            return None
+        if isinstance(first, FileSegment):
+            return self._send_file_segment(first)
+
+        # send whatever is before the first stream or file segment
+        to_send = []
+        for buffer in itertools.islice(buffers, IOV_MAX):
+            if isinstance(buffer, (AMQPBodyStream, FileSegment)):
+                break
+            to_send.append(buffer)
+
+        if not self.can_sendmsg:
+            return self.sock.send(b''.join(to_send))
+        flags = MSG_MORE if len(to_send) < len(buffers) else 0
+        return self.sock.sendmsg(to_send, [], flags)
+
+    def _send_buffers(self):  # type: () -> int
+        """
+        Send as much of self.buffers as the socket will take
+
+        :return: amount of bytes sent
+        """
+        if self.can_sendmsg:
+            if len(self.buffers) <= IOV_MAX:
+                return self.sock.sendmsg(self.buffers)
+            return self.sock.sendmsg(list(itertools.islice(self.buffers, IOV_MAX)))
+
+        # join short buffers, but never copy a long one
+        if len(self.buffers[0]) >= MAX_COALESCED_SEND:
+            return self.sock.send(self.buffers[0])
+        to_join = []
+        length = 0
+        for buffer in self.buffers:
+            length += len(buffer)
+            if length > MAX_COALESCED_SEND:
+                break
+            to_join.append(buffer)
+        return self.sock.send(b''.join(to_join))
 
     def on_write(self):      # type: () -> None
         """
@@ -122,34 +355,43 @@ class BaseSocket(object):
         if self.is_failed:
             return False
 
+        buffers = self.buffers
         while True:
-            if not self.data_to_send:
-                if not self.priority_queue:
+            if len(buffers) < IOV_MAX:
+                self._pick_buffers()
+                if not buffers:
                     return True
-                else:
-                    self.data_to_send.appendleft(self.priority_queue.popleft())
-
-            assert len(self.data_to_send) > 0
-
-            if self.data_to_send[0] is None:
-                raise SocketFailed()  # We should terminate the connection!
 
             try:
-                sent = self.sock.send(self.data_to_send[0])
-            except (IOError, socket.error):
+                if self.streams:
+                    sent = self._send_buffers_with_streams()
+                    if sent is None:
+                        continue
+                else:
+                    sent = self._send_buffers()
+            except (IOError, socket.error) as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return False  # socket's buffer is full
                 raise SocketFailed()
 
-            if sent < len(self.data_to_send[0]):
-                # Not everything could be sent
-                self.data_to_send[0] = self.data_to_send[0][sent:]
-                return False
-            else:
-                # Looks like everything has been sent
-                self.data_to_send.popleft()  # mark as sent
-
-                if self.priority_queue:
-                    # We can send a priority pack
-                    self.data_to_send.appendleft(self.priority_queue.popleft())
+            # pop whatever has been sent
+            while sent:
+                length = len(buffers[0])
+                if sent < length:
+                    # Not everything could be sent
+                    buffer = buffers[0]
+                    if isinstance(buffer, FileSegment):
+                        buffer.advance(sent)
+                    else:
+                        if not isinstance(buffer, memoryview):
+                            buffer = memoryview(buffer)
+                        buffers[0] = buffer[sent:]
+                    return False
+                buffers.popleft()
+                sent -= length
+
+            if buffers and not isinstance(buffers[0], AMQPBodyStream) and not len(buffers[0]):
+                buffers.popleft()  # empty buffers are always "sent"
 
     def fileno(self):  # type: () -> int
         """Return descriptor number"""
@@ -77,7 +77,8 @@ class ListenerThread(threading.Thread):
 
     def register(self, sock,  # type: socket.socket
                  on_read=lambda data: None,  # type: tp.Callable[[bytes], None]
-                 on_fail=lambda: None      # type: tp.Callable[[], None]
+                 on_fail=lambda: None,     # type: tp.Callable[[], None]
+                 recv_into=None
                  ):
         """
         Add a socket to be listened for by the loop.
@@ -85,7 +86,9 @@ class ListenerThread(threading.Thread):
         :param sock: a socket instance (as returned by socket module)
         :param on_read: callable(data) to be called with received data
         :param on_fail: callable() to be called when socket fails
+        :param recv_into: object to receive data into, instead of calling on_read.
+            See BaseSocket for details.
 
         :return: a BaseSocket instance to use instead of this socket
         """
-        return self.listener.register(sock, on_read, on_fail)
+        return self.listener.register(sock, on_read, on_fail, recv_into=recv_into)
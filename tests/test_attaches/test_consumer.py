@@ -1,14 +1,183 @@
 # coding=UTF-8
 from __future__ import print_function, absolute_import, division
 
+import io
 import unittest
 
 from coolamqp.attaches import Consumer
-from coolamqp.objects import Queue
+from coolamqp.clustering import MessageReceived
+from coolamqp.framing.definitions import BasicConsumeOk, BasicDeliver, BasicContentPropertyList, \
+    BasicAck, BasicNack, BasicReject
+from coolamqp.framing.frames import AMQPMethodFrame, AMQPHeaderFrame, AMQPBodyFrame
+from coolamqp.objects import Queue, NodeDefinition, ReceivedMessage, MessageBatch
+from coolamqp.uplink import Connection
 
 
 class TestConsumer(unittest.TestCase):
+    def setUp(self):
+        self.sent = []      # payloads of methods sent
+        self.timers = []    # (delay, callback) of timers armed
+        self.conn = Connection(NodeDefinition('127.0.0.1', 'guest', 'guest'), None, [])
+        self.conn.send = lambda frames, priority=False: self.sent.extend(
+            frame.payload for frame in frames)
+        self.conn.watchdog = lambda delay, callback: self.timers.append((delay, callback))
+
+    def consume(self, on_message, **kwargs):
+        """Return a Consumer of channel 1 of self.conn, that has just been set up"""
+        cons = Consumer(Queue(), on_message, **kwargs)
+        cons.connection = self.conn
+        cons.channel_id = 1
+        cons.consumer_tag = b'ctag'
+        cons.on_setup(BasicConsumeOk(b'ctag'))
+        del self.sent[:]
+        return cons
+
+    def deliver(self, *tags):
+        """Receive messages of given delivery tags, with a single read"""
+        buf = io.BytesIO()
+        for tag in tags:
+            for frame in [AMQPMethodFrame(1, BasicDeliver(b'ctag', tag, False, b'', b'')),
+                          AMQPHeaderFrame(1, 60, 0, 1, BasicContentPropertyList()),
+                          AMQPBodyFrame(1, b'x')]:
+                frame.write_to(buf)
+        self.conn.recvf.put(buf.getvalue())
+
+    def settled(self):
+        """Return (type, delivery tag, multiple) of acks and rejects sent since last called"""
+        result = [(type(payload), payload.delivery_tag, getattr(payload, 'multiple', False))
+                  for payload in self.sent]
+        del self.sent[:]
+        return result
+
     def test_issue_26(self):
         """Support for passing qos as int"""
         cons = Consumer(Queue('wtf'), lambda msg: None, qos=25)
         self.assertEqual(cons.qos, 25)
+
+    def test_receiving_messages(self):
+        received = []
+        self.consume(received.append, no_ack=True)
+
+        buf = io.BytesIO()
+        for frame in [AMQPMethodFrame(1, BasicDeliver(b'ctag', 1, False, b'xchg', b'rkey')),
+                      AMQPHeaderFrame(1, 60, 0, 6, BasicContentPropertyList(content_type=b'text/plain')),
+                      AMQPBodyFrame(1, b'hel'),
+                      AMQPBodyFrame(1, b'lo!')]:
+            frame.write_to(buf)
+        data = buf.getvalue()
+
+        self.conn.recvf.put(data)           # through the content receiver
+        self.conn.remove_content_receiver(1)
+        self.conn.recvf.put(data)           # through the watches
+        self.assertEqual(len(received), 2)
+        for msg in received:
+            self.assertEqual(msg.body, b'hello!')
+            self.assertEqual(msg.routing_key, b'rkey')
+            self.assertEqual(msg.exchange_name, b'xchg')
+            self.assertEqual(msg.delivery_tag, 1)
+            self.assertEqual(msg.properties.content_type, b'text/plain')
+
+    def test_coalesced_acks(self):
+        received = []
+        cons = self.consume(received.append, no_ack=False, ack_batch_size=3)
+        self.deliver(*range(1, 9))
+        self.assertEqual(len(received), 8)
+
+        for msg in received[:3]:
+            msg.ack()
+        self.assertEqual(self.settled(), [(BasicAck, 3, True)])
+
+        received[4].ack()       # out of order
+        self.assertEqual(self.settled(), [(BasicAck, 5, False)])
+        received[3].ack()
+        received[0].ack()       # already acked
+        self.assertEqual(self.settled(), [])
+
+        received[5].nack()
+        self.assertEqual(self.settled(), [(BasicAck, 4, False)])
+        received[6].nack()
+        cons.receiver.flush_acks()
+        self.assertEqual(self.settled(), [(BasicNack, 7, True)])
+
+        received[7].ack()
+        cons.receiver.on_ack_timer()
+        self.assertEqual(self.settled(), [])
+        cons.receiver.batch_since -= 1
+        cons.receiver.on_ack_timer()
+        self.assertEqual(self.settled(), [(BasicAck, 8, False)])
+
+    def test_ack_timer(self):
+        received = []
+        cons = self.consume(received.append, no_ack=False, ack_batch_size=3)
+        self.assertEqual(self.timers, [(0.05, cons.receiver.on_ack_timer)])    # by the listener
+        self.deliver(1, 2, 3)
+
+        received[0].ack()
+        received[1].ack()
+        self.assertEqual(len(self.timers), 1)   # acking doesn't arm timers
+        self.timers.pop()[1]()
+        delay, callback = self.timers.pop()
+        self.assertLess(delay, 0.05)            # rearmed for when the batch is due
+        self.assertEqual(self.sent, [])
+        cons.receiver.batch_since -= 1
+        callback()
+        self.assertEqual(self.settled(), [(BasicAck, 2, True)])
+        self.assertEqual(self.timers, [(0.05, callback)])
+
+        cons.receiver.on_gone()
+        self.timers.pop()[1]()
+        self.assertEqual(self.timers, [])       # not rearmed once gone
+
+    def test_ack_batch_size_below_qos(self):
+        self.assertRaises(ValueError, Consumer, Queue(), None, no_ack=False, qos=100,
+                          ack_batch_size=100)
+        Consumer(Queue(), None, no_ack=False, qos=100, ack_batch_size=99)
+        Consumer(Queue(), None, no_ack=True, qos=100, ack_batch_size=100)
+
+    def test_message_class_and_acks(self):
+        received = []
+        self.consume(received.append, no_ack=False, message_class=MessageReceived)
+        self.deliver(1, 2)
+
+        self.assertIsInstance(received[0], MessageReceived)
+        self.assertEqual(received[0]._nack.args, (1, False))
+        received[1].ack()
+        received[1].nack()
+        received[0].nack()
+        self.assertEqual(self.settled(), [(BasicAck, 2, False), (BasicReject, 1, False)])
+
+    def test_received_message_with_callables(self):
+        acked = []
+        msg = ReceivedMessage(b'x', b'', b'', ack=lambda: acked.append(True),
+                              nack=lambda: acked.append(False))
+        msg.nack()
+        msg.ack()
+        self.assertEqual(acked, [False])
+        ReceivedMessage(b'x', b'', b'').ack()
+
+        # constructing an event from a message, as it was done before
+        msg = ReceivedMessage(b'x', b'xchg', b'rk', delivery_tag=5,
+                              ack=lambda: acked.append(True))
+        event = MessageReceived(msg)
+        self.assertEqual((event.body, event.routing_key, event.delivery_tag), (b'x', b'rk', 5))
+        event.ack()
+        self.assertTrue(msg.acked)
+        self.assertEqual(acked, [False, True])
+
+        MessageBatch([ReceivedMessage(b'x', b'', b'', nack=lambda: acked.append(False))]).nack()
+        self.assertEqual(acked, [False, True, False])
+
+    def test_batches(self):
+        batches = []
+        self.consume(None, no_ack=False, on_messages=batches.append, batch_size=3)
+        self.deliver(1, 2, 3, 4)
+        self.deliver(5)
+        self.assertEqual([[msg.delivery_tag for msg in batch] for batch in batches],
+                         [[1, 2, 3], [4], [5]])
+
+        batches[1][0].ack()
+        batches[0].ack()
+        batches[2].nack()
+        batches[0].nack()
+        self.assertEqual(self.settled(),
+                         [(BasicAck, 4, False), (BasicAck, 3, True), (BasicReject, 5, False)])
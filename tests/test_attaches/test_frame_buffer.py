@@ -0,0 +1,127 @@
+# coding=UTF-8
+from __future__ import print_function, absolute_import, division
+
+import io
+import unittest
+
+from coolamqp.attaches import FrameBuffer, Publisher
+from coolamqp.exceptions import BufferFull
+from coolamqp.framing.body_stream import AMQPBodyStream, BuffersWithStreams
+from coolamqp.framing.definitions import ConnectionBlocked, ConnectionUnblocked, ChannelOpenOk
+from coolamqp.framing.frames import AMQPBodyFrame
+from coolamqp.objects import Message, StreamedBody
+from tests.test_attaches.test_publisher import make_publisher
+
+
+def serialize(frames):
+    buf = io.BytesIO()
+    for frame in frames:
+        frame.write_to(buf)
+    return buf.getvalue()
+
+
+def join(buffers):
+    return b''.join(bytes(buffer) for buffer in buffers)
+
+
+class TestFrameBuffer(unittest.TestCase):
+    def test_in_memory(self):
+        buf = FrameBuffer()
+        frames = [AMQPBodyFrame(1, b'x' * i) for i in range(100)]
+        buf.extend(frames[:50])
+        buf.extend(frames[50:])
+        self.assertEqual(buf.size, len(serialize(frames)))
+        self.assertFalse(buf.is_full())
+
+        self.assertEqual(join(buf.take()), serialize(frames))
+        self.assertEqual(buf.size, 0)
+        self.assertFalse(buf)
+
+    def test_spill(self):
+        buf = FrameBuffer(memory_limit=1000)
+        frames = [AMQPBodyFrame(1, b'%d' % i * 100) for i in range(100)]
+        for frame in frames:
+            buf.extend([frame])
+        self.assertLessEqual(buf.memory, 1000)
+        self.assertEqual(buf.size, len(serialize(frames)))
+
+        buffers = buf.take()
+        self.assertIsInstance(buffers[-1], memoryview)
+        self.assertEqual(join(buffers), serialize(frames))
+
+    def test_streams_keep_order(self):
+        buf = FrameBuffer(memory_limit=0)
+        stream = AMQPBodyStream(1, StreamedBody(b'streamed'), 100)
+        buf.extend([AMQPBodyFrame(1, b'first')])
+        buf.extend([stream, AMQPBodyFrame(1, b'second')])
+
+        buffers = buf.take()
+        self.assertIsInstance(buffers, BuffersWithStreams)
+        self.assertEqual(buffers.streams, 1)
+        self.assertEqual(len(buffers), 3)
+        self.assertIs(buffers[1], stream)
+        self.assertEqual(bytes(buffers[0]), serialize([AMQPBodyFrame(1, b'first')]))
+        self.assertEqual(bytes(buffers[2]), serialize([AMQPBodyFrame(1, b'second')]))
+
+    def test_full(self):
+        buf = FrameBuffer(memory_limit=100, size_limit=1000)
+        buf.extend([AMQPBodyFrame(1, b'x' * 900)])
+        self.assertFalse(buf.is_full())
+        buf.extend([AMQPBodyFrame(1, b'x' * 100)])
+        self.assertTrue(buf.is_full())
+        buf.take()
+        self.assertFalse(buf.is_full())
+
+
+class TestPublisherBlocked(unittest.TestCase):
+    def test_replay_in_order(self):
+        pub, sent = make_publisher(Publisher.MODE_CNPUB)
+        expected_pub, expected = make_publisher(Publisher.MODE_CNPUB)
+        pub.frames_to_send = FrameBuffer(memory_limit=1000)
+        messages = [Message(b'x' * (i * 100)) for i in range(30)]
+
+        for message in messages[:10]:
+            pub.publish(message, routing_key=b'rk')
+        pub.on_connection_blocked(ConnectionBlocked(b'low on memory'))
+        for message in messages[10:]:
+            pub.publish(message, routing_key=b'rk')
+        self.assertEqual(len(sent), 10)
+        self.assertGreater(pub.buffered_bytes, 1000)
+
+        pub.on_connection_blocked(ConnectionUnblocked())
+        self.assertEqual(pub.buffered_bytes, 0)
+        pub.publish(Message(b'after'), routing_key=b'rk')
+
+        for message in messages + [Message(b'after')]:
+            expected_pub.publish(message, routing_key=b'rk')
+        self.assertEqual(b''.join(join(buffers) for buffers in sent),
+                         b''.join(join(buffers) for buffers in expected))
+
+    def test_buffer_full(self):
+        pub, sent = make_publisher(Publisher.MODE_NOACK)
+        pub.frames_to_send = FrameBuffer(size_limit=1000)
+        pub.on_connection_blocked(ConnectionBlocked(b'low on memory'))
+        pub.publish(Message(b'x' * 1000))
+        self.assertRaises(BufferFull, pub.publish, Message(b'x'))
+        self.assertRaises(BufferFull, pub.publish_many, [(Message(b'x'), b'', b'')])
+        self.assertFalse(sent)
+
+        pub.on_connection_blocked(ConnectionUnblocked())
+        pub.publish(Message(b'x'))
+        self.assertEqual(len(sent), 2)
+
+    def test_dropped_on_fail(self):
+        pub, sent = make_publisher(Publisher.MODE_NOACK)
+        pub.frames_to_send = FrameBuffer(memory_limit=500, size_limit=1000)
+        pub.on_connection_blocked(ConnectionBlocked(b'low on memory'))
+        pub.content_flow = False
+        pub.publish(Message(b'x' * 1000))
+        self.assertRaises(BufferFull, pub.publish, Message(b'y'))
+
+        pub.on_fail()
+        self.assertEqual(pub.buffered_bytes, 0)
+        pub.on_setup(ChannelOpenOk())
+        pub.publish(Message(b'after'))
+        buffers, = sent
+        self.assertNotIn(b'x', join(buffers))
+        self.assertIn(b'after', join(buffers))
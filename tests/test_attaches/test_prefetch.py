@@ -0,0 +1,88 @@
+# coding=UTF-8
+from __future__ import print_function, absolute_import, division
+
+import io
+import unittest
+
+from coolamqp.attaches import Consumer, PrefetchController
+from coolamqp.framing.definitions import BasicConsumeOk, BasicDeliver, BasicContentPropertyList, \
+    BasicQos
+from coolamqp.framing.frames import AMQPMethodFrame, AMQPHeaderFrame, AMQPBodyFrame
+from coolamqp.objects import Queue, NodeDefinition
+from coolamqp.uplink import Connection
+from coolamqp.utils import monotonic
+
+
+class TestPrefetchController(unittest.TestCase):
+    def setUp(self):
+        self.stats = []
+        self.controller = PrefetchController(min_qos=10, max_qos=1000, on_stats=self.stats.append)
+
+    def adjust(self, qos, settled, unacked):
+        # as if a second passed since the last call
+        self.controller.last_tick = monotonic() - 1.0
+        return self.controller.adjust(qos, settled, unacked)
+
+    def test_probes_while_rate_grows(self):
+        self.assertEqual(self.adjust(100, 1000, 100), 150)      # all of prefetch is in use
+        self.assertEqual(self.adjust(150, 1500, 150), 225)
+        self.assertEqual(self.adjust(225, 1520, 150), 150)      # that didn't help
+        results = [self.adjust(150, 1500, 10) for _ in range(8)]
+        self.assertEqual(results, [150] * 7 + [225])            # probing again after a while
+
+        stats = self.stats[0]
+        self.assertEqual((stats.qos, stats.new_qos, stats.unacked), (100, 150, 100))
+        self.assertAlmostEqual(stats.rate, 1000, delta=50)
+        self.assertAlmostEqual(stats.latency, 0.1, delta=0.01)
+
+    def test_capped(self):
+        self.assertEqual(self.adjust(900, 9000, 900), 1000)
+        self.assertEqual(self.adjust(1000, 20000, 1000), 1000)
+        self.assertIsNone(self.controller.probe_from)
+
+    def test_shrinks_when_messages_wait(self):
+        self.assertEqual(self.adjust(100, 1000, 50), 100)
+        # processing is the limit, so more prefetch only adds latency
+        qos = self.adjust(500, 1000, 500)
+        self.assertAlmostEqual(qos, 100, delta=10)
+        self.assertIsNone(self.controller.probe_from)
+        self.assertEqual(self.adjust(5, 1, 5), 10)              # bounded by min_qos
+
+    def test_idle(self):
+        self.assertEqual(self.adjust(100, 0, 0), 100)
+        self.assertIsNone(self.stats[0].latency)
+
+    def test_consumer(self):
+        sent = []
+        conn = Connection(NodeDefinition('127.0.0.1', 'guest', 'guest'), None, [])
+        conn.send = lambda frames, priority=False: sent.extend(frame.payload for frame in frames)
+        self.assertRaises(ValueError, Consumer, Queue(), None, no_ack=True,
+                          prefetch_controller=self.controller)
+        received = []
+        cons = Consumer(Queue(), received.append, no_ack=False,
+                        prefetch_controller=self.controller)
+        self.assertEqual(cons.qos, 10)
+        cons.connection = conn
+        cons.channel_id = 1
+        cons.consumer_tag = b'ctag'
+        cons.on_setup(BasicConsumeOk(b'ctag'))
+
+        buf = io.BytesIO()
+        for tag in range(1, 101):
+            for frame in [AMQPMethodFrame(1, BasicDeliver(b'ctag', tag, False, b'', b'')),
+                          AMQPHeaderFrame(1, 60, 0, 1, BasicContentPropertyList()),
+                          AMQPBodyFrame(1, b'x')]:
+                frame.write_to(buf)
+        conn.recvf.put(buf.getvalue())
+        for msg in received:
+            msg.ack()
+        self.assertEqual(cons.receiver.settled, 100)
+        del sent[:]
+
+        self.controller.last_tick = monotonic() - 1.0
+        cons.receiver.on_prefetch_timer()
+        self.assertEqual(cons.receiver.settled, 0)
+        self.assertEqual(self.stats[0].unacked, 50.5)
+        self.assertEqual(cons.qos, 15)
+        self.assertEqual([(type(payload), payload.prefetch_count) for payload in sent],
+                         [(BasicQos, 15)])
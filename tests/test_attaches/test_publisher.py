@@ -0,0 +1,254 @@
+# coding=UTF-8
+from __future__ import print_function, absolute_import, division
+
+import io
+import unittest
+
+from concurrent.futures import Future
+
+from coolamqp.attaches import Publisher
+from coolamqp.attaches.publisher import PreparedPublish
+from coolamqp.attaches.channeler import ST_ONLINE, ST_OFFLINE
+from coolamqp.attaches.utils import AtomicTagger, AggregateConfirmableRejectable
+from coolamqp.framing.definitions import BasicPublish, ChannelOpenOk
+from coolamqp.framing.frames import AMQPMethodFrame, AMQPHeaderFrame, AMQPBodyFrame
+from coolamqp.framing.body_stream import AMQPBodyStream
+from coolamqp.objects import Message, MessageProperties, NodeDefinition, Exchange, \
+    StreamedBody, EMPTY_PROPERTIES
+from coolamqp.uplink import Connection
+from coolamqp.uplink.connection.send_framer import SendingFramer
+
+
+def make_publisher(mode):
+    sent = []
+    conn = Connection(NodeDefinition('127.0.0.1', 'guest', 'guest'), None, [])
+    conn.frame_max = 131072
+    conn.sendf = SendingFramer(lambda data, priority: sent.append(data))
+    pub = Publisher(mode)
+    pub.connection = conn
+    pub.channel_id = 1
+    pub.state = ST_ONLINE
+    if mode == Publisher.MODE_CNPUB:
+        pub.tagger = AtomicTagger()
+    return pub, sent
+
+
+class TestPublishMany(unittest.TestCase):
+    def test_single_send(self):
+        pub, sent = make_publisher(Publisher.MODE_NOACK)
+        conn_frames = []
+        pub.connection.send = lambda frames, priority=False: conn_frames.append(frames)
+        pub.publish_many([(Message(b'hello'), u'xchg', u'rk'),
+                          (Message(b''), Exchange(u'other'), b'rk2'),
+                          (Message(b'x' * 200000), b'', b'')])
+        frames, = conn_frames
+        self.assertEqual([type(frame) for frame in frames],
+                         [AMQPMethodFrame, AMQPHeaderFrame, AMQPBodyFrame,
+                          AMQPMethodFrame, AMQPHeaderFrame,
+                          AMQPMethodFrame, AMQPHeaderFrame, AMQPBodyFrame, AMQPBodyFrame])
+        self.assertIsInstance(frames[0].payload, BasicPublish)
+        self.assertEqual(frames[0].payload.exchange, b'xchg')
+        self.assertEqual(frames[3].payload.exchange, b'other')
+
+    def test_streamed_body(self):
+        pub, sent = make_publisher(Publisher.MODE_NOACK)
+        conn_frames = []
+        pub.connection.send = lambda frames, priority=False: conn_frames.append(frames)
+        pub.publish(Message(StreamedBody(iter([b'x' * 10]), 10)))
+        pub.publish(Message(StreamedBody(b'')))
+        (method, header, body), (_, empty_header) = conn_frames
+        self.assertIsInstance(body, AMQPBodyStream)
+        self.assertEqual(header.body_size, 10)
+        self.assertEqual(empty_header.body_size, 0)
+
+    def test_held_back_when_blocked(self):
+        pub, sent = make_publisher(Publisher.MODE_NOACK)
+        pub.blocked = True
+        pub.publish_many([(Message(b'hello'), b'', b'')] * 2)
+        self.assertEqual(sent, [])
+        # the frames of both messages are held back serialized, as a single piece
+        frames, _ = pub._get_frames(Message(b'hello'), b'', b'')
+        self.assertEqual(len(pub.frames_to_send), 1)
+        self.assertEqual(pub.buffered_bytes,
+                         2 * sum(frame.get_size() for frame in frames))
+
+    def test_futures(self):
+        pub, sent = make_publisher(Publisher.MODE_CNPUB)
+        futures = pub.publish_many([(Message(b'hello'), b'', b'')] * 3)
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(len(futures), 3)
+        pub.tagger.ack(2, True)
+        pub.tagger.nack(3, False)
+        self.assertIsNone(futures[0].result(0))
+        self.assertIsNone(futures[1].result(0))
+        self.assertRaises(Exception, futures[2].result, 0)
+
+    def test_aggregate(self):
+        pub, sent = make_publisher(Publisher.MODE_CNPUB)
+        fut = pub.publish_many([(Message(b'hello'), b'', b'')] * 3, aggregate=True)
+        self.assertEqual(len(sent), 1)
+        pub.tagger.ack(2, True)
+        self.assertFalse(fut.done())
+        pub.tagger.ack(3, False)
+        self.assertIsNone(fut.result(0))
+
+
+    def test_callbacks(self):
+        pub, sent = make_publisher(Publisher.MODE_CNPUB)
+        confirmed = []
+        messages = [Message(b'%d' % i) for i in range(3)]
+        self.assertIsNone(pub.publish_many([(message, b'', b'') for message in messages],
+                                           on_confirmed=lambda *args: confirmed.append(args)))
+        self.assertIsNone(pub.publish_many([(message, b'', b'') for message in messages],
+                                           aggregate=True,
+                                           on_confirmed=lambda *args: confirmed.append(args)))
+        pub.tagger.nack(2, False)
+        pub.tagger.ack(6, True)
+        self.assertEqual(confirmed, [(messages[1], False), (messages[0], True),
+                                     (messages[2], True), (messages, True)])
+
+
+class TestPublish(unittest.TestCase):
+    def test_on_confirmed(self):
+        pub, sent = make_publisher(Publisher.MODE_CNPUB)
+        confirmed = []
+        message = Message(b'hello')
+        self.assertIsNone(pub.publish(message, on_confirmed=lambda *args: confirmed.append(args)))
+        self.assertEqual(len(sent), 1)
+        self.assertFalse(pub.messages)
+        pub.tagger.ack(1, False)
+        self.assertEqual(confirmed, [(message, True)])
+
+    def test_queued_while_offline(self):
+        pub, sent = make_publisher(Publisher.MODE_CNPUB)
+        pub.state = ST_OFFLINE
+        confirmed = []
+        fut = pub.publish(Message(b'hello'))
+        pub.publish(Message(b'hello'), on_confirmed=lambda *args: confirmed.append(args))
+        self.assertEqual(sent, [])
+        pub.state = ST_ONLINE
+        pub._mode_cnpub_process_deliveries()
+        pub.tagger.ack(2, True)
+        self.assertIsNone(fut.result(0))
+        self.assertEqual(len(confirmed), 1)
+
+
+class TestAggregateConfirmableRejectable(unittest.TestCase):
+    def make(self, count):
+        fut = Future()
+        fut.set_running_or_notify_cancel()
+        return fut, AggregateConfirmableRejectable.for_future(fut, count)
+
+    def test_confirm(self):
+        fut, acr = self.make(2)
+        acr.confirm()
+        self.assertFalse(fut.done())
+        acr.confirm()
+        self.assertIsNone(fut.result(0))
+
+    def test_reject(self):
+        fut, acr = self.make(3)
+        acr.confirm()
+        acr.reject()
+        acr.reject()
+        acr.confirm()
+        self.assertRaises(Exception, fut.result, 0)
+
+    def test_empty(self):
+        fut, acr = self.make(0)
+        self.assertIsNone(fut.result(0))
+
+
+class TestPreparedPublish(unittest.TestCase):
+    def assertSameAsPublish(self, pub, sent, prepared, body):
+        del sent[:]
+        prepared.send(body)
+        via_prepared = b''.join(bytes(buffer) for data in sent for buffer in data)
+        del sent[:]
+        pub.publish(Message(body, prepared.properties), prepared.exchange, prepared.routing_key)
+        via_publish = b''.join(bytes(buffer) for data in sent for buffer in data)
+        self.assertEqual(via_prepared, via_publish)
+
+    def test_same_as_publish(self):
+        pub, sent = make_publisher(Publisher.MODE_NOACK)
+        pub.connection.frame_max = 4096
+        prepared = PreparedPublish(pub, b'xchg', b'rkey',
+                                   MessageProperties(content_type=b'text/plain',
+                                                     headers={'a': 1}))
+        for body in (b'', b'hello', b'x' * 2000, b'y' * 10000):
+            self.assertSameAsPublish(pub, sent, prepared, body)
+
+        pub.channel_id = 2
+        self.assertSameAsPublish(pub, sent, prepared, b'hello')
+        self.assertEqual(prepared.channel_id, 2)
+
+    def test_received_properties(self):
+        pub, sent = make_publisher(Publisher.MODE_NOACK)
+        props = MessageProperties(content_type=b'text/plain', headers={'a': 1})
+        buf = io.BytesIO()
+        AMQPHeaderFrame(1, 60, 0, 5, props).write_to(buf)
+        received = AMQPHeaderFrame.unserialize(1, memoryview(buf.getvalue())[7:-1]).properties
+        prepared = PreparedPublish(pub, b'xchg', b'rkey', received)
+        self.assertSameAsPublish(pub, sent, prepared, b'hello')
+
+    def test_confirms(self):
+        pub, sent = make_publisher(Publisher.MODE_CNPUB)
+        prepared = PreparedPublish(pub, b'', b'rkey', MessageProperties())
+        fut = prepared.send(b'hello')
+        confirmed = []
+        prepared.send(b'hello', on_confirmed=lambda *args: confirmed.append(args))
+        pub.state = ST_OFFLINE
+        queued = prepared.send(b'later')
+        self.assertEqual(len(pub.messages), 1)
+        pub.state = ST_ONLINE
+        pub._mode_cnpub_process_deliveries()
+        self.assertEqual(len(sent), 3)
+
+        pub.tagger.ack(3, True)
+        self.assertIsNone(fut.result(0))
+        self.assertIsNone(queued.result(0))
+        self.assertEqual(confirmed[0][0].body, b'hello')
+
+
+class TestReconnectBuffer(unittest.TestCase):
+    def make_offline_publisher(self, **kwargs):
+        pub, sent = make_publisher(Publisher.MODE_NOACK)
+        pub.reconnect_buffer_messages = kwargs.get('messages', 0)
+        pub.reconnect_buffer_bytes = kwargs.get('bytes')
+        pub.state = ST_OFFLINE
+        return pub, sent
+
+    def test_dropped_by_default(self):
+        pub, sent = self.make_offline_publisher()
+        pub.publish(Message(b'hello'))
+        pub.on_setup(ChannelOpenOk())
+        self.assertEqual(pub.state, ST_ONLINE)
+        self.assertEqual(sent, [])
+
+    def test_sent_on_reconnect(self):
+        pub, sent = self.make_offline_publisher(messages=3)
+        pub.publish(Message(b'first'), routing_key=b'rk')
+        pub.publish_many([(Message(b'second'), b'', b'rk'), (Message(b'third'), b'', b'rk')])
+        PreparedPublish(pub, b'', b'rk', EMPTY_PROPERTIES).send(b'fourth')
+        self.assertEqual(sent, [])
+
+        pub.on_setup(ChannelOpenOk())
+        self.assertEqual(pub.state, ST_ONLINE)
+        buffers, = sent
+        data = b''.join(bytes(buffer) for buffer in buffers)
+        self.assertNotIn(b'first', data)
+        self.assertLess(data.index(b'second'), data.index(b'third'))
+        self.assertLess(data.index(b'third'), data.index(b'fourth'))
+        self.assertFalse(pub.reconnect_buffer)
+
+    def test_bytes_limit(self):
+        pub, sent = self.make_offline_publisher(messages=100, bytes=10)
+        pub.publish(Message(b'a' * 6))
+        pub.publish(Message(b'b' * 4))
+        pub.publish(Message(b'c' * 4))
+        self.assertEqual([message.body for message, _, _ in pub.reconnect_buffer],
+                         [b'b' * 4, b'c' * 4])
+        self.assertEqual(pub.reconnect_buffer_size, 8)
+        pub.publish(Message(b'd' * 11))
+        self.assertFalse(pub.reconnect_buffer)
+        self.assertEqual(pub.reconnect_buffer_size, 0)
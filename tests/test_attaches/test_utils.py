@@ -0,0 +1,157 @@
+# coding=UTF-8
+from __future__ import print_function, absolute_import, division
+
+import random
+import unittest
+
+from coolamqp.attaches.utils import AtomicTagger, DeliveryTagSet
+
+
+class Tracked(object):
+    def __init__(self, tag, results):
+        self.tag = tag
+        self.results = results
+
+    def confirm(self):
+        self.results.append((self.tag, True))
+
+    def reject(self):
+        self.results.append((self.tag, False))
+
+
+class TestAtomicTagger(unittest.TestCase):
+    def setUp(self):
+        self.results = []
+        self.tagger = AtomicTagger()
+
+    def deposit(self, *tags):
+        for tag in tags:
+            self.tagger.deposit(tag, Tracked(tag, self.results))
+
+    def test_single_and_multiple(self):
+        self.deposit(1, 2, 3, 4, 5)
+        self.tagger.ack(3, False)
+        self.tagger.ack(3, False)
+        self.tagger.nack(4, True)
+        self.tagger.ack(10, False)
+        self.tagger.ack(0, True)
+        self.assertEqual(self.results, [(3, True), (1, False), (2, False), (4, False), (5, True)])
+
+    def test_out_of_order_deposit(self):
+        self.deposit(5, 7, 3, 6, 1)
+        self.tagger.ack(5, True)
+        self.assertEqual(self.results, [(1, True), (3, True), (5, True)])
+        self.deposit(2)
+        self.tagger.ack(7, True)
+        self.assertEqual(self.results[3:], [(2, True), (6, True), (7, True)])
+
+    def test_against_model(self):
+        rng = random.Random(1)
+        held = set()
+        for step in range(20000):
+            if rng.random() < 0.55:
+                tag = self.tagger.get_key()
+                if rng.random() < 0.9:  # some keys are never deposited
+                    self.deposit(tag)
+                    held.add(tag)
+                continue
+
+            tag = rng.randint(0, self.tagger.next_tag)
+            multiple = rng.random() < 0.3
+            if not tag:
+                expected = sorted(held)
+            elif multiple:
+                expected = sorted(t for t in held if t <= tag)
+            else:
+                expected = [tag] if tag in held else []
+
+            del self.results[:]
+            self.tagger.ack(tag, multiple)
+            self.assertEqual([t for t, _ in self.results], expected)
+            held.difference_update(expected)
+
+        self.tagger.ack(0, True)
+        self.assertEqual(sorted(t for t, _ in self.results), sorted(held))
+        self.assertEqual(self.tagger.slots, [])
+
+
+class SmallDeliveryTagSet(DeliveryTagSet):
+    __slots__ = ()
+    MAX_BITMAP_BYTES = 16
+
+
+class TestDeliveryTagSet(unittest.TestCase):
+    def test_basic(self):
+        tags = DeliveryTagSet()
+        self.assertIsNone(tags.lowest())
+        for tag in (1, 2, 3, 10):
+            tags.add(tag)
+        self.assertRaises(ValueError, tags.add, 10)
+        self.assertEqual(len(tags), 4)
+        self.assertIn(10, tags)
+        self.assertNotIn(4, tags)
+
+        self.assertTrue(tags.discard(2))
+        self.assertFalse(tags.discard(2))
+        self.assertRaises(KeyError, tags.remove, 5)
+        self.assertEqual(tags.lowest(), 1)
+        tags.remove(1)
+        self.assertEqual(tags.lowest(), 3)
+        tags.remove(3)
+        tags.remove(10)
+        self.assertIsNone(tags.lowest())
+        self.assertFalse(tags)
+
+    def test_stays_small(self):
+        tags = SmallDeliveryTagSet()
+        tags.add(1)     # never removed
+        for tag in range(2, 100000):
+            tags.add(tag)
+            if tag > 21:
+                tags.remove(tag - 20)
+        self.assertLessEqual(len(tags.bits), 256)
+        self.assertEqual(len(tags), 21)
+        self.assertEqual(tags.lowest(), 1)
+        tags.remove(1)
+        self.assertEqual(tags.lowest(), 99980)
+
+    def test_lowest_straggler(self):
+        tags = SmallDeliveryTagSet()
+        for tag in range(1, 100000):
+            tags.add(tag)
+            if tag % 1000 and tag > 20:
+                tags.remove(tag - 20)
+        stragglers = sorted(tags.stragglers)
+        self.assertGreater(len(stragglers), 50)
+        tags.remove(stragglers[1])
+        self.assertEqual(tags.lowest(), stragglers[0])
+        tags.remove(stragglers[0])
+        self.assertEqual(tags.lowest(), stragglers[2])
+        for tag in stragglers[3:]:
+            tags.remove(tag)
+        self.assertEqual(tags.lowest(), stragglers[2])
+        tags.remove(stragglers[2])
+        self.assertEqual(tags.lowest(), 98980)  # still in the bitmap
+        for tag in range(100000, 200000):
+            tags.add(tag)
+            tags.remove(tag - 20)
+        self.assertLessEqual(len(tags.straggler_order), 64)
+
+    def test_against_model(self):
+        rng = random.Random(1)
+        tags = SmallDeliveryTagSet()
+        held = set()
+        next_tag = 1
+        for step in range(20000):
+            if rng.random() < 0.5 or not held:
+                next_tag += rng.choice([1, 1, 1, 2, 50])
+                tags.add(next_tag)
+                held.add(next_tag)
+            else:
+                tag = rng.choice(sorted(held)[:5]) if rng.random() < 0.7 else rng.randint(0, next_tag)
+                self.assertEqual(tags.discard(tag), tag in held)
+                held.discard(tag)
+            self.assertEqual(len(tags), len(held))
+            self.assertEqual(tags.lowest(), min(held) if held else None)
+            tag = rng.randint(0, next_tag + 1)
+            self.assertEqual(tag in tags, tag in held)
@@ -0,0 +1,88 @@
+# coding=UTF-8
+from __future__ import print_function, absolute_import, division
+
+import threading
+import time
+import unittest
+
+from coolamqp.attaches import InFlightWindow, Publisher
+from coolamqp.attaches.utils import AtomicTagger
+from coolamqp.exceptions import WindowFull
+from coolamqp.objects import Message
+from coolamqp.uplink import ListenerThread
+from tests.test_attaches.test_publisher import make_publisher
+
+
+class TestInFlightWindow(unittest.TestCase):
+    def test_limits(self):
+        window = InFlightWindow(max_messages=2, max_bytes=100, timeout=0)
+        window.acquire(1, 10)
+        window.acquire(1, 10)
+        self.assertFalse(window.has_room())
+        self.assertRaises(WindowFull, window.acquire, 1, 0)
+        window.release(2, 20)
+        window.acquire(1, 90)
+        self.assertRaises(WindowFull, window.acquire, 1, 11)
+        window.acquire(1, 10)
+
+    def test_oversized_passes_when_empty(self):
+        window = InFlightWindow(max_messages=2, max_bytes=100, timeout=0)
+        window.acquire(5, 1000)
+        self.assertRaises(WindowFull, window.acquire, 1, 0)
+
+    def test_blocks_until_released(self):
+        window = InFlightWindow(max_messages=1, timeout=5)
+        window.acquire(1, 0)
+        threading.Timer(0.1, lambda: window.release(1, 0)).start()
+        started = time.time()
+        window.acquire(1, 0)
+        self.assertGreater(time.time() - started, 0.05)
+
+    def test_timeout(self):
+        window = InFlightWindow(max_messages=1, timeout=0.1)
+        window.acquire(1, 0)
+        self.assertRaises(WindowFull, window.acquire, 1, 0)
+
+    def test_listener_thread_does_not_wait(self):
+        window = InFlightWindow(max_messages=1)
+        window.acquire(1, 0)
+        raised = []
+
+        class Listener(ListenerThread):
+            def run(self):
+                try:
+                    window.acquire(1, 0)
+                except WindowFull:
+                    raised.append(True)
+
+        listener = Listener()
+        listener.start()
+        listener.join(5)
+        self.assertEqual(raised, [True])
+
+    def test_adaptive(self):
+        window = InFlightWindow(max_messages=100, adaptive=True, min_messages=10)
+        window._adapt(1, 0.01)
+        window._adapt(1, 0.1)  # queueing
+        self.assertEqual(window.limit, 75)
+        window._adapt(1, 0.1)  # not again within that latency
+        self.assertEqual(window.limit, 75)
+        for i in range(75):
+            window._adapt(1, 0.01)
+        self.assertAlmostEqual(window.limit, 76, places=0)
+        self.assertRaises(ValueError, InFlightWindow, adaptive=True)
+
+
+class TestPublisherWindow(unittest.TestCase):
+    def test_released_on_ack_and_fail(self):
+        pub, sent = make_publisher(Publisher.MODE_CNPUB)
+        pub.window = InFlightWindow(max_messages=3, timeout=0)
+        pub.tagger = AtomicTagger(pub.window)
+        pub.publish(Message(b'hello'))
+        pub.publish_many([(Message(b'hello'), b'', b'')] * 2)
+        self.assertRaises(WindowFull, pub.publish, Message(b'hello'))
+        self.assertEqual((pub.window.messages, pub.window.bytes), (3, 15))
+        pub.tagger.ack(2, True)
+        self.assertEqual((pub.window.messages, pub.window.bytes), (1, 5))
+        pub.on_fail()
+        self.assertEqual((pub.window.messages, pub.window.bytes), (0, 0))
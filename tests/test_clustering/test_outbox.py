@@ -0,0 +1,197 @@
+# coding=UTF-8
+from __future__ import print_function, absolute_import, division
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from coolamqp.clustering.outbox import Outbox
+from coolamqp.objects import Callable, Message, MessageProperties
+
+
+class FakeSNR(object):
+    def __init__(self):
+        self.on_fail = Callable()
+        self.on_connected = Callable()
+
+
+class RecordingCluster(object):
+    """Takes place of a Cluster, remembering what was published"""
+
+    def __init__(self, fail=False):
+        self.snr = FakeSNR()
+        self.fail = fail
+        self.batches = []  # list of (messages, on_confirmed)
+        self.published = threading.Event()
+
+    def publish_many(self, messages, aggregate=False, on_confirmed=None):
+        assert aggregate
+        if self.fail:
+            raise IOError('no way')
+        self.batches.append((list(messages), on_confirmed))
+        self.published.set()
+
+    def wait_for(self, count, timeout=5):
+        deadline = time.time() + timeout
+        while sum(len(messages) for messages, _ in self.batches) < count:
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+
+    def assertLess(self, a, b):
+        assert a < b, 'timed out'
+
+    def confirm_all(self, confirmed=True):
+        batches, self.batches = self.batches, []
+        for messages, on_confirmed in batches:
+            on_confirmed([message for message, _, _ in messages], confirmed)
+
+
+class TestOutbox(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def logs(self):
+        return sorted(os.listdir(self.directory))
+
+    def test_publish_and_confirm(self):
+        cluster = RecordingCluster()
+        outbox = Outbox(cluster, self.directory, segment_size=4096)
+        outbox.start()
+        for i in range(100):
+            outbox.publish(Message(b'%d' % i * 10), u'xchg', u'rk')
+        cluster.wait_for(100)
+        self.assertEqual(outbox.pending, 100)
+        self.assertGreater(len(self.logs()), 1)
+
+        bodies = [message.body for messages, _ in cluster.batches
+                  for message, _, _ in messages]
+        self.assertEqual(bodies, [b'%d' % i * 10 for i in range(100)])
+        message, exchange, routing_key = cluster.batches[0][0][0]
+        self.assertEqual(exchange, b'xchg')
+        self.assertEqual(routing_key, b'rk')
+
+        cluster.confirm_all()
+        self.assertTrue(outbox.wait(0))
+        # only the segment being written to is left
+        self.assertEqual(len(self.logs()), 1)
+        outbox.close()
+        self.assertEqual(self.logs(), [])
+
+    def test_recovery(self):
+        cluster = RecordingCluster()
+        outbox = Outbox(cluster, self.directory)
+        outbox.start()
+        properties = MessageProperties(content_type=b'text/plain', headers={'a': 1})
+        for i in range(3):
+            outbox.publish(Message(b'body %d' % i, properties), routing_key=b'q')
+        cluster.wait_for(3)
+        outbox.close()
+
+        # a torn record at the end is ignored
+        log, = self.logs()
+        with open(os.path.join(self.directory, log), 'r+b') as f:
+            data = f.read()
+            f.seek(data.rindex(b'body 2') + 6)
+            f.write(b'\x00\x00\x01\x00garbage')
+
+        cluster = RecordingCluster()
+        outbox = Outbox(cluster, self.directory)
+        outbox.start()
+        cluster.wait_for(3)
+        messages = [message for message, _, _ in cluster.batches[0][0]]
+        self.assertEqual([message.body for message in messages],
+                         [b'body 0', b'body 1', b'body 2'])
+        self.assertEqual(messages[0].properties.content_type, b'text/plain')
+        self.assertEqual(messages[0].properties.headers[b'a'][0], 1)
+
+        cluster.confirm_all()
+        self.assertTrue(outbox.wait(1))
+        outbox.close()
+        self.assertEqual(self.logs(), [])
+
+    def test_republished(self):
+        cluster = RecordingCluster()
+        outbox = Outbox(cluster, self.directory, sync=False)
+        outbox.start()
+        outbox.publish(Message(b'hello'))
+        cluster.wait_for(1)
+
+        # rejected
+        cluster.confirm_all(False)
+        cluster.wait_for(1)
+
+        # lost with the connection
+        cluster.snr.on_fail()
+        cluster.snr.on_connected()
+        cluster.wait_for(2)
+        cluster.confirm_all()
+        self.assertTrue(outbox.wait(1))
+        outbox.close()
+        self.assertFalse(cluster.snr.on_fail.callables)
+        self.assertFalse(cluster.snr.on_connected.callables)
+
+    def test_reconnecting(self):
+        cluster = RecordingCluster()
+        outbox = Outbox(cluster, self.directory, sync=False, batch_size=2, max_in_flight=2)
+        outbox.start()
+        for i in range(4):
+            outbox.publish(Message(b'%d' % i))
+        cluster.wait_for(2)
+
+        # every attempt to reconnect fails
+        for _ in range(5):
+            cluster.snr.on_fail()
+        outbox.publish(Message(b'4'))
+        time.sleep(0.05)
+        self.assertEqual(len(cluster.batches), 1)
+        self.assertEqual(outbox.in_flight_count, 2)
+
+        # confirms of the connection that was lost don't count
+        cluster.confirm_all()
+        self.assertEqual(outbox.pending, 5)
+
+        cluster.snr.on_connected()
+        cluster.wait_for(2)
+        self.assertEqual([message.body for message, _, _ in cluster.batches[0][0]],
+                         [b'0', b'1'])
+        for _ in range(2):
+            cluster.confirm_all()
+            cluster.wait_for(1)
+        cluster.confirm_all()
+        self.assertTrue(outbox.wait(1))
+        outbox.close()
+
+    def test_retry(self):
+        cluster = RecordingCluster(fail=True)
+        outbox = Outbox(cluster, self.directory, retry_interval=0.01)
+        outbox.start()
+        outbox.publish(Message(b'hello'))
+        time.sleep(0.05)
+        self.assertFalse(cluster.batches)
+        cluster.fail = False
+        cluster.wait_for(1)
+        self.assertEqual(outbox.pending, 1)
+        outbox.close()
+
+    def test_group_commit(self):
+        cluster = RecordingCluster()
+        outbox = Outbox(cluster, self.directory, segment_size=65536)
+        outbox.start()
+
+        def publish():
+            for _ in range(200):
+                outbox.publish(Message(b'x' * 100))
+
+        threads = [threading.Thread(target=publish) for _ in range(4)]
+        [thread.start() for thread in threads]
+        [thread.join() for thread in threads]
+        cluster.wait_for(800)
+        cluster.confirm_all()
+        self.assertTrue(outbox.wait(1))
+        outbox.close()
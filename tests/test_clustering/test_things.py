@@ -4,14 +4,16 @@ from __future__ import print_function, absolute_import, division
 
 import logging
 import os
+import tempfile
+import threading
 import time
 import unittest
 
 from coolamqp.framing.definitions import BasicContentPropertyList
 
-from coolamqp.clustering import Cluster
+from coolamqp.clustering import Cluster, Outbox
 from coolamqp.exceptions import ConnectionDead
-from coolamqp.objects import NodeDefinition, Queue, Exchange
+from coolamqp.objects import NodeDefinition, Queue, Exchange, Message
 
 NODE = NodeDefinition(os.environ.get('AMQP_HOST', '127.0.0.1'), 'guest', 'guest', heartbeat=20)
 logging.getLogger('coolamqp').setLevel(logging.DEBUG)
@@ -89,6 +91,47 @@ class TestConnecting(unittest.TestCase):
         time.sleep(5)
         self.assertFalse(q['failed'])
 
+    def test_publisher_channels(self):
+        c = Cluster([NODE], publisher_channels=3)
+        c.start(wait=True, timeout=None)
+        results = []
+
+        def publish():
+            results.append((c._get_publisher(True),
+                            c.publish(Message(b'test'), routing_key='test', confirm=True)))
+
+        threads = [threading.Thread(target=publish) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(set(publisher for publisher, _ in results)), 3)
+        for _, fut in results:
+            fut.result()
+        c.shutdown(True)
+
+    def test_outbox(self):
+        directory = tempfile.mkdtemp()
+        c = Cluster([NODE])
+        c.start(wait=True, timeout=None)
+        got = []
+        cons, fut = c.consume(Queue(u'outbox', exclusive=True, auto_delete=True),
+                              on_message=lambda message: got.append(message.body), no_ack=True)
+        fut.result()
+
+        outbox = Outbox(c, directory)
+        outbox.start()
+        for i in range(100):
+            outbox.publish(Message(b'%d' % i), routing_key=u'outbox')
+        self.assertTrue(outbox.wait(10))
+        outbox.close()
+        time.sleep(1)
+        self.assertEqual(got, [b'%d' % i for i in range(100)])
+        self.assertEqual(os.listdir(directory), [])
+        os.rmdir(directory)
+        c.shutdown(True)
+
     def test_start_called_multiple_times(self):
         c = Cluster([NODE])
         c.start(wait=True, timeout=20)
@@ -1,7 +1,18 @@
 import io
+import json
+import os
+import tempfile
 import unittest
 
-from coolamqp.framing.field_table import enframe_table
+import six
+
+from coolamqp.framing.definitions import BasicContentPropertyList
+from coolamqp.framing.frames import AMQPHeaderFrame
+from coolamqp.framing.field_table import enframe_table, deframe_table, FieldTableView, \
+    frame_table_size
+from coolamqp.framing.lazy_properties import LazyContentPropertyList
+from coolamqp.framing.compilation import property_cache
+from coolamqp.framing.compilation.table_encoder import encode_table, compile_table_encoder
 
 from coolamqp.argumentify import argumentify
 
@@ -11,3 +22,203 @@ class TestFraming(unittest.TestCase):
         buf = io.BytesIO()
         args = argumentify({'x-match': 'all', 'format': 'pdf'})
         enframe_table(buf, args)
+
+    def test_array_roundtrip(self):
+        headers = [(b'list', ([(1, 'b'), (b'two', 'S'), ([(3, 'b')], 'A')], 'A')),
+                   (b'after', (5, 'b'))]
+        buf = io.BytesIO()
+        enframe_table(buf, headers)
+        data = buf.getvalue()
+        self.assertEqual(deframe_table(memoryview(data), 0), (headers, len(data)))
+
+        buf = io.BytesIO()
+        BasicContentPropertyList(headers=headers).write_to(buf)
+        lazy = LazyContentPropertyList(BasicContentPropertyList, memoryview(buf.getvalue()), 0)
+        self.assertEqual(dict(lazy.headers), dict(headers))
+
+
+class TestPropertyCache(unittest.TestCase):
+    FIELDS = ('content_type', 'correlation_id', 'reserved')
+
+    def setUp(self):
+        self.particular_classes = dict(BasicContentPropertyList.PARTICULAR_CLASSES)
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        BasicContentPropertyList.PARTICULAR_CLASSES.clear()
+        BasicContentPropertyList.PARTICULAR_CLASSES.update(self.particular_classes)
+        os.unlink(self.path)
+
+    def forget(self):
+        particular = BasicContentPropertyList.typize(*self.FIELDS)
+        zpf, = [zpf for zpf, cls in BasicContentPropertyList.PARTICULAR_CLASSES.items()
+                if cls is particular]
+        del BasicContentPropertyList.PARTICULAR_CLASSES[zpf]
+        return zpf, particular
+
+    def test_save_and_load(self):
+        property_cache.warm_up(BasicContentPropertyList, self.FIELDS)
+        property_cache.save(self.path)
+        property_cache.save(self.path)  # replaces the file
+        zpf, particular = self.forget()
+
+        self.assertEqual(property_cache.load(self.path), 1)
+        loaded = BasicContentPropertyList.PARTICULAR_CLASSES[zpf]
+        self.assertIsNot(loaded, particular)
+        props = loaded(b'text/plain', b'1', b'')
+        self.assertEqual(props.to_bytes(), particular(b'text/plain', b'1', b'').to_bytes())
+
+    def test_invalid_entries(self):
+        property_cache.warm_up(BasicContentPropertyList, self.FIELDS)
+        property_cache.save(self.path)
+        zpf, particular = self.forget()
+
+        with open(self.path, 'r') as f:
+            data = json.load(f)
+        data['classes']['BasicContentPropertyList'][:0] = ['not hex', {'source': 'import os'}]
+        with open(self.path, 'w') as f:
+            json.dump(data, f)
+
+        self.assertEqual(property_cache.load(self.path), 1)
+        self.assertIn(zpf, BasicContentPropertyList.PARTICULAR_CLASSES)
+
+    def test_load_corrupted(self):
+        with open(self.path, 'w') as f:
+            f.write('{not json')
+        self.assertEqual(property_cache.load(self.path), 0)
+
+
+class TestTableEncoder(unittest.TestCase):
+    def test_same_as_enframe_table(self):
+        for table in ({'trace-id': 'abc', b'hops': 3, 'big': 2 ** 40, 'negative': -300,
+                       'ratio': 0.5, 'sampled': True}, {}):
+            buf = io.BytesIO()
+            enframe_table(buf, argumentify(table))
+            self.assertEqual(encode_table(table), buf.getvalue())
+
+    def test_cached(self):
+        table = {'a': 'b', 'c': 1}
+        encode_table(table)
+        encoder = compile_table_encoder((('a', str), ('c', int)))
+        self.assertIs(compile_table_encoder((('a', str), ('c', int))), encoder)
+
+    def test_strings_compiled(self):
+        # type() of a value is never basestring on Python 2
+        for value_type in (six.binary_type, six.text_type):
+            self.assertIsNotNone(compile_table_encoder(((b'a', value_type), )))
+        self.assertEqual(encode_table({'a': b'x', 'b': u'\u0105'}),
+                         compile_table_encoder(((b'a', six.binary_type),
+                                                (b'b', six.text_type)))(b'x', u'\u0105'))
+
+    def test_unsupported(self):
+        self.assertIsNone(encode_table({'a': [1, 2]}))
+        self.assertIsNone(encode_table({'a': {'b': 1}}))
+        self.assertIsNone(encode_table({'a' * 256: 1}))
+
+
+class TestFieldTableView(unittest.TestCase):
+    def setUp(self):
+        buf = io.BytesIO()
+        enframe_table(buf, [(b'x-trace', (b'abc', 'S')), (b'hops', (3, 'b')), (b'ratio', (0.5, 'd')),
+                            (b'nested', ([(b'a', (1, 'b'))], 'F')),
+                            (b'list', ([(1, 'b'), (2, 'b')], 'A'))])
+        self.data = buf.getvalue()
+
+    def test_lookup(self):
+        view = FieldTableView(memoryview(b'\x00' + self.data), 1)
+        self.assertIsNone(view.index)
+        self.assertEqual(view[b'hops'], (3, 'b'))
+        self.assertEqual(view['x-trace'], (b'abc', 'S'))
+        self.assertEqual(len(view.decoded), 2)
+        self.assertIn('ratio', view)
+        self.assertNotIn(b'missing', view)
+        self.assertIsNone(view.get('missing'))
+        self.assertRaises(KeyError, lambda: view['missing'])
+        self.assertEqual(len(view), 5)
+
+        nested, tp = view['nested']
+        self.assertEqual(tp, 'F')
+        self.assertIsInstance(nested, FieldTableView)
+        self.assertEqual(dict(nested), {b'a': (1, 'b')})
+
+    def test_list_semantics(self):
+        # received headers used to be a list of (name, field-value)
+        view = FieldTableView(memoryview(self.data), 0)
+        table, _ = deframe_table(memoryview(self.data), 0)
+        self.assertEqual(view[0], (b'x-trace', (b'abc', 'S')))
+        self.assertEqual(view[-1], table[-1])
+        self.assertEqual(view[1:3], table[1:3])
+        self.assertEqual([name for name, _ in view], [name for name, _ in table])
+        self.assertEqual(list(view)[:3], table[:3])
+        self.assertIn((b'hops', (3, 'b')), view)
+        self.assertEqual(view.keys(), [b'x-trace', b'hops', b'ratio', b'nested', b'list'])
+        self.assertEqual(view.values()[1], (3, 'b'))
+        self.assertEqual(view[:2], [(b'x-trace', (b'abc', 'S')), (b'hops', (3, 'b'))])
+        self.assertEqual(view, table)
+        self.assertNotEqual(view, [])
+
+    def test_same_as_eager(self):
+        view = FieldTableView(memoryview(self.data), 0)
+        table, length = deframe_table(memoryview(self.data), 0)
+        self.assertEqual(length, view.get_size())
+        table = dict(table)
+        table[b'nested'] = dict(table[b'nested'][0]), 'F'
+        self.assertEqual(dict(view), table)
+
+    def test_enframing(self):
+        view = FieldTableView(memoryview(self.data), 0)
+        self.assertEqual(frame_table_size(view), len(self.data))
+        buf = io.BytesIO()
+        enframe_table(buf, view)
+        self.assertEqual(buf.getvalue(), self.data)
+
+        buf = io.BytesIO()
+        enframe_table(buf, argumentify({'inner': view}))
+        table, _ = deframe_table(memoryview(buf.getvalue()), 0)
+        self.assertEqual(dict(table[0][1][0])[b'hops'], (3, 'b'))
+
+
+class TestLazyContentPropertyList(unittest.TestCase):
+    def test_lazy_decoding(self):
+        props = BasicContentPropertyList(content_type=b'text/plain', delivery_mode=2,
+                                         headers=argumentify({'a': 5, 'b': 'xyz'}),
+                                         timestamp=123456, type_=b'event', app_id=b'app')
+        buf = io.BytesIO()
+        props.write_to(buf)
+        data = buf.getvalue()
+
+        lazy = LazyContentPropertyList(BasicContentPropertyList, memoryview(b'\x00' * 12 + data), 12)
+        self.assertIsNone(lazy.index)
+        self.assertEqual(lazy.app_id, b'app')
+        self.assertEqual(lazy.content_type, b'text/plain')
+        self.assertEqual(lazy.delivery_mode, 2)
+        self.assertEqual(lazy.timestamp, 123456)
+        self.assertEqual(lazy.type_, b'event')
+        self.assertIsInstance(lazy.headers, FieldTableView)
+        self.assertEqual(dict(lazy.headers), {b'a': (5, 'b'), b'b': (b'xyz', 'S')})
+        self.assertRaises(AttributeError, lambda: lazy.priority)
+        self.assertIsNone(lazy.get('priority'))
+        self.assertIn('content_type', str(lazy))
+
+        self.assertEqual(lazy.get_size(), len(data))
+        buf = io.BytesIO()
+        lazy.write_to(buf)
+        self.assertEqual(buf.getvalue(), data)
+
+    def test_serializing_received(self):
+        props = BasicContentPropertyList(content_type=b'text/plain',
+                                         headers=argumentify({'a': 5}))
+        buf = io.BytesIO()
+        AMQPHeaderFrame(1, 60, 0, 5, props).write_to(buf)
+        # payload starts after frame type, channel and size
+        received = AMQPHeaderFrame.unserialize(1, memoryview(buf.getvalue())[7:-1]).properties
+        self.assertIsInstance(received, LazyContentPropertyList)
+        self.assertEqual(received.to_bytes(), props.to_bytes())
+        self.assertIsInstance(received.to_bytes(), bytes)
+        self.assertEqual(received.get_size(), props.get_size())
+
+    def test_empty(self):
+        lazy = LazyContentPropertyList(BasicContentPropertyList, memoryview(b'\x00\x00'), 0)
+        self.assertRaises(AttributeError, lambda: lazy.content_type)
+        self.assertEqual(lazy.get_size(), 2)
@@ -8,7 +8,8 @@ import warnings
 
 from coolamqp.framing.definitions import QueueDeclare
 
-from coolamqp.objects import NodeDefinition, MessageProperties, Queue, Exchange
+from coolamqp.objects import NodeDefinition, MessageProperties, Queue, Exchange, \
+    exchange_and_routing_key
 from coolamqp.argumentify import argumentify
 
 logger = logging.getLogger(__name__)
@@ -29,6 +30,11 @@ class TestObjects(unittest.TestCase):
         self.assertEqual(a[xchg], 5)
         self.assertEqual(a[queue], 3)
 
+    def test_exchange_and_routing_key(self):
+        for exchange in (Exchange(u'xchg'), u'xchg', b'xchg'):
+            self.assertEqual(exchange_and_routing_key(exchange, u'rk'), (b'xchg', b'rk'))
+        self.assertEqual(exchange_and_routing_key(None, b'rk'), (b'', b'rk'))
+
     def test_queue_failures(self):
         Queue()
         Queue('')
@@ -59,6 +65,7 @@ class TestObjects(unittest.TestCase):
         msg = MessageProperties(headers={'city': 'sydney'})
         buf = io.BytesIO()
         msg.write_to(buf)
+        self.assertEqual(msg.headers[b'city'], (b'sydney', 'S'))
 
     def test_queue_declare(self):
         args = argumentify({'x-dead-letter-exchange': 'deadletter',
@@ -76,6 +83,15 @@ class TestObjects(unittest.TestCase):
         ce_p_msg = MessageProperties(content_encoding=b'wtf')
         self.assertIn('wtf', str(ce_p_msg))
 
+    def test_message_properties_serialized_once(self):
+        msg = MessageProperties(content_encoding=b'wtf', delivery_mode=2)
+        data = msg.to_bytes()
+        self.assertIs(msg.to_bytes(), data)
+        self.assertEqual(msg.get_size(), len(data))
+        buf = io.BytesIO()
+        msg.write_to(buf)
+        self.assertEqual(buf.getvalue(), data)
+
     def test_node_definition_from_amqp(self):
         n1 = NodeDefinition(u'amqp://ala:ma@kota/psa')
 
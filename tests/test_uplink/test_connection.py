@@ -0,0 +1,134 @@
+# coding=UTF-8
+from __future__ import print_function, absolute_import, division
+
+import unittest
+
+from coolamqp.framing.definitions import BasicConsumeOk, BasicDeliver, ChannelCloseOk, \
+    ChannelClose, BasicAck
+from coolamqp.framing.frames import AMQPMethodFrame, AMQPBodyFrame, AMQPHeartbeatFrame
+from coolamqp.objects import NodeDefinition
+from coolamqp.uplink.connection import Connection, HeaderOrBodyWatch, AnyWatch, \
+    MethodWatch, FailWatch
+
+
+def make_connection():
+    return Connection(NodeDefinition('127.0.0.1', 'guest', 'guest'), None, [])
+
+
+def deliver(channel):
+    return AMQPMethodFrame(channel, BasicDeliver(b'ctag', 1, False, b'', b'rkey'))
+
+
+class TestBatchedDispatch(unittest.TestCase):
+    def test_watch_registered_midbatch_sees_next_frame(self):
+        conn = make_connection()
+        delivered = []
+
+        def on_consume_ok(payload):
+            conn.watch_for_method(1, BasicDeliver, delivered.append)
+
+        conn.watch_for_method(1, BasicConsumeOk, on_consume_ok)
+        conn.on_frames([AMQPMethodFrame(1, BasicConsumeOk(b'ctag')), deliver(1), deliver(1)])
+        self.assertEqual(len(delivered), 1)
+        conn.on_frames([deliver(1)])
+        self.assertEqual(len(delivered), 1)
+
+    def test_channels_and_any_watches(self):
+        conn = make_connection()
+        bodies = []
+        everything = []
+        conn.watch(HeaderOrBodyWatch(1, bodies.append))
+        conn.watch(HeaderOrBodyWatch(2, bodies.append))
+        conn.watch(AnyWatch(everything.append))
+        frames = [AMQPBodyFrame(1, b'a'), AMQPBodyFrame(2, b'b'), AMQPHeartbeatFrame(),
+                  AMQPBodyFrame(1, b'c')]
+        conn.on_frames(frames)
+        self.assertEqual([frame.data for frame in bodies], [b'a', b'b', b'c'])
+        self.assertEqual(len(everything), 4)
+        conn.on_frames([AMQPBodyFrame(2, b'd')])
+        self.assertEqual(len(bodies), 4)
+        self.assertEqual(len(everything), 5)
+
+    def test_unwatch_all_midbatch(self):
+        conn = make_connection()
+        bodies = []
+
+        def on_close_ok(payload):
+            conn.unwatch_all(1)
+
+        conn.watch(HeaderOrBodyWatch(1, bodies.append))
+        conn.watch(MethodWatch(1, ChannelCloseOk, on_close_ok))
+        conn.on_frames([AMQPBodyFrame(1, b'a'), AMQPMethodFrame(1, ChannelCloseOk()),
+                        AMQPBodyFrame(1, b'b')])
+        self.assertEqual(len(bodies), 1)
+        self.assertNotIn(1, conn.watches)
+
+
+class TestDispatchIndex(unittest.TestCase):
+    def test_oneshot_with_many_methods_fires_once(self):
+        conn = make_connection()
+        fired = []
+        failed = []
+        conn.watch_for_method(1, (ChannelClose, ChannelCloseOk), fired.append,
+                              on_fail=lambda: failed.append(True))
+        conn.on_frames([AMQPMethodFrame(1, ChannelCloseOk()),
+                        AMQPMethodFrame(1, ChannelClose(0, b'', 0, 0))])
+        self.assertEqual(len(fired), 1)
+        conn.on_fail()
+        self.assertEqual(failed, [])
+
+    def test_reregistering_doesnt_fire_on_same_frame(self):
+        conn = make_connection()
+        fired = []
+
+        def on_ack(payload):
+            fired.append(payload)
+            conn.watch_for_method(1, BasicAck, on_ack)
+
+        conn.watch_for_method(1, BasicAck, on_ack)
+        conn.on_frames([AMQPMethodFrame(1, BasicAck(1, False))])
+        self.assertEqual(len(fired), 1)
+        conn.on_frames([AMQPMethodFrame(1, BasicAck(2, False))])
+        self.assertEqual(len(fired), 2)
+        self.assertEqual(len(conn.watches[1][BasicAck]), 1)
+
+    def test_fail_watches(self):
+        conn = make_connection()
+        failed = []
+        conn.watch(FailWatch(lambda: failed.append(1)))
+        conn.watch_for_method(2, (BasicAck, ChannelClose), lambda payload: None,
+                              on_fail=lambda: failed.append(2))
+        cancelled = MethodWatch(3, BasicAck, lambda payload: None,
+                                on_end=lambda: failed.append(3))
+        conn.watch(cancelled)
+        cancelled.cancel()
+        conn.on_fail()
+        self.assertEqual(sorted(failed), [1, 2])
+
+    def test_stale_watches_are_cleaned_up(self):
+        conn = make_connection()
+        for i in range(100):
+            conn.watch_for_method(1, (ChannelClose, ChannelCloseOk), lambda payload: None)
+            conn.on_frames([AMQPMethodFrame(1, ChannelCloseOk())])
+        self.assertLess(len(conn.watches[1][ChannelClose]), 32)
+
+    def test_cleanup_while_alerting(self):
+        conn = make_connection()
+        fired = []
+
+        def on_ack(payload):
+            fired.append('oneshot')
+            conn.watch_for_method(1, BasicAck, on_ack)  # makes it 16 watches long
+
+        conn.watch_for_method(1, BasicAck, on_ack)
+        for i in range(13):
+            conn.watch_for_method(1, BasicAck, lambda payload: None).cancel()
+        multishot = MethodWatch(1, BasicAck, lambda payload: fired.append('multishot'))
+        multishot.oneshot = False
+        conn.watch(multishot)
+
+        conn.on_frames([AMQPMethodFrame(1, BasicAck(1, False))])
+        self.assertEqual(fired, ['oneshot', 'multishot'])
+        conn.on_frames([AMQPMethodFrame(1, BasicAck(2, False))])
+        self.assertEqual(fired, ['oneshot', 'multishot', 'multishot', 'oneshot'])
+        self.assertEqual(len(conn.watches[1][BasicAck]), 2)
@@ -0,0 +1,165 @@
+# coding=UTF-8
+from __future__ import print_function, absolute_import, division
+
+import io
+import socket
+import unittest
+
+from coolamqp.framing.definitions import BasicDeliver, BasicContentPropertyList, BasicAck
+from coolamqp.framing.frames import AMQPMethodFrame, AMQPHeaderFrame, AMQPBodyFrame, \
+    AMQPHeartbeatFrame
+from coolamqp.uplink.connection.recv_framer import ReceivingFramer, MIN_RECV_SIZE
+from coolamqp.uplink.listener.socket import BaseSocket, SocketFailed
+
+
+def serialize(frames):
+    buf = io.BytesIO()
+    for frame in frames:
+        frame.write_to(buf)
+    return buf.getvalue()
+
+
+def a_delivery(channel, body):
+    return [
+        AMQPMethodFrame(channel, BasicDeliver(b'ctag', 1, False, b'xchg', b'rkey')),
+        AMQPHeaderFrame(channel, 60, 0, len(body),
+                        BasicContentPropertyList(content_type=b'text/plain')),
+        AMQPBodyFrame(channel, body),
+    ]
+
+
+class TestReceivingFramer(unittest.TestCase):
+    def setUp(self):
+        self.frames = []
+        self.framer = ReceivingFramer(self.frames.append)
+
+    def test_put_byte_by_byte(self):
+        data = serialize(a_delivery(1, b'hello') + [AMQPHeartbeatFrame()])
+        for i in range(len(data)):
+            self.framer.put(data[i:i + 1])
+
+        self.assertEqual(len(self.frames), 4)
+        self.assertEqual(self.frames[0].payload.routing_key, b'rkey')
+        self.assertEqual(self.frames[1].properties.content_type, b'text/plain')
+        self.assertEqual(self.frames[1].body_size, 5)
+        self.assertEqual(self.frames[2].data.tobytes(), b'hello')
+        self.assertIsInstance(self.frames[3], AMQPHeartbeatFrame)
+
+    def test_recv_into(self):
+        data = serialize(a_delivery(2, b'x' * 1000) * 10)
+        while data:
+            buf = self.framer.get_buffer()
+            chunk = data[:len(buf)]
+            buf[:len(chunk)] = chunk
+            self.framer.on_received(len(chunk))
+            data = data[len(chunk):]
+
+        self.assertEqual(len(self.frames), 30)
+        self.assertTrue(all(frame.channel == 2 for frame in self.frames))
+
+    def test_frames_stay_valid_after_buffer_is_exhausted(self):
+        body = b'y' * 50000
+        for i in range(50):
+            self.framer.put(serialize(a_delivery(1, body)))
+        self.assertEqual(len(self.frames), 150)
+        for frame in self.frames[2::3]:
+            self.assertEqual(frame.data.tobytes(), body)
+        for frame in self.frames[0::3]:
+            self.assertEqual(frame.payload.exchange, b'xchg')
+
+    def test_buffer_reused_when_not_referenced(self):
+        framer = ReceivingFramer(lambda frame: None)
+        first_buffer = framer.buf
+        for i in range(50):
+            framer.put(serialize(a_delivery(1, b'z' * 50000)))
+        if hasattr(memoryview, 'release'):
+            self.assertIs(framer.buf, first_buffer)
+
+    def test_adaptive_recv_size(self):
+        self.assertEqual(len(self.framer.get_buffer()), MIN_RECV_SIZE)
+        self.framer.on_received(0)
+        for i in range(20):
+            buf = self.framer.get_buffer()
+            buf[:] = AMQPHeartbeatFrame.DATA * (len(buf) // AMQPHeartbeatFrame.LENGTH)
+            self.framer.on_received(len(buf))
+        self.assertEqual(self.framer.recv_size, 131072)
+
+        self.framer.set_frame_max(8192)
+        self.assertEqual(len(self.framer.get_buffer()), 8192)
+        for i in range(10):
+            self.framer.get_buffer()
+            self.framer.on_received(0)
+        self.assertEqual(self.framer.recv_size, MIN_RECV_SIZE)
+
+    def test_invalid_frames(self):
+        self.assertRaises(ValueError, self.framer.put, b'\x09\x00\x00\x00\x00\x00\x00\xce')
+        framer = ReceivingFramer()
+        self.assertRaises(ValueError, framer.put, b'\x08\x00\x00\x00\x00\x00\x00\xcf')
+
+
+class TestSocketReceivingInto(unittest.TestCase):
+    def test_socket(self):
+        frames = []
+        framer = ReceivingFramer(frames.append)
+        a, b = socket.socketpair()
+        try:
+            sock = BaseSocket(a, recv_into=framer)
+            b.sendall(serialize(a_delivery(3, b'body') + [AMQPHeartbeatFrame()]))
+            sock.on_read()
+            self.assertEqual(len(frames), 4)
+            self.assertEqual(frames[2].data.tobytes(), b'body')
+
+            b.sendall(b'\x05\x00\x00\x00\x00\x00\x00\xce')
+            self.assertRaises(SocketFailed, sock.on_read)
+            b.close()
+            self.assertRaises(SocketFailed, sock.on_read)
+        finally:
+            a.close()
+
+
+class TestBatching(unittest.TestCase):
+    def test_on_frames(self):
+        batches = []
+        framer = ReceivingFramer(on_frames=batches.append)
+        data = serialize(a_delivery(1, b'abc') * 3)
+        framer.put(data[:-5])
+        framer.put(data[-5:])
+        framer.put(b'')
+        self.assertEqual([len(batch) for batch in batches], [8, 1])
+
+
+class RecordingReceiver(object):
+    def __init__(self, events):
+        self.events = events
+
+    def on_deliver(self, delivery_tag, exchange, routing_key):
+        self.events.append(('deliver', delivery_tag, exchange.tobytes(), routing_key.tobytes()))
+
+    def on_content_header(self, body_size, properties):
+        self.events.append(('header', body_size, properties.content_type.tobytes()))
+
+    def on_body(self, data):
+        self.events.append(('body', data.tobytes()))
+
+
+class TestContentReceivers(unittest.TestCase):
+    def test_fast_path(self):
+        events = []
+        framer = ReceivingFramer(on_frames=lambda frames: events.extend(frames))
+        framer.content_receivers[1] = RecordingReceiver(events)
+        framer.put(serialize([AMQPHeartbeatFrame()] + a_delivery(1, b'hello') +
+                             a_delivery(2, b'other') + [AMQPMethodFrame(1, BasicAck(1, False))]))
+
+        self.assertIsInstance(events[0], AMQPHeartbeatFrame)
+        self.assertEqual(events[1:4], [('deliver', 1, b'xchg', b'rkey'),
+                                       ('header', 5, b'text/plain'),
+                                       ('body', b'hello')])
+        self.assertEqual([frame.channel for frame in events[4:]], [2, 2, 2, 1])
+        self.assertIsInstance(events[-1].payload, BasicAck)
+
+    def test_receiver_removed_by_earlier_frame(self):
+        events = []
+        framer = ReceivingFramer(on_frames=lambda frames: framer.content_receivers.clear())
+        framer.content_receivers[1] = RecordingReceiver(events)
+        framer.put(serialize([AMQPHeartbeatFrame()] + a_delivery(1, b'hello')))
+        self.assertEqual(events, [])
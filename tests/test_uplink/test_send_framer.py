@@ -0,0 +1,238 @@
+# coding=UTF-8
+from __future__ import print_function, absolute_import, division
+
+import mmap
+import os
+import socket
+import tempfile
+import threading
+import unittest
+
+from coolamqp.framing.body_stream import AMQPBodyStream
+from coolamqp.framing.frames import AMQPBodyFrame, AMQPHeartbeatFrame, AMQPHeaderFrame, \
+    AMQPMethodFrame
+from coolamqp.objects import StreamedBody
+from coolamqp.uplink.connection.recv_framer import ReceivingFramer
+from coolamqp.uplink.connection.send_framer import SendingFramer, COPY_THRESHOLD
+from coolamqp.uplink.listener.socket import BaseSocket, SocketFailed
+from tests.test_uplink.test_recv_framer import serialize, a_delivery
+
+
+class TestSendingFramer(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        self.framer = SendingFramer(lambda data, priority: self.sent.append(data))
+
+    def test_same_as_write_to(self):
+        frames = a_delivery(1, b'hello') + a_delivery(2, b'x' * 5000) + [AMQPHeartbeatFrame()]
+        self.framer.send(frames)
+        buffers, = self.sent
+        self.assertEqual(b''.join(bytes(buffer) for buffer in buffers), serialize(frames))
+
+    def test_large_body_not_copied(self):
+        body = b'x' * COPY_THRESHOLD
+        self.framer.send(a_delivery(1, body))
+        buffers, = self.sent
+        self.assertEqual(len(buffers), 3)  # frames up to the body, the body, and it's frame end
+        self.assertIs(buffers[1], body)
+
+    def test_mutable_body_copied(self):
+        body = bytearray(b'x' * COPY_THRESHOLD)
+        self.framer.send(a_delivery(1, memoryview(body)))
+        body[:] = b'y' * COPY_THRESHOLD     # reused right after publishing
+        buffers, = self.sent
+        self.assertEqual(b''.join(bytes(buffer) for buffer in buffers),
+                         serialize(a_delivery(1, b'x' * COPY_THRESHOLD)))
+
+    def test_view_of_bytes_not_copied(self):
+        body = memoryview(b'x' * 2 * COPY_THRESHOLD)[COPY_THRESHOLD:]
+        self.framer.send(a_delivery(1, body))
+        buffers, = self.sent
+        if hasattr(body, 'obj'):    # can't tell what's behind a memoryview on Python 2
+            self.assertIs(buffers[1], body)
+
+    def test_arena_reuse(self):
+        arena = self.framer.arena
+        self.framer.send(a_delivery(1, b'x' * COPY_THRESHOLD))
+        self.framer.send(a_delivery(1, b'hello'))
+        self.assertIs(self.framer.arena, arena)
+        self.assertEqual(arena.tell(), 0)
+        self.assertEqual(b''.join(bytes(buffer) for data in self.sent for buffer in data),
+                         serialize(a_delivery(1, b'x' * COPY_THRESHOLD) + a_delivery(1, b'hello')))
+
+    def test_arena_per_thread(self):
+        arenas = []
+        thread = threading.Thread(target=lambda: arenas.append(self.framer.arena))
+        thread.start()
+        thread.join()
+        self.assertIsNot(arenas[0], self.framer.arena)
+
+        def send_many(body):
+            for i in range(200):
+                self.framer.send(a_delivery(i + 1, body))
+
+        threads = [threading.Thread(target=send_many, args=(b'%d' % i * 100, ))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(self.sent), 800)
+        expected = set(serialize(a_delivery(i + 1, b'%d' % j * 100))
+                       for i in range(200) for j in range(4))
+        for data in self.sent:
+            self.assertIn(b''.join(bytes(buffer) for buffer in data), expected)
+
+    def test_invalid_frame_is_dropped(self):
+        self.assertRaises(Exception, self.framer.send,
+                          [AMQPHeartbeatFrame(), AMQPBodyFrame(1, b'ok'), None])
+        self.assertEqual(self.sent, [])
+        self.framer.send([AMQPHeartbeatFrame()])
+        self.assertEqual(self.sent, [[AMQPHeartbeatFrame.DATA]])
+
+
+class TestSocketWrite(unittest.TestCase):
+    def test_partial_writes(self):
+        a, b = socket.socketpair()
+        try:
+            a.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+            a.settimeout(0)
+            framer = SendingFramer()
+            sock = BaseSocket(a)
+            framer.on_send = sock.send
+
+            frames = []
+            for i in range(100):
+                frames.extend(a_delivery(i + 1, (b'%d' % (i, )) * (i * 100)))
+            for frame in frames:
+                framer.send([frame], priority=False)
+            expected = serialize(frames)
+
+            received = []
+            while sock.wants_to_send_data():
+                sock.on_write()
+                while True:
+                    try:
+                        data = b.recv(65536, socket.MSG_DONTWAIT)
+                    except (IOError, socket.error):
+                        break
+                    received.append(data)
+            self.assertEqual(b''.join(received), expected)
+        finally:
+            a.close()
+            b.close()
+
+    def test_without_sendmsg(self):
+        a, b = socket.socketpair()
+        try:
+            sock = BaseSocket(a)
+            sock.can_sendmsg = False
+            sock.send([b'abc', memoryview(b'def'), b''], priority=False)
+            sock.send(b'ghi', priority=False)
+            self.assertTrue(sock.on_write())
+            self.assertEqual(b.recv(100), b'abcdefghi')
+        finally:
+            a.close()
+            b.close()
+
+
+class TestStreamedBody(unittest.TestCase):
+    MAX_BODY_SIZE = 1000
+
+    def setUp(self):
+        self.a, self.b = socket.socketpair()
+        self.a.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        self.a.settimeout(0)
+        self.sock = BaseSocket(self.a)
+        self.framer = SendingFramer(self.sock.send)
+
+    def tearDown(self):
+        self.a.close()
+        self.b.close()
+
+    def send_streamed(self, body, data):
+        """Send a delivery with a StreamedBody, and return what was expected"""
+        frames = a_delivery(1, b'')
+        header = AMQPHeaderFrame(1, 60, 0, len(body), frames[1].properties)
+        self.framer.send([frames[0], header, AMQPBodyStream(1, body, self.MAX_BODY_SIZE)],
+                         priority=False)
+        return serialize([frames[0], header] + [
+            AMQPBodyFrame(1, data[i:i + self.MAX_BODY_SIZE])
+            for i in range(0, len(data), self.MAX_BODY_SIZE)])
+
+    def receive_all(self):
+        received = []
+        while self.sock.wants_to_send_data():
+            self.sock.on_write()
+            while True:
+                try:
+                    data = self.b.recv(65536, socket.MSG_DONTWAIT)
+                except (IOError, socket.error):
+                    break
+                received.append(data)
+        return b''.join(received)
+
+    def test_sources(self):
+        data = os.urandom(10500)
+        with tempfile.TemporaryFile() as f:
+            f.write(b'skip' + data)
+            f.seek(4)
+            expected = self.send_streamed(StreamedBody(f), data)
+            expected += self.send_streamed(StreamedBody(iter([data[:2000], b'', data[2000:]]),
+                                                        len(data)), data)
+            expected += self.send_streamed(StreamedBody(data), data)
+            mapped = mmap.mmap(-1, len(data))
+            mapped.write(data)
+            expected += self.send_streamed(StreamedBody(mapped), data)
+            after = a_delivery(1, b'')[:1]  # waits for all the messages on it's channel
+            self.framer.send(after, priority=False)
+            expected += serialize(after)
+            self.assertEqual(self.receive_all(), expected)
+
+    def test_without_sendfile(self):
+        self.sock.can_sendfile = False
+        data = os.urandom(5000)
+        with tempfile.TemporaryFile() as f:
+            f.write(data)
+            f.seek(0)
+            expected = self.send_streamed(StreamedBody(f), data)
+            self.assertEqual(self.receive_all(), expected)
+
+    def test_priority_between_frames(self):
+        data = b'x' * 3000
+        self.send_streamed(StreamedBody(data), data)
+        self.sock._pick_buffers()
+        self.sock.send(AMQPHeartbeatFrame.DATA)
+        received = self.receive_all()
+        # heartbeat goes before the first body frame
+        index = received.index(AMQPHeartbeatFrame.DATA)
+        self.assertEqual(received[index - 1:index], b'\xce')
+        self.assertLess(index, len(received) - 2 * self.MAX_BODY_SIZE)
+
+    def test_other_channels_interleaved(self):
+        data = b'x' * 3000
+        self.send_streamed(StreamedBody(data), data)
+        self.sock._pick_buffers()
+        self.framer.send(a_delivery(1, b'after'), priority=False)
+        self.framer.send(a_delivery(2, b'other'), priority=False)
+        self.framer.send(a_delivery(3, b'third'), priority=False)
+
+        frames = []
+        ReceivingFramer(frames.append).put(self.receive_all())
+        self.assertEqual([(frame.channel, type(frame)) for frame in frames], [
+            (1, AMQPMethodFrame), (1, AMQPHeaderFrame),
+            (2, AMQPMethodFrame), (2, AMQPHeaderFrame), (2, AMQPBodyFrame),
+            (1, AMQPBodyFrame),
+            (3, AMQPMethodFrame), (3, AMQPHeaderFrame), (3, AMQPBodyFrame),
+            (1, AMQPBodyFrame), (1, AMQPBodyFrame),
+            (1, AMQPMethodFrame), (1, AMQPHeaderFrame), (1, AMQPBodyFrame),
+        ])
+        self.assertEqual(bytes(frames[-1].data), b'after')
+
+    def test_body_shorter_than_declared(self):
+        self.send_streamed(StreamedBody(iter([b'x' * 10]), 20), b'x' * 10)
+        self.assertRaises(SocketFailed, self.receive_all)
+
+    def test_length_required(self):
+        self.assertRaises(ValueError, StreamedBody, iter([b'x']))